@@ -4,46 +4,146 @@
 
 """Main (module) entry point for Treater, a Raspberry Pi-based remotely accessible pet feeder"""
 
-from datetime import datetime
-from twisted.internet import reactor
-from website import TreatWeb, TreatWebConfig
-from machine import TreatMachine, TreatMachineConfig
-from camera import TreatCam, TreatCamConfig
 from argparse import ArgumentParser
 from ConfigParser import SafeConfigParser
+from startup import STARTUP, ImportProfiler
 
-def initializeLogging(configFile):
+def initializeLogging(configFile, config):
     from logging.config import fileConfig
     from twisted.python.log import PythonLoggingObserver
+    from asynclog import AsyncLogConfig, installAsyncLogging
     fileConfig(configFile)
+    installAsyncLogging(AsyncLogConfig(config))
     observer = PythonLoggingObserver()
     observer.start()
 
+def createCamera(reactor, config):
+    # Only the configured camera implementation is imported; raspicam pulls in PIL
+    if config.get("camera", "type") == "raspicam":
+        from raspicam import TreatCam, TreatCamConfig
+    else:
+        from camera import TreatCam, TreatCamConfig
+    return TreatCam(reactor, TreatCamConfig(config))
+
 if __name__ == "__main__":
     parser = ArgumentParser(description = "Service for Raspberry Pi powered pet treat feeder")
     parser.add_argument("-C")
+    parser.add_argument("--profile-imports", action="store_true", help="log how long each module took to import")
+    parser.add_argument("--fleet", action="store_true", help="run as a fleet aggregator of the [fleet] nodes, without hardware")
     args = parser.parse_args()
 
+    profiler = None
+    if args.profile_imports:
+        profiler = ImportProfiler()
+        profiler.install()
+
     config = SafeConfigParser()
     config.read(args.C)
 
-    initializeLogging(args.C)
+    initializeLogging(args.C, config)
     from logging import getLogger
     LOGGER = getLogger("main")
 
-    camera = TreatCam(reactor, TreatCamConfig(config))
+    from tracebuffer import TraceConfig, configureTrace
+    configureTrace(TraceConfig(config))
+
+    from twisted.internet import reactor
+    from website import TreatWeb, TreatWebConfig
+
+    if args.fleet:
+        from fleet import FleetConfig, startFleetAggregator
+        startFleetAggregator(reactor, FleetConfig(config), TreatWebConfig(config).port)
+        reactor.run()
+        raise SystemExit()
+
+    # Listen first, so that getStatus can report "Initializing" while the slower hardware set-up runs
+    webConfig = TreatWebConfig(config)
+    web = TreatWeb(reactor, None, None, webConfig)
+    from memory import MemoryConfig, startMemoryMonitor, AdminMemoryResource
+    memoryMonitor = startMemoryMonitor(reactor, MemoryConfig(config))
+    if web.admin is not None:
+        web.admin.putChild("memory", AdminMemoryResource(memoryMonitor))
+    if webConfig.apiWorkers:
+        from apiworkers import startApiWorkers
+        startApiWorkers(reactor, args.C, webConfig, web)
+
+    hardware = {}
+
+    def reportImports():
+        if profiler is not None:
+            profiler.uninstall()
+            LOGGER.info(profiler.report())
 
-    machine = TreatMachine(reactor, TreatMachineConfig(config))
-    machine.start()
+    def initializeCamera():
+        try:
+            hardware["camera"] = createCamera(reactor, config)
+        except Exception:
+            LOGGER.exception("Unable to initialize the camera")
+            reportImports()
+            reactor.stop()
+            return
+        if getattr(hardware["camera"], "store", None) is not None and not webConfig.serveCaptures:
+            # Nothing else can read captures out of segment files, so they would never be served
+            LOGGER.error("captureStorage = segments needs serveCaptures = true in the [web] section")
+            reportImports()
+            reactor.stop()
+            return
+        STARTUP.mark("camera_ready")
+        reactor.callLater(0, provisionMachineGpio)
+
+    def provisionMachineGpio():
+        # Waiting for udev to make the pins writable can take seconds; a thread keeps the reactor answering requests
+        from twisted.internet.threads import deferToThread
+        from machine import TreatMachineConfig, provisionGpio
+        machineConfig = TreatMachineConfig(config)
+        d = deferToThread(provisionGpio, machineConfig)
+        d.addCallbacks(initializeMachine, machineFailed, callbackArgs=(machineConfig,))
+
+    def machineFailed(failure):
+        LOGGER.error("Unable to initialize the treat machine: %s" % failure.getTraceback())
+        reportImports()
+        reactor.stop()
+
+    def initializeMachine(gpio, machineConfig):
+        from machine import TreatMachine
+        try:
+            machine = TreatMachine(reactor, machineConfig, gpio=gpio)
+        except Exception:
+            LOGGER.exception("Unable to initialize the treat machine")
+            reportImports()
+            reactor.stop()
+            return
+        hardware["machine"] = machine
+        camera = hardware["camera"]
+        from correlation import CorrelationIndex, CorrelationConfig
+        correlation = CorrelationIndex(CorrelationConfig(config))
+        store = getattr(camera, "store", None)
+        correlation.open(machine.history, camera.config.captureDir, store.names if store is not None else None,
+                         camera.getLastCaptureName())
+        camera.addCaptureListener(correlation)
+        machine.history.addListener(correlation)
+        machine.addDispenseListener(camera)
+        hardware["correlation"] = correlation
+        machine.start()
+        web.attach(machine, camera, correlation)
+        STARTUP.mark("hardware_ready")
+        reportImports()
+
+    # Each stage is its own reactor turn, so requests that arrive in between are answered
+    reactor.callWhenRunning(initializeCamera)
 
-    web = TreatWeb(reactor, machine, camera, TreatWebConfig(config)) 
-    
     def shutdown():
-        machine.stop()
-        machine.close()
+        machine = hardware.get("machine")
+        lcdClosed = None
+        if machine is not None:
+            machine.stop()
+            lcdClosed = machine.close()
+        correlation = hardware.get("correlation")
+        if correlation is not None:
+            correlation.close()
         LOGGER.info("Treater exiting")
+        # Shutdown waits until the display has been told the treater is disabled
+        return lcdClosed
     reactor.addSystemEventTrigger('before', 'shutdown', shutdown)
-    
-    reactor.run()
-
 
+    reactor.run()
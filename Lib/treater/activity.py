@@ -0,0 +1,241 @@
+#!/usr/bin/python
+
+# treater/activity.py
+
+"""Keeps the motion score of every analysed frame as an activity time series, at per-second, per-minute and per-hour
+resolution in fixed-size arrays, so that an activity chart can be drawn without looking at any images. Each second's
+scores are appended to a file as the second closes, and replayed into the arrays at start-up"""
+
+import os
+import sys
+import time
+from array import array
+from logging import getLogger
+from metrics import REGISTRY
+
+LOGGER = getLogger("camera")
+
+FRAMES_RECORDED = REGISTRY.counter("treater_activity_frames_total", "Motion frame scores recorded in the activity series")
+
+# Names, bucket seconds and bucket count of each level: 6 hours of seconds, 7 days of minutes and a year of hours
+LEVELS = (("second", 1, 6 * 3600), ("minute", 60, 7 * 24 * 60), ("hour", 3600, 366 * 24))
+
+# The finest resolution is chosen that keeps a query's result under this many buckets
+MAX_AUTO_BUCKETS = 1500
+
+class ActivityLevel:
+    """A ring of buckets, each holding the peak and total motion score and the number of frames in one interval.
+    A slot belongs to the interval whose number is in buckets; anything else in it is stale"""
+
+    def __init__(self, name, seconds, slots):
+        self.name = name
+        self.seconds = seconds
+        self.slots = slots
+        self.buckets = array("l", [-1]) * slots
+        self.peaks = array("I", [0]) * slots
+        self.totals = array("I", [0]) * slots
+        self.frames = array("I", [0]) * slots
+
+    def add(self, epoch, peak, total, frames):
+        bucket = int(epoch) // self.seconds
+        slot = bucket % self.slots
+        if self.buckets[slot] != bucket:
+            if self.buckets[slot] > bucket:
+                # Older than the ring reaches
+                return
+            self.buckets[slot] = bucket
+            self.peaks[slot] = 0
+            self.totals[slot] = 0
+            self.frames[slot] = 0
+        self.peaks[slot] = max(self.peaks[slot], peak)
+        self.totals[slot] += total
+        self.frames[slot] += frames
+
+    def records(self, fromEpoch, toEpoch):
+        """(start epoch, peak, total, frames) for each bucket with frames in [fromEpoch, toEpoch)"""
+        first = int(fromEpoch) // self.seconds
+        last = (int(toEpoch) - 1) // self.seconds
+        first = max(first, last - self.slots + 1)
+        result = []
+        for bucket in xrange(first, last + 1):
+            slot = bucket % self.slots
+            if self.buckets[slot] == bucket and self.frames[slot]:
+                result.append((bucket * self.seconds, int(self.peaks[slot]), int(self.totals[slot]), int(self.frames[slot])))
+        return result
+
+    def query(self, fromEpoch, toEpoch):
+        """[start epoch, peak, mean, frames] for each bucket with frames in [fromEpoch, toEpoch)"""
+        return [[start, peak, round(float(total) / frames, 1), frames]
+                for (start, peak, total, frames) in self.records(fromEpoch, toEpoch)]
+
+    def retainedFrom(self, now):
+        return (int(now) // self.seconds - self.slots + 1) * self.seconds
+
+    def memoryUsage(self):
+        return sum(a.buffer_info()[1] * a.itemsize for a in (self.buckets, self.peaks, self.totals, self.frames))
+
+class ActivitySeries:
+    """record(epoch, score) for each analysed motion frame; query(fromEpoch, toEpoch, resolution) to read it back"""
+
+    def __init__(self, path = ""):
+        self.levels = [ActivityLevel(name, seconds, slots) for (name, seconds, slots) in LEVELS]
+        self.levelsByName = dict((level.name, level) for level in self.levels)
+        self.path = path
+        self.file = None
+        # [second, peak, total, frames] of the second being accumulated, written to the file when it closes
+        self.pending = None
+        if path:
+            self.load(path)
+            self.open(path)
+
+    def __str__(self):
+        return "ActivitySeries"
+
+    def record(self, epoch, score):
+        FRAMES_RECORDED.inc()
+        for level in self.levels:
+            level.add(epoch, score, score, 1)
+        second = int(epoch)
+        pending = self.pending
+        if pending is not None and pending[0] == second:
+            pending[1] = max(pending[1], score)
+            pending[2] += score
+            pending[3] += 1
+        else:
+            self.flush()
+            self.pending = [second, score, score, 1]
+
+    def flush(self):
+        if self.pending is None:
+            return
+        if self.file is not None:
+            try:
+                self.file.write("%d %d %d %d\n" % tuple(self.pending))
+            except IOError:
+                LOGGER.error("Unable to append to activity file: %s" % self.path)
+        self.pending = None
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def open(self, path):
+        try:
+            # Line buffered, so each second reaches the file in a single write
+            self.file = open(path, "a", 1)
+        except IOError:
+            LOGGER.exception("Unable to open activity file: %s" % path)
+            self.file = None
+
+    def load(self, path):
+        """Replays the file into the levels, then rewrites it if most of it could be held at a coarser resolution"""
+        if not os.path.isfile(path):
+            return
+        start = time.time()
+        retainedFrom = [level.retainedFrom(start) for level in self.levels]
+        lines = 0
+        try:
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        (second, peak, total, frames) = [int(field) for field in line.split()]
+                    except ValueError:
+                        # Cut short by a crash
+                        continue
+                    lines += 1
+                    for (level, levelFrom) in zip(self.levels, retainedFrom):
+                        if second >= levelFrom:
+                            level.add(second, peak, total, frames)
+        except IOError:
+            LOGGER.exception("Unable to read activity file: %s" % path)
+            return
+        compacted = self.compactedRecords(start)
+        if lines > len(compacted) * 5 / 4:
+            self.rewrite(path, compacted)
+            LOGGER.info("Loaded %d activity records in %.0f ms, compacted to %d" % (
+                lines, (time.time() - start) * 1000, len(compacted)))
+
+    def compactedRecords(self, now):
+        """Each level's buckets from where the next finer level stops holding them, as file records. The file is then
+        no bigger than the levels, however long the treater has been recording"""
+        records = []
+        upTo = sys.maxint
+        for (level, coarser) in zip(self.levels, self.levels[1:] + [None]):
+            # Start on a boundary of the next coarser level, which writes everything before it
+            levelFrom = level.retainedFrom(now)
+            if coarser is not None:
+                levelFrom = -(-levelFrom // coarser.seconds) * coarser.seconds
+            else:
+                levelFrom = 0
+            records.extend(level.records(levelFrom, min(upTo, int(now) + 1)))
+            upTo = levelFrom
+        records.sort()
+        return records
+
+    def rewrite(self, path, records):
+        temporaryPath = path + ".tmp"
+        try:
+            with open(temporaryPath, "w") as f:
+                for record in records:
+                    f.write("%d %d %d %d\n" % record)
+            os.rename(temporaryPath, path)
+        except (IOError, OSError):
+            LOGGER.exception("Unable to compact activity file: %s" % path)
+
+    def chooseLevel(self, fromEpoch, toEpoch, now):
+        """The finest level that still holds fromEpoch and covers the range in at most MAX_AUTO_BUCKETS buckets"""
+        for level in self.levels:
+            if fromEpoch >= level.retainedFrom(now) and (toEpoch - fromEpoch) / level.seconds <= MAX_AUTO_BUCKETS:
+                return level
+        return self.levels[-1]
+
+    def query(self, fromEpoch, toEpoch, resolution = None):
+        """Returns (level, buckets). resolution is a level name, or None to choose one. Raises ValueError for an
+        unknown resolution"""
+        if resolution is None:
+            level = self.chooseLevel(fromEpoch, toEpoch, time.time())
+        elif resolution in self.levelsByName:
+            level = self.levelsByName[resolution]
+        else:
+            raise ValueError("resolution must be one of: %s" % ", ".join(name for (name, seconds, slots) in LEVELS))
+        return (level, level.query(fromEpoch, toEpoch))
+
+    def memoryUsage(self):
+        return (sum(level.memoryUsage() for level in self.levels), sum(level.slots for level in self.levels))
+
+if __name__ == "__main__":
+    import random
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), "activity")
+    series = ActivitySeries(path)
+    now = time.time()
+    start = now - 3 * 24 * 3600
+    began = time.time()
+    epoch = start
+    frames = 0
+    while epoch < now:
+        # A burst of activity around each meal, quiet otherwise
+        active = (epoch % 43200) < 600
+        series.record(epoch, random.randint(40, 400) if active else random.randint(0, 5))
+        epoch += 0.5 if active else 4.0
+        frames += 1
+    series.close()
+    print("Recorded %d frames in %.2f s; arrays hold %d KB" % (
+        frames, time.time() - began, series.memoryUsage()[0] // 1024))
+    written = os.path.getsize(path)
+    began = time.time()
+    ActivitySeries(path).close()
+    print("Reloaded %d KB file in %.2f s, compacting it to %d KB" % (
+        written // 1024, time.time() - began, os.path.getsize(path) // 1024))
+    began = time.time()
+    reloaded = ActivitySeries(path)
+    print("Reloaded the compacted file in %.2f s; hourly series %s" % (time.time() - began,
+        "unchanged" if reloaded.query(start, now, "hour")[1] == series.query(start, now, "hour")[1] else "CHANGED"))
+    for (fromEpoch, resolution) in ((now - 600, None), (now - 6 * 3600, None), (now - 3 * 24 * 3600, None), (now - 3600, "second")):
+        began = time.time()
+        (level, buckets) = reloaded.query(fromEpoch, now, resolution)
+        print("Last %5.1f hours: %d %s buckets in %.1f ms; busiest %s" % (
+            (now - fromEpoch) / 3600, len(buckets), level.name, (time.time() - began) * 1000,
+            max(buckets, key=lambda b: b[1]) if buckets else None))
@@ -0,0 +1,36 @@
+#!/usr/bin/python
+
+# treater/admin.py
+
+"""Password-protected admin API for diagnosing a running treater"""
+
+from logging import getLogger
+from zope.interface import implements
+from twisted.cred import portal, checkers
+from twisted.web.guard import HTTPAuthSessionWrapper, DigestCredentialFactory, BasicCredentialFactory
+from twisted.web.resource import Resource, IResource
+
+LOGGER = getLogger("webapi")
+
+REALM = b"treater admin"
+
+class AdminRealm:
+    implements(portal.IRealm)
+
+    def __init__(self, resource):
+        self.resource = resource
+
+    def requestAvatar(self, avatarId, mind, *interfaces):
+        if IResource in interfaces:
+            LOGGER.info("Admin API request from user %s" % avatarId)
+            return (IResource, self.resource, lambda: None)
+        raise NotImplementedError()
+
+def createAdminResource(passwordFile):
+    """Returns (admin, protected): children are added to admin, and protected is what gets mounted. The password
+    file holds username:password lines. Digest is offered first so that passwords need not cross the network"""
+    admin = Resource()
+    checker = checkers.FilePasswordDB(passwordFile, cache=True)
+    credentialFactories = [DigestCredentialFactory(b"md5", REALM), BasicCredentialFactory(REALM)]
+    protected = HTTPAuthSessionWrapper(portal.Portal(AdminRealm(admin), [checker]), credentialFactories)
+    return (admin, protected)
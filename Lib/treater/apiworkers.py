@@ -0,0 +1,238 @@
+#!/usr/bin/python
+
+# treater/apiworkers.py
+
+"""Split deployment: read-only API worker processes serve getStatus from a shared status snapshot, and forward
+everything else to the hardware-owner process over a Unix socket"""
+
+import json
+import os
+import socket
+import sys
+from logging import getLogger
+from cStringIO import StringIO
+from twisted.internet import reactor, protocol, task
+from twisted.internet.endpoints import UNIXClientEndpoint
+from twisted.web.client import Agent, HTTPConnectionPool, FileBodyProducer, readBody
+from twisted.web.http_headers import Headers
+from twisted.web.resource import Resource
+from twisted.web.server import Site, NOT_DONE_YET
+from statussnapshot import StatusSnapshot
+
+LOGGER = getLogger("webapi")
+
+LISTEN_FD = 3
+RESPAWN_SECONDS = 1.0
+FORWARDED_REQUEST_HEADERS = (b"Content-Type", b"Accept", b"Authorization", b"If-None-Match", b"If-Modified-Since", b"Range")
+FORWARDED_RESPONSE_HEADERS = (b"Content-Type", b"Cache-Control", b"ETag", b"Last-Modified", b"Content-Range", b"WWW-Authenticate")
+
+class StatusPublisher:
+    """Runs in the owner process and periodically publishes the getStatus document into the snapshot"""
+
+    def __init__(self, reactor, snapshot, statusResource, intervalSeconds):
+        self.snapshot = snapshot
+        self.statusResource = statusResource
+        self.call = task.LoopingCall(self.publish)
+        self.call.clock = reactor
+        self.intervalSeconds = intervalSeconds
+
+    def start(self):
+        self.call.start(self.intervalSeconds)
+
+    def stop(self):
+        if self.call.running:
+            self.call.stop()
+
+    def publish(self):
+        try:
+            self.snapshot.publish(json.dumps(self.statusResource.getStatus()))
+        except Exception:
+            LOGGER.exception("Unable to publish status snapshot")
+
+class WorkerProcessProtocol(protocol.ProcessProtocol):
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+
+    def processEnded(self, reason):
+        self.pool.workerEnded(self.index, reason)
+
+class ApiWorkerPool:
+    """Owns the shared listening socket and keeps the configured number of worker processes running"""
+
+    def __init__(self, reactor, configPath, config):
+        self.reactor = reactor
+        self.configPath = configPath
+        self.config = config
+        self.workers = {}
+        self.stopping = False
+        if config.workerSocket:
+            if os.path.exists(config.workerSocket):
+                os.remove(config.workerSocket)
+            self.family = socket.AF_UNIX
+            self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.listener.bind(config.workerSocket)
+        else:
+            self.family = socket.AF_INET
+            self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.listener.bind(("", config.port))
+        self.listener.listen(128)
+        self.listener.setblocking(False)
+
+    def __str__(self):
+        return "ApiWorkerPool"
+
+    def start(self):
+        LOGGER.info("Starting %d API worker processes" % self.config.apiWorkers)
+        for index in range(self.config.apiWorkers):
+            self.spawn(index)
+
+    def spawn(self, index):
+        if self.stopping:
+            return
+        args = [sys.executable, "-m", "treater.apiworkers", "-C", self.configPath,
+                "--family", "unix" if self.family == socket.AF_UNIX else "inet"]
+        childFDs = {0: "w", 1: 1, 2: 2, LISTEN_FD: self.listener.fileno()}
+        self.workers[index] = self.reactor.spawnProcess(WorkerProcessProtocol(self, index), sys.executable, args,
+                                                        env=os.environ, childFDs=childFDs)
+
+    def workerEnded(self, index, reason):
+        self.workers.pop(index, None)
+        if not self.stopping:
+            LOGGER.error("API worker %d exited (%s); restarting it" % (index, reason.getErrorMessage()))
+            self.reactor.callLater(RESPAWN_SECONDS, self.spawn, index)
+
+    def stop(self):
+        self.stopping = True
+        for transport in self.workers.values():
+            try:
+                transport.signalProcess("TERM")
+            except Exception:
+                pass
+        self.listener.close()
+
+def startApiWorkers(reactor, configPath, config, web):
+    """Called in the owner process once TreatWeb is listening on the control socket"""
+    snapshot = StatusSnapshot(config.statusSnapshotFile, create=True)
+    publisher = StatusPublisher(reactor, snapshot, web.statusResource, config.snapshotIntervalSeconds)
+    publisher.start()
+    pool = ApiWorkerPool(reactor, configPath, config)
+    pool.start()
+    def shutdown():
+        publisher.stop()
+        pool.stop()
+        snapshot.close()
+    reactor.addSystemEventTrigger('before', 'shutdown', shutdown)
+    return pool
+
+class SnapshotStatusResource(Resource):
+    isLeaf = True
+
+    def __init__(self, snapshot):
+        Resource.__init__(self)
+        self.snapshot = snapshot
+
+    def render_GET(self, request):
+        request.defaultContentType = b"application/json"
+        data = self.snapshot.read()
+        if data is None:
+            request.setResponseCode(503)
+            return "Treater is starting"
+        return data
+
+class ControlSocketEndpointFactory:
+    def __init__(self, reactor, path):
+        self.reactor = reactor
+        self.path = path
+
+    def endpointForURI(self, uri):
+        return UNIXClientEndpoint(self.reactor, self.path)
+
+class ForwardingResource(Resource):
+    """Relays a request to the owner process and copies its response back"""
+    isLeaf = True
+
+    def __init__(self, agent):
+        Resource.__init__(self)
+        self.agent = agent
+
+    def render(self, request):
+        headers = Headers()
+        for name in FORWARDED_REQUEST_HEADERS:
+            values = request.requestHeaders.getRawHeaders(name)
+            if values:
+                headers.setRawHeaders(name, values)
+        body = request.content.read() if request.content is not None else b""
+        producer = FileBodyProducer(StringIO(body)) if body else None
+        d = self.agent.request(request.method, b"http://owner" + request.uri, headers, producer)
+        client = {"connected": True}
+        def clientGone(failure):
+            client["connected"] = False
+            d.cancel()
+        request.notifyFinish().addErrback(clientGone)
+        d.addCallback(self.relayResponse, request, client)
+        d.addErrback(self.relayError, request, client)
+        return NOT_DONE_YET
+
+    def relayResponse(self, response, request, client):
+        request.setResponseCode(response.code)
+        for name in FORWARDED_RESPONSE_HEADERS:
+            values = response.headers.getRawHeaders(name)
+            if values:
+                request.responseHeaders.setRawHeaders(name, values)
+        d = readBody(response)
+        def write(body):
+            if client["connected"]:
+                request.write(body)
+                request.finish()
+        d.addCallback(write)
+        return d
+
+    def relayError(self, failure, request, client):
+        if not client["connected"]:
+            return
+        LOGGER.error("Error forwarding %s to treater owner process: %s" % (request.uri, failure.getErrorMessage()))
+        request.setResponseCode(502)
+        request.write("Treater is unavailable")
+        request.finish()
+
+def makeWorkerSite(reactor, config):
+    snapshot = StatusSnapshot(config.statusSnapshotFile)
+    pool = HTTPConnectionPool(reactor, persistent=True)
+    agent = Agent.usingEndpointFactory(reactor, ControlSocketEndpointFactory(reactor, config.controlSocket), pool=pool)
+    forward = ForwardingResource(agent)
+
+    class ApiRoot(Resource):
+        def getChild(self, name, request):
+            return forward
+
+    api = ApiRoot()
+    api.putChild("getStatus", SnapshotStatusResource(snapshot))
+    root = Resource()
+    root.putChild("api", api)
+    return Site(root)
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    from ConfigParser import SafeConfigParser
+    from logging.config import fileConfig
+    from twisted.python.log import PythonLoggingObserver
+    from website import TreatWebConfig
+
+    parser = ArgumentParser(description = "Treater API worker process (started by the treater service)")
+    parser.add_argument("-C")
+    parser.add_argument("--family", choices=("inet", "unix"), default="inet")
+    args = parser.parse_args()
+
+    config = SafeConfigParser()
+    config.read(args.C)
+    fileConfig(args.C)
+    PythonLoggingObserver().start()
+
+    site = makeWorkerSite(reactor, TreatWebConfig(config))
+    family = socket.AF_UNIX if args.family == "unix" else socket.AF_INET
+    reactor.adoptStreamPort(LISTEN_FD, family, site)
+    os.close(LISTEN_FD)
+    LOGGER.info("API worker %d serving" % os.getpid())
+    reactor.run()
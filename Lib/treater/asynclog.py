@@ -0,0 +1,245 @@
+#!/usr/bin/python
+
+# treater/asynclog.py
+
+"""Moves log file writes off the calling thread. The handlers configured in treater.cfg are wrapped behind a bounded
+queue that a background thread drains, writing records in batches with one flush per batch"""
+
+import atexit
+import os
+import threading
+import time
+from logging import Handler, StreamHandler, Formatter, getLogger, root, Logger, WARNING
+from logging.handlers import WatchedFileHandler
+from Queue import Queue, Empty, Full
+from metrics import REGISTRY
+
+DROP = "drop"
+BLOCK = "block"
+POLICIES = (DROP, BLOCK)
+
+RECORDS_DROPPED = REGISTRY.counter("treater_log_records_dropped_total", "Log records dropped because the log queue was full")
+
+STOP = object()
+
+class AsyncLogConfig:
+    SECTION_NAME = "main"
+
+    def __init__(self, config = None):
+        self.asyncLogging = True
+        self.logQueueSize = 1000
+        self.logQueuePolicy = DROP
+        self.logBatchSize = 50
+        self.logFlushSeconds = 0.5
+        if config:
+            self.load(config)
+
+    def load(self, config):
+        sec = AsyncLogConfig.SECTION_NAME
+        self.asyncLogging = config.getboolean(sec, "asyncLogging")
+        self.logQueueSize = config.getint(sec, "logQueueSize")
+        self.logQueuePolicy = config.get(sec, "logQueuePolicy")
+        self.logBatchSize = config.getint(sec, "logBatchSize")
+        self.logFlushSeconds = config.getfloat(sec, "logFlushSeconds")
+
+def reopenIfMoved(handler):
+    """WatchedFileHandler's check, done once per batch rather than once per record: reopen the file if logrotate
+    has moved or removed it"""
+    try:
+        stat = os.stat(handler.baseFilename)
+        changed = stat.st_dev != handler.dev or stat.st_ino != handler.ino
+    except OSError:
+        stat = None
+        changed = True
+    if not changed:
+        return
+    if handler.stream is not None:
+        handler.stream.flush()
+        handler.stream.close()
+    handler.stream = handler._open()
+    stat = os.fstat(handler.stream.fileno())
+    (handler.dev, handler.ino) = (stat.st_dev, stat.st_ino)
+
+class AsyncLogPipeline:
+    def __init__(self, config):
+        if config.logQueuePolicy not in POLICIES:
+            raise ValueError("Unknown log queue policy: %s" % config.logQueuePolicy)
+        self.config = config
+        self.queue = Queue(config.logQueueSize)
+        # Records are dropped on any logging thread; the count is only read by the writer thread
+        self.dropLock = threading.Lock()
+        self.reportedDropped = RECORDS_DROPPED.value
+        # Handlers of the last record written, which the drop warning goes to
+        self.warningHandlers = None
+        self.thread = threading.Thread(target=self.run, name="asynclog")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeoutSeconds = 5.0):
+        """Writes out everything queued so far. Called at exit, before the logging module closes the handlers"""
+        if self.thread.is_alive():
+            self.queue.put(STOP)
+            self.thread.join(timeoutSeconds)
+
+    def enqueue(self, handlers, record):
+        if self.config.logQueuePolicy == BLOCK:
+            self.queue.put((handlers, record))
+            return
+        try:
+            self.queue.put_nowait((handlers, record))
+        except Full:
+            with self.dropLock:
+                RECORDS_DROPPED.inc()
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            try:
+                item = self.queue.get()
+                deadline = time.time() + self.config.logFlushSeconds
+                while item is not STOP:
+                    batch.append(item)
+                    if len(batch) >= self.config.logBatchSize:
+                        break
+                    item = self.queue.get(True, max(0.0, deadline - time.time()))
+                stopping = item is STOP
+            except Empty:
+                pass
+            self.write(batch)
+        # Anything logged while stopping
+        batch = []
+        try:
+            while True:
+                item = self.queue.get_nowait()
+                if item is not STOP:
+                    batch.append(item)
+        except Empty:
+            pass
+        self.write(batch)
+
+    def write(self, batch):
+        if batch:
+            # The root logger's handlers in practice
+            self.warningHandlers = batch[0][0]
+        dropped = RECORDS_DROPPED.value
+        if dropped != self.reportedDropped and self.warningHandlers is not None:
+            message = "%d log records dropped because the log queue was full" % (dropped - self.reportedDropped)
+            record = getLogger("main").makeRecord("main", WARNING, __file__, 0, message, None, None)
+            batch.append((self.warningHandlers, record))
+            self.reportedDropped = dropped
+        touched = set()
+        for (handlers, record) in batch:
+            for handler in handlers:
+                if record.levelno < handler.level or not handler.filter(record):
+                    continue
+                if not isinstance(handler, StreamHandler):
+                    handler.handle(record)
+                    continue
+                handler.acquire()
+                try:
+                    if handler not in touched:
+                        touched.add(handler)
+                        if isinstance(handler, WatchedFileHandler):
+                            reopenIfMoved(handler)
+                    handler.stream.write(handler.format(record) + "\n")
+                except Exception:
+                    handler.handleError(record)
+                finally:
+                    handler.release()
+        for handler in touched:
+            handler.acquire()
+            try:
+                handler.stream.flush()
+            except Exception:
+                pass
+            finally:
+                handler.release()
+
+class AsyncHandler(Handler):
+    """Stands in for a logger's configured handlers, queueing records for them"""
+
+    def __init__(self, pipeline, handlers):
+        Handler.__init__(self)
+        self.pipeline = pipeline
+        self.handlers = tuple(handlers)
+
+    def emit(self, record):
+        # Format the message now, on the calling thread, since its arguments may change before the record is written
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = EXCEPTION_FORMATTER.formatException(record.exc_info)
+                record.exc_info = None
+        except Exception:
+            self.handleError(record)
+            return
+        self.pipeline.enqueue(self.handlers, record)
+
+EXCEPTION_FORMATTER = Formatter()
+
+def installAsyncLogging(config):
+    """Wraps the handlers of every configured logger. Returns the pipeline, or None when async logging is off"""
+    if not config.asyncLogging:
+        return None
+    pipeline = AsyncLogPipeline(config)
+    loggers = [root] + [logger for logger in Logger.manager.loggerDict.values() if isinstance(logger, Logger)]
+    for logger in loggers:
+        if logger.handlers:
+            handlers = list(logger.handlers)
+            for handler in handlers:
+                logger.removeHandler(handler)
+            logger.addHandler(AsyncHandler(pipeline, handlers))
+    pipeline.start()
+    return pipeline
+
+class SlowFlushStream:
+    """Makes each flush take as long as one to an SD card might, for the demo below"""
+
+    def __init__(self, stream, seconds):
+        self.stream = stream
+        self.seconds = seconds
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def flush(self):
+        self.stream.flush()
+        time.sleep(self.seconds)
+
+if __name__ == "__main__":
+    import logging
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), "asynclog.log")
+    handler = WatchedFileHandler(path)
+    handler.setFormatter(Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    handler.stream = SlowFlushStream(handler.stream, 0.002)
+    logger = getLogger("demo")
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    count = 2000
+
+    start = time.time()
+    for n in range(count):
+        logger.info("Synchronous record %d", n)
+    synchronous = time.time() - start
+
+    config = AsyncLogConfig()
+    config.logQueuePolicy = BLOCK
+    pipeline = installAsyncLogging(config)
+    start = time.time()
+    for n in range(count):
+        logger.info("Asynchronous record %d", n)
+        if n == count // 2:
+            os.rename(path, path + ".1")
+    asynchronous = time.time() - start
+    pipeline.stop()
+
+    lines = sum(1 for line in open(path)) + sum(1 for line in open(path + ".1"))
+    print("Calling thread: %.1f us per record synchronously, %.1f us with the queue" % (
+        synchronous / count * 1e6, asynchronous / count * 1e6))
+    print("%d of %d lines written across the rotated and reopened files" % (lines, count * 2))
@@ -0,0 +1,69 @@
+#!/usr/bin/python
+
+# treater/benchresults.py
+
+"""Saving benchmark results as JSON and comparing them against a stored baseline"""
+
+import json
+import math
+import platform
+import time
+
+# Metrics for which a smaller number is better. Anything else (throughput) is better when larger
+LOWER_IS_BETTER = ("p50", "p95", "p99", "max", "mean", "cpuPerFrame", "secondsPerOp")
+
+def percentile(sortedValues, fraction):
+    if not sortedValues:
+        return 0.0
+    index = int(math.ceil(fraction * len(sortedValues))) - 1
+    return sortedValues[min(max(index, 0), len(sortedValues) - 1)]
+
+def summarizeLatencies(latencies):
+    values = sorted(latencies)
+    if not values:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0, "mean": 0.0}
+    return {
+        "p50": percentile(values, 0.50),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99),
+        "max": values[-1],
+        "mean": sum(values) / len(values)}
+
+def saveResults(path, kind, results):
+    document = {
+        "kind": kind,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "results": results}
+    with open(path, "w") as f:
+        json.dump(document, f, indent=2, sort_keys=True)
+
+def loadResults(path):
+    with open(path, "r") as f:
+        return json.load(f)["results"]
+
+def compareResults(results, baseline, threshold, metrics):
+    """Returns a list of (benchmark, metric, baseline, current, change) for every metric that got worse by
+    more than threshold (a fraction, e.g. 0.2 for 20%)"""
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        for metric in metrics:
+            if metric not in results[name] or metric not in baseline[name]:
+                continue
+            old = float(baseline[name][metric])
+            new = float(results[name][metric])
+            if old == 0:
+                continue
+            change = (new - old) / old
+            if metric not in LOWER_IS_BETTER:
+                change = -change
+            if change > threshold:
+                regressions.append((name, metric, old, new, change))
+    return regressions
+
+def formatRegressions(regressions):
+    return "\n".join("REGRESSION %s %s: baseline %.6g, now %.6g (%+.1f%%)" % (name, metric, old, new, change * 100)
+                     for (name, metric, old, new, change) in regressions)
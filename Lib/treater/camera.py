@@ -14,12 +14,23 @@ from twisted.python.filepath import FilePath
 from twisted.python import failure
 from twisted.python.constants import NamedConstant, Names
 from logging import getLogger
+from metrics import REGISTRY
+from tracebuffer import TRACE
 from os import path, remove, rename, symlink, getcwd
 from glob import glob
 from datetime import datetime, timedelta
+import time
+import sys
 
 LOGGER = getLogger("camera")
 
+CAPTURE_DURATION = REGISTRY.histogram("treater_capture_photo_duration_seconds", "Round-trip time of capturePhoto requests")
+CAPTURE_TIMEOUTS = REGISTRY.counter("treater_capture_photo_timeouts_total", "Number of capturePhoto requests that timed out")
+TRIM_DURATION = REGISTRY.histogram("treater_capture_trim_duration_seconds", "Time spent trimming excess capture files")
+
+TRACE_NOTIFY = TRACE.defineEvent("camera", "notify", formatter = lambda a, b: "%s lastCapture=%d" % (humanReadableMask(a), b))
+TRACE_CAPTURE = TRACE.defineEvent("camera", "captureCreated", "waiting=%(a)d")
+
 class TreatCamConfig:
     SECTION_NAME = "camera"
 
@@ -28,6 +39,9 @@ class TreatCamConfig:
         self.captureDir = 'captures'
         self.motionControlPort = 8001
         self.motionStreamPort = 8002
+        self.dedupPolicy = "off"
+        self.dedupMaxDistance = 4
+        self.dedupRecentCaptures = 32
         if config:
             self.load(config)
 
@@ -37,6 +51,9 @@ class TreatCamConfig:
         self.captureDir = config.get(sec, "captureDir")
         self.motionControlPort = config.getint(sec, "motionControlPort")
         self.motionStreamPort = config.getint(sec, "motionStreamPort")
+        self.dedupPolicy = config.get(sec, "dedupPolicy")
+        self.dedupMaxDistance = config.getint(sec, "dedupMaxDistance")
+        self.dedupRecentCaptures = config.getint(sec, "dedupRecentCaptures")
                         
 class TreatCam:
     CAPTURE_GLOB = "capture-*.jpg"
@@ -49,6 +66,9 @@ class TreatCam:
         self.reactor = reactor
         self.agent = Agent(reactor)
         self.defers = []
+        from memory import MEMORY
+        MEMORY.register("pendingCaptures", lambda: (sum(sys.getsizeof(d.__dict__) for d in self.defers), len(self.defers)))
+        self.captureListeners = []
         self.snapshotActionUrl = "http://localhost:%d/0/action/snapshot" % self.config.motionControlPort
 
         self.capturePath = FilePath(config.captureDir)
@@ -56,6 +76,8 @@ class TreatCam:
         self.lastCaptureTime = None
         self.lastCaptureName = None
         self.findPreExistingLastCapture()
+        from dedup import createDeduplicator
+        self.deduplicator = createDeduplicator(reactor, config)
         
         self.notifier = INotify()
         self.notifier.startReading()
@@ -71,10 +93,15 @@ class TreatCam:
             httpRequestDefer = self.agent.request('GET', self.snapshotActionUrl)
             httpRequestDefer.addCallbacks(self.httpResponseCallback, self.httpResponseErrback)
         d = Deferred()
+        d.addBoth(self.observeCaptureDuration, time.time())
         self.addTimeout(d, 2)
         self.defers.append(d)
         return d
 
+    def observeCaptureDuration(self, result, start):
+        CAPTURE_DURATION.observe(time.time() - start)
+        return result
+
     def httpResponseCallback(self, ignored):
         LOGGER.debug("Received response from HTTP GET snapshot request to motion")
 
@@ -90,22 +117,54 @@ class TreatCam:
                 d.errback(Failure())
 
     def notifyCallback(self, ignored, filepath, mask):
-        LOGGER.debug("Notify event %s on %s" % (humanReadableMask(mask), filepath.basename()))
-        if mask & IN_CREATE and filepath == self.lastCaptureLink:
+        isLastCapture = filepath == self.lastCaptureLink
+        TRACE.record(TRACE_NOTIFY, mask, isLastCapture)
+        if mask & IN_CREATE and isLastCapture:
             capture = filepath.realpath().basename()
-            LOGGER.info("New capture detected: %s" % capture)
-            try:
-                self.lastCaptureTime = self.extractDateTimeFromCaptureName(capture)
-                self.lastCaptureName = capture
-            except ValueError:
-                self.errbackDefers(Failure())
-
-            if self.defers:
-                defers = self.defers
-                self.defers = []
-                for d in defers:
-                    if not d.called:
-                        d.callback(capture)
+            LOGGER.info("New capture detected: %s", capture)
+            if self.deduplicator is None:
+                self.captureCreated(capture)
+            else:
+                self.deduplicator.check(capture).addCallback(self.dedupChecked)
+
+    def dedupChecked(self, result):
+        (kept, match) = result
+        if kept is None:
+            # Dropped as a duplicate, so point the last capture link (which motion made) back at its match
+            temporaryLink = self.lastCaptureLink.siblingExtension(".dedup")
+            if temporaryLink.islink():
+                temporaryLink.remove()
+            symlink(match, temporaryLink.path)
+            rename(temporaryLink.path, self.lastCaptureLink.path)
+            kept = match
+        self.captureCreated(kept)
+
+    def captureCreated(self, capture):
+        TRACE.record(TRACE_CAPTURE, len(self.defers))
+        try:
+            self.lastCaptureTime = self.extractDateTimeFromCaptureName(capture)
+            self.lastCaptureName = capture
+        except ValueError:
+            self.errbackDefers(Failure())
+        else:
+            for listener in self.captureListeners:
+                listener.captureAdded(capture)
+
+        if self.defers:
+            defers = self.defers
+            self.defers = []
+            for d in defers:
+                if not d.called:
+                    d.callback(capture)
+
+    def dispenseStarted(self):
+        # Treat machine dispense listener. The motion daemon chooses its own frame rate, so there is nothing to do
+        pass
+
+    def addCaptureListener(self, listener):
+        """listener.captureAdded(name) is called for each new capture, and listener.capturesRemoved(names) when
+        captures are trimmed"""
+        self.captureListeners.append(listener)
 
     def getLastCaptureTime(self):
         return self.lastCaptureTime
@@ -114,7 +173,10 @@ class TreatCam:
         return self.lastCaptureName
 
     def addTimeout(self, d, duration):
-        timeout = reactor.callLater(duration, d.cancel)
+        def onTimeout():
+            CAPTURE_TIMEOUTS.inc()
+            d.cancel()
+        timeout = reactor.callLater(duration, onTimeout)
         def cancelTimeout(result):
             if timeout.active():
                 timeout.cancel()
@@ -139,12 +201,16 @@ class TreatCam:
                 pass
 
     def trimExcessCaptureFiles(self):
+        start = time.time()
         captures = sorted(self.capturePath.globChildren(TreatCam.CAPTURE_GLOB))
         excessCaptures = len(captures) - self.config.capturesToRetain
         if (excessCaptures > 0):
             for i in range(excessCaptures):
                 LOGGER.info("Trimming: %s" % captures[i].basename())
                 captures[i].remove()
+            for listener in self.captureListeners:
+                listener.capturesRemoved([c.basename() for c in captures[:excessCaptures]])
+        TRIM_DURATION.observe(time.time() - start)
 
 
 if __name__=="__main__":
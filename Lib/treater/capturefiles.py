@@ -0,0 +1,383 @@
+#!/usr/bin/python
+
+# treater/capturefiles.py
+
+"""Serves captured images straight from the capture directory with sendfile, for deployments without nginx. With
+segmented capture storage, each image is sent from its offset in the segment file that holds it"""
+
+import os
+import re
+import errno
+import time
+from collections import OrderedDict
+from logging import getLogger
+from twisted.internet.interfaces import IPushProducer, ISSLTransport
+from twisted.web import http
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+from zope.interface import implements
+from metrics import REGISTRY
+
+LOGGER = getLogger("webapi")
+
+BYTES_SENT = REGISTRY.counter("treater_capture_bytes_sent_total", "Bytes of capture images served by the web server",
+                              {"method": "sendfile"})
+BYTES_WRITTEN = REGISTRY.counter("treater_capture_bytes_sent_total", "Bytes of capture images served by the web server",
+                                 {"method": "write"})
+FD_CACHE_SIZE = REGISTRY.gauge("treater_capture_fd_cache_size", "Number of capture files held open for serving")
+
+def loadSendfile():
+    try:
+        from os import sendfile
+        return sendfile
+    except ImportError:
+        pass
+    # Python 2 has no os.sendfile, so call the libc function directly
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libcSendfile = libc.sendfile64
+    except (OSError, AttributeError):
+        return None
+    libcSendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    libcSendfile.restype = ctypes.c_ssize_t
+
+    def sendfile(outFd, inFd, offset, count):
+        off = ctypes.c_int64(offset)
+        sent = libcSendfile(outFd, inFd, ctypes.byref(off), count)
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return sent
+    return sendfile
+
+sendfile = loadSendfile()
+
+def parseRange(header, size):
+    """Parses a single byte range request. Returns (start, end) inclusive, None to serve the whole file,
+    or raises ValueError if the range can not be satisfied"""
+    if not header or not header.startswith("bytes="):
+        return None
+    spec = header[len("bytes="):].strip()
+    if "," in spec:
+        # Multipart ranges aren't worth supporting for single images; serving the whole file is allowed
+        return None
+    (first, sep, last) = spec.partition("-")
+    if not sep:
+        return None
+    try:
+        if not first:
+            suffix = int(last)
+            if suffix <= 0:
+                raise ValueError("Empty suffix range")
+            return (max(0, size - suffix), size - 1)
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        raise ValueError("Range %s not satisfiable for size %d" % (spec, size))
+    return (start, min(end, size - 1))
+
+class CachedFile:
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDONLY)
+        st = os.fstat(self.fd)
+        self.identity = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self.users = 0
+        self.evicted = False
+
+    def acquire(self):
+        self.users += 1
+        return self
+
+    def release(self):
+        self.users -= 1
+        if self.evicted and self.users == 0:
+            self.close()
+
+    def evict(self):
+        self.evicted = True
+        if self.users == 0:
+            self.close()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+class FileDescriptorCache:
+    """Least recently used cache of open capture files. Files removed by capture trimming are noticed on the
+    next lookup, and the number of open files never exceeds the capture retention count"""
+
+    def __init__(self, maxEntries):
+        self.maxEntries = max(1, maxEntries)
+        self.entries = OrderedDict()
+
+    def open(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.discard(path)
+            raise
+        entry = self.entries.pop(path, None)
+        if entry is not None and entry.identity != (st.st_dev, st.st_ino, st.st_size, st.st_mtime):
+            entry.evict()
+            entry = None
+        if entry is None:
+            entry = CachedFile(path)
+        self.entries[path] = entry
+        while len(self.entries) > self.maxEntries:
+            (ignored, oldest) = self.entries.popitem(last=False)
+            oldest.evict()
+        FD_CACHE_SIZE.set(len(self.entries))
+        return entry.acquire()
+
+    def discard(self, path):
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            entry.evict()
+        FD_CACHE_SIZE.set(len(self.entries))
+
+    def close(self):
+        for entry in self.entries.values():
+            entry.evict()
+        self.entries.clear()
+        FD_CACHE_SIZE.set(0)
+
+class SendfileProducer:
+    """Push producer that copies a range of a cached file to the request's socket with sendfile. Bytes queued in the
+    transport (the response headers) must reach the socket first, so the headers are written on their own and the
+    body waits for the transport to drain them and resume us; a full socket is waited out the same way. When the
+    transport is not a plain socket (e.g. TLS) the body is written through it in chunks instead"""
+    implements(IPushProducer)
+
+    CHUNK_SIZE = 2 ** 16
+
+    def __init__(self, request, entry, offset, length):
+        self.request = request
+        self.entry = entry
+        self.offset = offset
+        self.remaining = length
+        self.paused = False
+        self.stopped = False
+        transport = request.channel.transport if request.channel else None
+        self.socketFd = None
+        # producerPaused and startWriting are how a FileDescriptor transport tells its producer it has drained
+        if (sendfile is not None and transport is not None and not ISSLTransport.providedBy(transport)
+                and hasattr(transport, "getHandle") and hasattr(transport, "producerPaused")):
+            self.socketFd = transport.getHandle().fileno()
+        self.transport = transport
+
+    def start(self):
+        self.request.registerProducer(self, True)
+        if self.socketFd is None:
+            self.produce()
+            return
+        self.request.write(b"")
+        self.waitForTransport()
+
+    def waitForTransport(self):
+        """Pauses until the transport has written out everything it holds and the socket can take more. This is the
+        state the transport itself leaves us in when its buffer overflows, so it resumes us the same way"""
+        self.paused = True
+        self.transport.producerPaused = True
+        self.transport.startWriting()
+
+    def produce(self):
+        try:
+            while self.remaining > 0 and not self.paused and not self.stopped:
+                if self.socketFd is None:
+                    self.writeChunk()
+                    continue
+                try:
+                    sent = sendfile(self.socketFd, self.entry.fd, self.offset, self.remaining)
+                except OSError as e:
+                    if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        raise
+                    self.waitForTransport()
+                    return
+                if sent == 0:
+                    raise IOError("Capture file shrank while being served")
+                BYTES_SENT.inc(sent)
+                self.offset += sent
+                self.remaining -= sent
+        except (IOError, OSError):
+            LOGGER.exception("Error serving capture file")
+            self.finish(abort=True)
+            return
+        if self.remaining == 0:
+            self.finish()
+
+    def writeChunk(self):
+        os.lseek(self.entry.fd, self.offset, os.SEEK_SET)
+        data = os.read(self.entry.fd, min(self.remaining, self.CHUNK_SIZE))
+        if not data:
+            raise IOError("Capture file shrank while being served")
+        BYTES_WRITTEN.inc(len(data))
+        self.offset += len(data)
+        self.remaining -= len(data)
+        self.request.write(data)
+
+    def finish(self, abort = False):
+        if self.stopped:
+            return
+        self.stopped = True
+        self.entry.release()
+        self.request.unregisterProducer()
+        if abort:
+            self.transport.loseConnection()
+        else:
+            self.request.finish()
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.produce()
+
+    def stopProducing(self):
+        if not self.stopped:
+            self.stopped = True
+            self.entry.release()
+
+class CaptureFileResource(Resource):
+    isLeaf = True
+
+    CAPTURE_NAME = re.compile(r"^capture-\d{8}-\d{6}(-\d+)?\.jpg$")
+    MUTABLE_NAMES = ("lastsnap.jpg",)
+    # Timestamped captures never change once written, so clients may cache them for as long as they like
+    IMMUTABLE_CACHE_CONTROL = b"public, max-age=31536000, immutable"
+    MUTABLE_CACHE_CONTROL = b"no-cache"
+
+    def __init__(self, captureDir, capturesToRetain, store = None):
+        Resource.__init__(self)
+        self.captureDir = captureDir
+        self.store = store
+        # One extra slot covers the lastsnap link alongside the full set of retained captures
+        self.fdCache = FileDescriptorCache(capturesToRetain + 1)
+        from memory import MEMORY
+        MEMORY.register("captureFileCache", lambda: (0, len(self.fdCache.entries)), self.fdCache.close)
+
+    def isServable(self, name):
+        return name in self.MUTABLE_NAMES or self.CAPTURE_NAME.match(name) is not None
+
+    def openCapture(self, name):
+        """Returns (entry, offset, size, mtime) of the capture within its file, or raises IOError or OSError"""
+        if self.store is None:
+            entry = self.fdCache.open(os.path.join(self.captureDir, name))
+            return (entry, 0, entry.size, entry.mtime)
+        if name in self.MUTABLE_NAMES:
+            name = self.store.latest()
+        located = self.store.locate(name) if name else None
+        if located is None:
+            raise IOError(errno.ENOENT, "No such capture", name)
+        (segmentPath, offset, size, second) = located
+        return (self.fdCache.open(segmentPath), offset, size, second)
+
+    def render_GET(self, request):
+        if len(request.postpath) != 1 or not self.isServable(request.postpath[0]):
+            request.setResponseCode(http.NOT_FOUND)
+            return b"Capture not found"
+        name = request.postpath[0]
+        try:
+            (entry, start, size, mtime) = self.openCapture(name)
+        except (IOError, OSError):
+            request.setResponseCode(http.NOT_FOUND)
+            return b"Capture not found"
+
+        if name in self.MUTABLE_NAMES:
+            request.setHeader(b"Cache-Control", self.MUTABLE_CACHE_CONTROL)
+        else:
+            request.setHeader(b"Cache-Control", self.IMMUTABLE_CACHE_CONTROL)
+        request.setHeader(b"Content-Type", b"image/jpeg")
+        request.setHeader(b"Accept-Ranges", b"bytes")
+        if request.setLastModified(mtime) is http.CACHED:
+            entry.release()
+            return b""
+
+        try:
+            byteRange = parseRange(request.getHeader(b"Range"), size)
+        except ValueError:
+            entry.release()
+            request.setResponseCode(http.REQUESTED_RANGE_NOT_SATISFIABLE)
+            request.setHeader(b"Content-Range", b"bytes */%d" % size)
+            return b""
+        if byteRange is None:
+            (offset, length) = (0, size)
+        else:
+            (offset, length) = (byteRange[0], byteRange[1] - byteRange[0] + 1)
+            request.setResponseCode(http.PARTIAL_CONTENT)
+            request.setHeader(b"Content-Range", b"bytes %d-%d/%d" % (byteRange[0], byteRange[1], size))
+        request.setHeader(b"Content-Length", b"%d" % length)
+
+        if request.method == b"HEAD" or length == 0:
+            entry.release()
+            return b""
+        SendfileProducer(request, entry, start + offset, length).start()
+        return NOT_DONE_YET
+
+    render_HEAD = render_GET
+
+def checkSendfile():
+    """Serves a capture under 64 KB and a large one read slowly through a small receive buffer, and checks that both
+    arrive intact with every body byte sent by sendfile"""
+    import shutil
+    import socket
+    import tempfile
+    from twisted.internet import reactor
+    from twisted.internet.threads import deferToThread
+    from twisted.web.server import Site
+
+    directory = tempfile.mkdtemp()
+    captures = {"capture-20240101-120000.jpg": os.urandom(30 * 1024), "capture-20240101-120100.jpg": os.urandom(4 * 2 ** 20)}
+    for (name, data) in captures.items():
+        with open(os.path.join(directory, name), "wb") as f:
+            f.write(data)
+    resource = CaptureFileResource(directory, 10)
+    root = Resource()
+    root.putChild(b"captures", resource)
+    port = reactor.listenTCP(0, Site(root), interface="127.0.0.1")
+
+    def fetch(name, slowly):
+        s = socket.socket()
+        if slowly:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        s.connect(("127.0.0.1", port.getHost().port))
+        s.sendall(b"GET /captures/%s HTTP/1.0\r\n\r\n" % name)
+        response = []
+        while True:
+            data = s.recv(4096)
+            if not data:
+                break
+            response.append(data)
+            if slowly:
+                time.sleep(0.0005)
+        s.close()
+        return b"".join(response).partition(b"\r\n\r\n")[2]
+
+    def check():
+        ok = True
+        for (name, slowly) in (("capture-20240101-120000.jpg", False), ("capture-20240101-120100.jpg", True)):
+            (before, writtenBefore) = (BYTES_SENT.value, BYTES_WRITTEN.value)
+            body = fetch(name, slowly)
+            bySendfile = BYTES_SENT.value - before
+            written = BYTES_WRITTEN.value - writtenBefore
+            print("%s: %d bytes, intact %s, %d by sendfile, %d written through the transport" % (
+                name, len(body), body == captures[name], bySendfile, written))
+            ok = ok and body == captures[name] and bySendfile == len(body) and written == 0
+        print("PASS" if ok else "FAIL")
+
+    def done(ignored):
+        port.stopListening()
+        shutil.rmtree(directory)
+        reactor.stop()
+    reactor.callWhenRunning(lambda: deferToThread(check).addErrback(lambda f: f.printTraceback()).addBoth(done))
+    reactor.run()
+
+if __name__ == "__main__":
+    checkSendfile()
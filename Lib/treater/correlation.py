@@ -0,0 +1,285 @@
+#!/usr/bin/python
+
+# treater/correlation.py
+
+"""Links each treat dispense to the captures taken around it, using a time-sorted capture index that is kept up to
+date from camera and history events, and persisted as an append-only journal"""
+
+import os
+import re
+import sys
+import time
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime
+from glob import glob
+from logging import getLogger
+
+LOGGER = getLogger("camera")
+
+TREAT_ID_FORMAT = "%Y%m%d-%H%M%S"
+CAPTURE_NAME_PATTERN = re.compile(r"^capture-(\d{8}-\d{6})")
+
+# Journal records, one per line
+CAPTURE_ADDED = "C"
+CAPTURE_REMOVED = "R"
+TREAT_DISPENSED = "T"
+
+# The journal is rewritten once it holds this many times more records than there are live entries
+COMPACTION_RATIO = 2
+MIN_RECORDS_BEFORE_COMPACTION = 1000
+
+def toEpoch(dt):
+    return time.mktime(dt.timetuple())
+
+def captureTimeFromName(name):
+    """Capture names from both the motion daemon and raspicam start with capture-YYYYmmdd-HHMMSS"""
+    match = CAPTURE_NAME_PATTERN.match(name)
+    if match is None:
+        return None
+    try:
+        return datetime.strptime(match.group(1), TREAT_ID_FORMAT)
+    except ValueError:
+        return None
+
+def treatId(treatTime):
+    return treatTime.strftime(TREAT_ID_FORMAT)
+
+class CorrelationConfig:
+    SECTION_NAME = "correlation"
+
+    def __init__(self, config = None):
+        self.journalFile = ""
+        self.windowBeforeSeconds = 60
+        self.windowAfterSeconds = 60
+        self.rescanOnStart = False
+        if config:
+            self.load(config)
+
+    def load(self, config):
+        sec = CorrelationConfig.SECTION_NAME
+        self.journalFile = config.get(sec, "journalFile")
+        self.windowBeforeSeconds = config.getfloat(sec, "windowBeforeSeconds")
+        self.windowAfterSeconds = config.getfloat(sec, "windowAfterSeconds")
+        self.rescanOnStart = config.getboolean(sec, "rescanOnStart")
+
+class CorrelationIndex:
+    """Registered as a camera capture listener and a treat history listener"""
+
+    def __init__(self, config):
+        self.config = config
+        # (epoch seconds, name), kept sorted
+        self.captures = []
+        self.captureTimes = {}
+        # Treat id -> (epoch seconds, treat count)
+        self.treats = {}
+        self.treatIds = []
+        self.journal = None
+        self.journalRecords = 0
+        from memory import MEMORY
+        MEMORY.register("correlationIndex", self.memoryUsage)
+
+    def __str__(self):
+        return "CorrelationIndex"
+
+    def memoryUsage(self):
+        size = sum(sys.getsizeof(structure) for structure in (self.captures, self.captureTimes, self.treats, self.treatIds))
+        if self.captures:
+            (epoch, name) = self.captures[0]
+            size += len(self.captures) * (sys.getsizeof(self.captures[0]) + sys.getsizeof(epoch) + sys.getsizeof(name))
+        if self.treatIds:
+            # The id string, and the (epoch, count) tuple it maps to
+            size += len(self.treatIds) * (sys.getsizeof(self.treatIds[0]) + sys.getsizeof((0.0, 0)) + 2 * sys.getsizeof(0.0))
+        return (size, len(self.captures) + len(self.treatIds))
+
+    def open(self, history, captureDir, listCaptures = None, latestCapture = None):
+        """Replays the journal, which the capture listener calls keep up to date, and adds the camera's latest capture
+        if the journal does not hold it. Every capture is listed (with listCaptures, or by a scan of the capture
+        directory when that is None) only when there is no journal yet, to seed the index along with the treat
+        history, or when rescanOnStart asks for the journal to be repaired"""
+        path = self.config.journalFile
+        if listCaptures is None:
+            listCaptures = lambda: [os.path.basename(p) for p in glob(os.path.join(captureDir, "capture-*"))]
+        if path and os.path.isfile(path):
+            self.replay(path)
+            if self.config.rescanOnStart:
+                (added, removed) = self.reconcile(listCaptures())
+                LOGGER.info("Loaded correlation index of %d treats and %d captures; rescanning added %d captures and "
+                            "removed %d" % (len(self.treats), len(self.captures), added, removed))
+            else:
+                if latestCapture is not None and self.addCapture(latestCapture):
+                    LOGGER.info("Latest capture %s was taken while the correlation index was closed; any others "
+                                "are linked only after a restart with rescanOnStart" % latestCapture)
+                LOGGER.info("Loaded correlation index of %d treats and %d captures" % (len(self.treats), len(self.captures)))
+        else:
+            captureNames = listCaptures()
+            for event in history.treatEvents:
+                self.addTreat(toEpoch(event.treatTime), event.treatCount)
+            for name in captureNames:
+                self.addCapture(name)
+            LOGGER.info("Seeded correlation index with %d treats and %d captures" % (len(self.treats), len(self.captures)))
+        self.pruneTreats()
+        if path:
+            self.compact()
+
+    def reconcile(self, captureNames):
+        """Brings the captures in line with captureNames, after the motion daemon (or a change of capture storage)
+        changed them while the index was closed. Returns (added, removed)"""
+        present = set(captureNames)
+        gone = [name for name in self.captureTimes if name not in present]
+        for name in gone:
+            self.removeCapture(name)
+        added = sum(1 for name in present if self.addCapture(name))
+        return (added, len(gone))
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def replay(self, path):
+        with open(path, "r") as f:
+            for line in f:
+                fields = line.split()
+                # A record cut short by a crash is ignored
+                if not line.endswith("\n") or not fields:
+                    continue
+                try:
+                    if fields[0] == CAPTURE_ADDED and len(fields) == 2:
+                        self.addCapture(fields[1])
+                    elif fields[0] == CAPTURE_REMOVED and len(fields) == 2:
+                        self.removeCapture(fields[1])
+                    elif fields[0] == TREAT_DISPENSED and len(fields) == 3:
+                        self.addTreat(float(fields[1]), int(fields[2]))
+                except ValueError:
+                    LOGGER.warning("Ignoring malformed correlation journal record: %r" % line)
+                self.journalRecords += 1
+
+    def compact(self):
+        """Rewrites the journal with just the live entries, then reopens it for appending"""
+        self.close()
+        path = self.config.journalFile
+        temporaryPath = path + ".tmp"
+        with open(temporaryPath, "w") as f:
+            for (epoch, count) in (self.treats[tid] for tid in self.treatIds):
+                f.write("%s %r %d\n" % (TREAT_DISPENSED, epoch, count))
+            for (epoch, name) in self.captures:
+                f.write("%s %s\n" % (CAPTURE_ADDED, name))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temporaryPath, path)
+        self.journalRecords = len(self.treatIds) + len(self.captures)
+        # Line buffered, so each record reaches the file in a single write
+        self.journal = open(path, "a", 1)
+
+    def appendRecord(self, record):
+        if self.journal is None:
+            return
+        try:
+            self.journal.write(record)
+        except IOError:
+            LOGGER.exception("Unable to append to correlation journal")
+            return
+        self.journalRecords += 1
+        live = len(self.treatIds) + len(self.captures)
+        if self.journalRecords > max(MIN_RECORDS_BEFORE_COMPACTION, COMPACTION_RATIO * live):
+            self.compact()
+
+    def addCapture(self, name):
+        captureTime = captureTimeFromName(name)
+        if captureTime is None or name in self.captureTimes:
+            return False
+        epoch = toEpoch(captureTime)
+        self.captureTimes[name] = epoch
+        # Captures almost always arrive in time order, making this an append
+        insort(self.captures, (epoch, name))
+        return True
+
+    def removeCapture(self, name):
+        epoch = self.captureTimes.pop(name, None)
+        if epoch is None:
+            return False
+        i = bisect_left(self.captures, (epoch, name))
+        if i < len(self.captures) and self.captures[i] == (epoch, name):
+            del self.captures[i]
+        return True
+
+    def addTreat(self, epoch, treatCount):
+        tid = treatId(datetime.fromtimestamp(epoch))
+        if tid not in self.treats:
+            insort(self.treatIds, tid)
+        self.treats[tid] = (epoch, treatCount)
+        return tid
+
+    def captureAdded(self, name):
+        if self.addCapture(name):
+            self.appendRecord("%s %s\n" % (CAPTURE_ADDED, name))
+
+    def capturesRemoved(self, names):
+        for name in names:
+            if self.removeCapture(name):
+                self.appendRecord("%s %s\n" % (CAPTURE_REMOVED, name))
+        self.pruneTreats()
+
+    def pruneTreats(self):
+        """Drops treats whose window ends before the oldest capture, as they can no longer be linked to anything.
+        Nothing is journaled: the same cutoff is applied again after a replay, and compaction leaves them out"""
+        if self.captures:
+            cutoff = self.captures[0][0] - self.config.windowAfterSeconds
+            while self.treatIds and self.treats[self.treatIds[0]][0] < cutoff:
+                del self.treats[self.treatIds.pop(0)]
+
+    def treatDispensed(self, event):
+        epoch = toEpoch(event.treatTime)
+        self.addTreat(epoch, event.treatCount)
+        self.appendRecord("%s %r %d\n" % (TREAT_DISPENSED, epoch, event.treatCount))
+
+    def getTreatIds(self):
+        return list(self.treatIds)
+
+    def getTreat(self, tid):
+        """(treat time, treat count), or None. The id "latest" names the most recent treat"""
+        if tid == "latest" and self.treatIds:
+            tid = self.treatIds[-1]
+        if tid not in self.treats:
+            return None
+        (epoch, treatCount) = self.treats[tid]
+        return (tid, datetime.fromtimestamp(epoch), treatCount)
+
+    def capturesForTreat(self, tid):
+        """(name, capture time) for each capture within the window around the treat, in time order"""
+        treat = self.getTreat(tid)
+        if treat is None:
+            return None
+        epoch = toEpoch(treat[1])
+        first = bisect_left(self.captures, (epoch - self.config.windowBeforeSeconds,))
+        last = bisect_right(self.captures, (epoch + self.config.windowAfterSeconds, "\xff"))
+        return [(name, datetime.fromtimestamp(captureEpoch)) for (captureEpoch, name) in self.captures[first:last]]
+
+if __name__ == "__main__":
+    from history import TreatEvent, TreatHistory
+    from tempfile import mkdtemp
+    from datetime import timedelta
+
+    directory = mkdtemp()
+    config = CorrelationConfig()
+    config.journalFile = os.path.join(directory, "correlation.journal")
+    index = CorrelationIndex(config)
+    index.open(TreatHistory(), directory)
+    now = datetime.now().replace(microsecond=0)
+    for seconds in range(-600, 600, 20):
+        index.captureAdded("capture-%s-01.jpg" % (now + timedelta(seconds=seconds)).strftime(TREAT_ID_FORMAT))
+    index.treatDispensed(TreatEvent(now, 3))
+    index.close()
+
+    # A capture taken while the index was closed is picked up on open when it is the camera's latest
+    latest = "capture-%s-01.jpg" % (now + timedelta(seconds=5)).strftime(TREAT_ID_FORMAT)
+    reopened = CorrelationIndex(config)
+    reopened.open(TreatHistory(), directory, latestCapture=latest)
+    reopened.close()
+    # Captures trimmed while it was closed are dropped only by a rescan
+    names = sorted(name for (epoch, name) in reopened.captures)
+    config.rescanOnStart = True
+    repaired = CorrelationIndex(config)
+    repaired.open(TreatHistory(), directory, lambda: names[len(names) // 2:])
+    for (name, captureTime) in repaired.capturesForTreat("latest"):
+        print("%s %s" % (name, captureTime))
@@ -0,0 +1,202 @@
+#!/usr/bin/python
+
+# treater/cutoff.py
+
+"""Decides when to cut dispenser power during a dispense cycle. In predictive mode it learns the feeder's treat rate
+and how long treats keep coming after power is cut, and cuts early enough to land on the target count"""
+
+import json
+import math
+import os
+from logging import getLogger
+from metrics import REGISTRY
+
+LOGGER = getLogger("machine")
+
+COUNT = "count"
+PREDICTIVE = "predictive"
+MODES = (COUNT, PREDICTIVE)
+
+# Cycles that must be observed before predictions are trusted over counting
+MIN_CYCLES = 3
+
+CYCLES = dict((mode, REGISTRY.counter("treater_cutoff_cycles_total", "Dispense cycles completed, by cutoff mode", {"mode": mode}))
+              for mode in MODES)
+OVERSHOOT = REGISTRY.counter("treater_cutoff_overshoot_treats_total", "Treats dispensed beyond the per-cycle target")
+UNDERSHOOT = REGISTRY.counter("treater_cutoff_undershoot_treats_total", "Treats short of the per-cycle target")
+PREDICTION_ERROR = REGISTRY.gauge("treater_cutoff_prediction_error_treats", "Actual minus predicted treat count for the last cycle")
+ABSOLUTE_ERROR = REGISTRY.histogram("treater_cutoff_absolute_error_treats", "Absolute per-cycle treat count prediction error",
+                                    (0.25, 0.5, 1, 1.5, 2, 3, 5))
+TREAT_RATE = REGISTRY.gauge("treater_cutoff_treats_per_second", "Learned rate at which the powered dispenser delivers treats")
+LATENCY = REGISTRY.gauge("treater_cutoff_latency_seconds", "Learned time that treats keep arriving for after power is cut")
+
+class CutoffModel:
+    def __init__(self, treatsPerSecond = None, latencySeconds = 0.0, cycles = 0):
+        self.treatsPerSecond = treatsPerSecond
+        self.latencySeconds = latencySeconds
+        self.cycles = cycles
+
+    def __str__(self):
+        return "CutoffModel"
+
+    def isReady(self):
+        return self.treatsPerSecond is not None and self.cycles >= MIN_CYCLES
+
+    def expectedTreatsAfterCutoff(self):
+        if self.treatsPerSecond is None:
+            return 0.0
+        return self.treatsPerSecond * self.latencySeconds
+
+    def learn(self, powerOnTime, powerOffTime, pulseTimes, learningRate):
+        """Updates the model from one cycle's pulse times. The latency is the effective one: treats seen after
+        power-off divided by the rate, which folds in detector and polling delays"""
+        powered = [t for t in pulseTimes if t <= powerOffTime]
+        afterCutoff = len(pulseTimes) - len(powered)
+        if len(powered) >= 2 and powered[-1] > powered[0]:
+            rate = (len(powered) - 1) / (powered[-1] - powered[0])
+            self.treatsPerSecond = rate if self.treatsPerSecond is None else \
+                self.treatsPerSecond + learningRate * (rate - self.treatsPerSecond)
+        if self.treatsPerSecond:
+            latency = afterCutoff / self.treatsPerSecond
+            self.latencySeconds = latency if self.cycles == 0 else \
+                self.latencySeconds + learningRate * (latency - self.latencySeconds)
+        self.cycles += 1
+        TREAT_RATE.set(self.treatsPerSecond or 0.0)
+        LATENCY.set(self.latencySeconds)
+
+    def toJson(self):
+        return json.dumps({"treatsPerSecond": self.treatsPerSecond, "latencySeconds": self.latencySeconds,
+                           "cycles": self.cycles})
+
+    @staticmethod
+    def load(path):
+        if path and os.path.isfile(path):
+            try:
+                with open(path, "r") as f:
+                    data = json.load(f)
+                model = CutoffModel(data["treatsPerSecond"], data["latencySeconds"], data["cycles"])
+                TREAT_RATE.set(model.treatsPerSecond or 0.0)
+                LATENCY.set(model.latencySeconds)
+                return model
+            except (IOError, ValueError, KeyError):
+                LOGGER.exception("Unable to load dispenser cutoff model from %s; starting afresh" % path)
+        return CutoffModel()
+
+    def save(self, path):
+        temporaryPath = path + ".tmp"
+        try:
+            with open(temporaryPath, "w") as f:
+                f.write(self.toJson())
+            os.rename(temporaryPath, path)
+        except (IOError, OSError):
+            LOGGER.error("Unable to save dispenser cutoff model to: %s" % path)
+
+class DispenserCutoff:
+    """Driven by DispensingState: startCycle, treatDetected for each pulse (True once power should be cut), poweredOff
+    when power is cut for any reason, and endCycle with the final count"""
+
+    def __init__(self, config):
+        if config.cutoffMode not in MODES:
+            raise ValueError("Unknown dispenser cutoff mode: %s" % config.cutoffMode)
+        self.mode = config.cutoffMode
+        self.target = config.maxTreatsPerCycle
+        self.learningRate = config.cutoffLearningRate
+        self.modelFile = config.cutoffModelFile
+        self.model = CutoffModel.load(self.modelFile)
+        self.startCycle(0)
+
+    def __str__(self):
+        return "DispenserCutoff"
+
+    def startCycle(self, now):
+        self.powerOnTime = now
+        self.powerOffTime = None
+        self.pulseTimes = []
+        self.predictedCount = None
+        self.targetReached = False
+
+    def treatDetected(self, now, count):
+        self.pulseTimes.append(now)
+        if not self.target or self.targetReached:
+            return self.targetReached
+        self.targetReached = count >= self.cutoffCount()
+        return self.targetReached
+
+    def cutoffCount(self):
+        """The treat count at which power should be cut this cycle, or None with no target"""
+        if not self.target:
+            return None
+        if self.mode == PREDICTIVE and self.model.isReady():
+            # Cut once the treats still expected after power-off would take the count nearest to the target
+            return max(1, int(math.ceil(self.target - 0.5 - self.model.expectedTreatsAfterCutoff())))
+        return self.target
+
+    def poweredOff(self, now):
+        if self.powerOffTime is None:
+            self.powerOffTime = now
+            self.predictedCount = len(self.pulseTimes) + self.model.expectedTreatsAfterCutoff()
+
+    def endCycle(self, count):
+        if self.powerOffTime is None:
+            return
+        CYCLES[self.mode].inc()
+        error = count - self.predictedCount
+        PREDICTION_ERROR.set(error)
+        ABSOLUTE_ERROR.observe(abs(error))
+        if self.target:
+            if count > self.target:
+                OVERSHOOT.inc(count - self.target)
+            elif count < self.target:
+                UNDERSHOOT.inc(self.target - count)
+        LOGGER.info("Dispense cycle: %d treats (target %s), predicted %.1f, error %+.1f" % (
+            count, self.target or "none", self.predictedCount, error))
+        self.model.learn(self.powerOnTime, self.powerOffTime, self.pulseTimes, self.learningRate)
+        if self.modelFile:
+            self.model.save(self.modelFile)
+
+def simulate(cycles, target, mode, treatsPerSecond, coastSeconds):
+    """Runs dispense cycles on stand-in hardware with a simulated dispenser, and returns the final treat counts"""
+    from twisted.internet import reactor
+    from standins import StandInTreatMachine, standInMachineConfig, SimulatedDispenser
+
+    config = standInMachineConfig()
+    config.maxTreatsPerCycle = target
+    config.treatEnabledSeconds = 3
+    config.cutoffMode = mode
+    config.cutoffModelFile = ""
+    machine = StandInTreatMachine(reactor, config)
+    SimulatedDispenser(reactor, machine.gpio, config.gpioTreatDetector, config.gpioTreatPower, treatsPerSecond, coastSeconds)
+    counts = []
+
+    def dispense():
+        machine.dispenseTreat().addCallback(completed)
+
+    def completed(result):
+        counts.append(result.treatCount)
+        if len(counts) < cycles:
+            reactor.callLater(config.treatRecoverySeconds + 0.1, dispense)
+        else:
+            reactor.stop()
+
+    machine.start()
+    reactor.callLater(0.1, dispense)
+    reactor.run()
+    return counts
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description = "Compare dispenser cutoff modes on a simulated dispenser")
+    parser.add_argument("--mode", choices=MODES, default=PREDICTIVE)
+    parser.add_argument("--cycles", type=int, default=12)
+    parser.add_argument("--target", type=int, default=3)
+    parser.add_argument("--treats-per-second", type=float, default=4.0)
+    parser.add_argument("--coast-seconds", type=float, default=0.3, help="how long treats keep falling after power-off")
+    args = parser.parse_args()
+
+    counts = simulate(args.cycles, args.target, args.mode, args.treats_per_second, args.coast_seconds)
+    print("%s mode, target %d: counts %s" % (args.mode, args.target, counts))
+    settled = counts[MIN_CYCLES:]
+    if settled:
+        print("After %d learning cycles: mean absolute miss %.2f treats" % (
+            MIN_CYCLES, sum(abs(c - args.target) for c in settled) / float(len(settled))))
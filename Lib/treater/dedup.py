@@ -0,0 +1,144 @@
+#!/usr/bin/python
+
+# treater/dedup.py
+
+"""Drops or hard-links new captures that are near-identical to a recent one, using a 64-bit difference hash. Dropping
+is what stretches capture retention: a hard-linked duplicate frees its disk space but keeps its name, so it still
+counts against capturesToRetain"""
+
+import os
+import time
+from collections import deque
+from logging import getLogger
+from twisted.internet import threads
+from metrics import REGISTRY
+
+LOGGER = getLogger("camera")
+
+DROP = "drop"
+LINK = "link"
+OFF = "off"
+POLICIES = (OFF, DROP, LINK)
+
+CHECKED = REGISTRY.counter("treater_dedup_checked_total", "New captures checked for near-duplicates")
+DUPLICATES = dict((policy, REGISTRY.counter("treater_dedup_duplicates_total", "New captures found to be near-duplicates",
+                                            {"policy": policy})) for policy in (DROP, LINK))
+BYTES_SAVED = REGISTRY.counter("treater_dedup_bytes_saved_total", "Disk bytes freed by dropping or linking duplicates")
+HASH_DURATION = REGISTRY.histogram("treater_dedup_hash_duration_seconds", "Time spent decoding and hashing a capture in the worker")
+
+HASH_SIZE = 8
+
+def differenceHash(path):
+    """64-bit dHash: each bit says whether a pixel is brighter than its right-hand neighbour in a 9x8 greyscale
+    thumbnail. Runs in a worker thread"""
+    from PIL import Image
+    image = Image.open(path)
+    # Lets the JPEG decoder scale down by up to 8x while decoding, which is most of the cost saved
+    image.draft("L", (HASH_SIZE * 8, HASH_SIZE * 8))
+    pixels = list(image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR).getdata())
+    value = 0
+    for row in range(HASH_SIZE):
+        for column in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + column]
+            value = (value << 1) | (left > pixels[row * (HASH_SIZE + 1) + column + 1])
+    return value
+
+def hashCapture(path):
+    start = time.time()
+    value = differenceHash(path)
+    return (value, time.time() - start)
+
+def freedBytes(path):
+    """Disk space released by removing or replacing path: nothing if another link still holds its data"""
+    st = os.stat(path)
+    return st.st_blocks * 512 if st.st_nlink == 1 else 0
+
+def hammingDistance(a, b):
+    return bin(a ^ b).count("1")
+
+class Deduplicator:
+    """check(name) returns a Deferred that fires with (keptName, matchName):
+        (name, None)   the capture is not a duplicate
+        (name, match)  it duplicated match and is now a hard link to it
+        (None, match)  it duplicated match and was deleted
+    It never errbacks; a capture that cannot be hashed is kept"""
+
+    def __init__(self, reactor, captureDir, policy, maxDistance, recentCaptures):
+        if policy not in POLICIES:
+            raise ValueError("Unknown capture dedup policy: %s" % policy)
+        self.reactor = reactor
+        self.captureDir = captureDir
+        self.policy = policy
+        self.maxDistance = maxDistance
+        # (hash, name) of the most recent unique captures, newest last
+        self.recent = deque(maxlen=recentCaptures)
+
+    def __str__(self):
+        return "Deduplicator"
+
+    def check(self, name):
+        path = os.path.join(self.captureDir, name)
+        d = threads.deferToThreadPool(self.reactor, self.reactor.getThreadPool(), hashCapture, path)
+        d.addCallbacks(self.hashed, self.hashFailed, callbackArgs=(name,), errbackArgs=(name,))
+        return d
+
+    def hashFailed(self, failure, name):
+        LOGGER.error("Unable to hash capture %s: %s" % (name, failure.getErrorMessage()))
+        return (name, None)
+
+    def hashed(self, result, name):
+        (value, seconds) = result
+        CHECKED.inc()
+        HASH_DURATION.observe(seconds)
+        match = self.findMatch(value)
+        if match is None or self.policy == OFF:
+            self.recent.append((value, name))
+            return (name, None)
+        try:
+            freed = freedBytes(os.path.join(self.captureDir, name))
+            if self.policy == DROP:
+                os.remove(os.path.join(self.captureDir, name))
+                result = (None, match)
+            else:
+                self.linkTo(name, match)
+                result = (name, match)
+        except OSError as e:
+            LOGGER.error("Unable to deduplicate capture %s against %s: %s" % (name, match, e))
+            self.recent.append((value, name))
+            return (name, None)
+        LOGGER.info("Capture %s duplicates %s; %s" % (name, match, "dropped" if self.policy == DROP else "linked"))
+        DUPLICATES[self.policy].inc()
+        BYTES_SAVED.inc(freed)
+        return result
+
+    def findMatch(self, value):
+        """The most recent capture within maxDistance that is still on disk"""
+        for (recentValue, recentName) in reversed(self.recent):
+            if hammingDistance(value, recentValue) <= self.maxDistance:
+                if os.path.exists(os.path.join(self.captureDir, recentName)):
+                    return recentName
+        return None
+
+    def linkTo(self, name, match):
+        # Link under a temporary name and rename over the capture, so that the name never goes missing
+        path = os.path.join(self.captureDir, name)
+        temporaryPath = path + ".dedup"
+        if os.path.exists(temporaryPath):
+            os.remove(temporaryPath)
+        os.link(os.path.join(self.captureDir, match), temporaryPath)
+        os.rename(temporaryPath, path)
+
+def createDeduplicator(reactor, config):
+    """Returns None when dedup is off, so that PIL is only imported when it is needed"""
+    if config.dedupPolicy == OFF:
+        return None
+    return Deduplicator(reactor, config.captureDir, config.dedupPolicy, config.dedupMaxDistance, config.dedupRecentCaptures)
+
+if __name__ == "__main__":
+    import sys
+    paths = sys.argv[1:]
+    hashes = [(differenceHash(p), p) for p in paths]
+    for (value, p) in hashes:
+        print("%016x %s" % (value, p))
+    for i in range(1, len(hashes)):
+        print("%s -> %s: distance %d" % (hashes[i - 1][1], hashes[i][1], hammingDistance(hashes[i - 1][0], hashes[i][0])))
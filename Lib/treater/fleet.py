@@ -0,0 +1,299 @@
+#!/usr/bin/python
+
+# treater/fleet.py
+
+"""Fleet aggregator: polls the status of many treater nodes over pooled connections and serves them as one
+document, so that a dashboard needs only one poll"""
+
+import hashlib
+import json
+import random
+import time
+from logging import getLogger
+from twisted.internet import reactor
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+from metrics import REGISTRY, CONTENT_TYPE as METRICS_CONTENT_TYPE
+
+LOGGER = getLogger("webapi")
+
+POLL_DURATION = REGISTRY.histogram("treater_fleet_poll_duration_seconds", "Time taken to fetch getStatus from a fleet node")
+
+class FleetConfig:
+    SECTION_NAME = "fleet"
+
+    def __init__(self, config = None):
+        self.nodes = []
+        self.pollIntervalSeconds = 2.0
+        self.timeoutSeconds = 2.0
+        self.maxBackoffSeconds = 60.0
+        self.connectionsPerNode = 2
+        if config:
+            self.load(config)
+
+    def load(self, config):
+        sec = FleetConfig.SECTION_NAME
+        self.nodes = parseNodes(config.get(sec, "nodes"))
+        self.pollIntervalSeconds = config.getfloat(sec, "pollIntervalSeconds")
+        self.timeoutSeconds = config.getfloat(sec, "timeoutSeconds")
+        self.maxBackoffSeconds = config.getfloat(sec, "maxBackoffSeconds")
+        self.connectionsPerNode = config.getint(sec, "connectionsPerNode")
+
+def parseNodes(text):
+    """Nodes are whitespace or comma separated, each either name=url or just a url (which is then the name)"""
+    nodes = []
+    for item in text.replace(",", " ").split():
+        (name, sep, url) = item.partition("=")
+        if not sep:
+            url = name
+        nodes.append((name, url.rstrip("/")))
+    return nodes
+
+class FleetNode:
+    def __init__(self, name, url):
+        self.name = name
+        self.url = url
+        self.status = None
+        self.reachable = False
+        self.error = "Not polled yet"
+        self.lastChanged = None
+        self.consecutiveFailures = 0
+        self.up = REGISTRY.gauge("treater_fleet_node_up", "1 if the last poll of a fleet node succeeded", {"node": name})
+
+    def describe(self):
+        # Only things that change when the node's status does, so that the ETag is stable between changes
+        return {
+            "name" : self.name,
+            "url" : self.url,
+            "reachable" : self.reachable,
+            "error" : self.error,
+            "lastChanged" : self.lastChanged,
+            "status" : self.status}
+
+class FleetAggregator:
+    def __init__(self, reactor, config):
+        self.reactor = reactor
+        self.config = config
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = config.connectionsPerNode
+        self.agent = Agent(reactor, connectTimeout=config.timeoutSeconds, pool=self.pool)
+        self.nodes = [FleetNode(name, url) for (name, url) in config.nodes]
+        self.calls = {}
+        self.running = False
+        self.document = None
+        self.etag = None
+        self.rebuild()
+
+    def __str__(self):
+        return "FleetAggregator"
+
+    def start(self):
+        LOGGER.info("Aggregating status from %d treater nodes" % len(self.nodes))
+        self.running = True
+        for node in self.nodes:
+            # Spread the first polls out so that the nodes are not all polled in lock step
+            self.schedule(node, random.uniform(0, self.config.pollIntervalSeconds))
+
+    def stop(self):
+        self.running = False
+        for call in self.calls.values():
+            if call.active():
+                call.cancel()
+        self.calls.clear()
+        return self.pool.closeCachedConnections()
+
+    def schedule(self, node, delay):
+        if self.running:
+            self.calls[node.name] = self.reactor.callLater(delay, self.poll, node)
+
+    def poll(self, node):
+        start = time.time()
+        d = self.agent.request(b"GET", node.url + b"/api/getStatus")
+        d.addTimeout(self.config.timeoutSeconds, self.reactor)
+        def gotResponse(response):
+            if response.code != 200:
+                response.deliverBody(DiscardBody())
+                raise ValueError("HTTP %d" % response.code)
+            return readBody(response)
+        d.addCallback(gotResponse)
+        d.addCallback(json.loads)
+        d.addCallbacks(self.pollSucceeded, self.pollFailed, callbackArgs=(node, start), errbackArgs=(node,))
+        d.addErrback(lambda failure: LOGGER.error("Error handling fleet poll of %s: %s" % (node.name, failure.getErrorMessage())))
+        return d
+
+    def pollSucceeded(self, status, node, start):
+        POLL_DURATION.observe(time.time() - start)
+        node.consecutiveFailures = 0
+        node.up.set(1)
+        if status != node.status or not node.reachable:
+            if not node.reachable:
+                LOGGER.info("Fleet node %s is reachable" % node.name)
+            node.status = status
+            node.reachable = True
+            node.error = None
+            node.lastChanged = time.strftime("%Y-%m-%dT%H:%M:%S")
+            self.rebuild()
+        self.schedule(node, self.config.pollIntervalSeconds)
+
+    def pollFailed(self, failure, node):
+        node.consecutiveFailures += 1
+        node.up.set(0)
+        error = failure.getErrorMessage() or failure.type.__name__
+        if node.reachable or node.error != error:
+            LOGGER.warning("Fleet node %s poll failed: %s" % (node.name, error))
+            # The last known status is kept, marked unreachable
+            node.reachable = False
+            node.error = error
+            node.lastChanged = time.strftime("%Y-%m-%dT%H:%M:%S")
+            self.rebuild()
+        self.schedule(node, self.backoffSeconds(node))
+
+    def backoffSeconds(self, node):
+        """Exponential backoff with jitter, so that a down node is not hammered and recovering nodes are not
+        polled in step"""
+        delay = min(self.config.pollIntervalSeconds * 2 ** min(node.consecutiveFailures, 16), self.config.maxBackoffSeconds)
+        return delay * random.uniform(0.5, 1.0)
+
+    def rebuild(self):
+        """Serializes the combined document once per change rather than once per request"""
+        self.document = json.dumps({"nodes" : [node.describe() for node in self.nodes]}, sort_keys=True)
+        self.etag = '"%s"' % hashlib.sha1(self.document).hexdigest()[:16]
+
+class DiscardBody:
+    def dataReceived(self, data):
+        pass
+
+    def connectionLost(self, reason):
+        pass
+
+    def makeConnection(self, transport):
+        pass
+
+class FleetStatusResource(Resource):
+    isLeaf = True
+
+    def __init__(self, aggregator):
+        Resource.__init__(self)
+        self.aggregator = aggregator
+
+    def render_GET(self, request):
+        request.setHeader(b"ETag", self.aggregator.etag)
+        request.setHeader(b"Cache-Control", b"no-cache")
+        if request.setETag(self.aggregator.etag):
+            # setETag has already set 304 Not Modified
+            return b""
+        request.defaultContentType = b"application/json"
+        return self.aggregator.document
+
+class FleetMetricsResource(Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader(b"Content-Type", METRICS_CONTENT_TYPE)
+        return REGISTRY.render()
+
+def makeFleetSite(aggregator):
+    fleet = Resource()
+    fleet.putChild("status", FleetStatusResource(aggregator))
+    api = Resource()
+    api.putChild("fleet", fleet)
+    api.putChild("metrics", FleetMetricsResource())
+    root = Resource()
+    root.putChild("api", api)
+    return Site(root)
+
+def startFleetAggregator(reactor, config, port):
+    aggregator = FleetAggregator(reactor, config)
+    reactor.listenTCP(port, makeFleetSite(aggregator))
+    aggregator.start()
+    reactor.addSystemEventTrigger('before', 'shutdown', aggregator.stop)
+    return aggregator
+
+def checkAgainstStandIns(reactor, count, basePort, port):
+    """Starts count stand-in treaters on loopback ports and an aggregator over them, dispenses a treat on each, checks
+    the combined document and that polls a few seconds apart are answered 304 Not Modified, then stops one node and
+    checks that it is reported unreachable"""
+    from twisted.internet.defer import inlineCallbacks
+    from twisted.web.http_headers import Headers
+    from loadtest import spawnStandInServer, waitUntilServing
+
+    servers = [spawnStandInServer(reactor, basePort + i, 0.25) for i in range(count)]
+    config = FleetConfig()
+    config.nodes = [("standin%d" % i, "http://127.0.0.1:%d" % (basePort + i)) for i in range(count)]
+    config.pollIntervalSeconds = 0.5
+    config.timeoutSeconds = 1.0
+    config.maxBackoffSeconds = 2.0
+    client = Agent(reactor)
+    fleetUrl = "http://127.0.0.1:%d/api/fleet/status" % port
+    outcome = {"passed": False}
+
+    def fetch(etag = None):
+        headers = Headers({"If-None-Match": [etag]}) if etag else None
+        d = client.request(b"GET", fleetUrl, headers)
+        def body(response):
+            return readBody(response).addCallback(lambda data: (response.code, response.headers.getRawHeaders("ETag", [None])[0], data))
+        return d.addCallback(body)
+
+    def sleep(seconds):
+        from twisted.internet.task import deferLater
+        return deferLater(reactor, seconds, lambda: None)
+
+    @inlineCallbacks
+    def run():
+        try:
+            for i in range(count):
+                yield waitUntilServing(reactor, client, "http://127.0.0.1:%d" % (basePort + i), 15)
+                # A last treat on every node, so that its timeSinceLastTreat is counting
+                response = yield client.request(b"POST", "http://127.0.0.1:%d/api/dispenseTreat?wait=1" % (basePort + i))
+                yield readBody(response)
+            aggregator = startFleetAggregator(reactor, config, port)
+            # Long enough for the nodes to come back to Idle after their dispense cycles
+            yield sleep(3.5)
+            (code, etag, data) = yield fetch()
+            reachable = [node["reachable"] for node in json.loads(data)["nodes"]]
+            print("GET: %d, %d of %d nodes reachable, ETag %s" % (code, reachable.count(True), count, etag))
+            # A minute of timeSinceLastTreat may tick over between one pair of polls, but not between two
+            notModified = False
+            for attempt in range(2):
+                (code, etag, data) = yield fetch()
+                yield sleep(3)
+                (code, ignored, data) = yield fetch(etag)
+                print("GET with If-None-Match 3 s later: %d (%d bytes)" % (code, len(data)))
+                if code == 304:
+                    notModified = True
+                    break
+            (transport, proto) = servers.pop()
+            transport.signalProcess("TERM")
+            yield proto.exited
+            yield sleep(3)
+            (code, etag, data) = yield fetch(etag)
+            reachable = [node["reachable"] for node in json.loads(data)["nodes"]]
+            print("After stopping one node: %d, %d of %d nodes reachable" % (code, reachable.count(True), count))
+            outcome["passed"] = notModified and reachable.count(True) == count - 1
+            yield aggregator.stop()
+        finally:
+            for (transport, proto) in servers:
+                transport.signalProcess("TERM")
+            reactor.callLater(0.5, reactor.stop)
+    reactor.callWhenRunning(run)
+    reactor.run()
+    print("PASS" if outcome["passed"] else "FAIL")
+    return outcome["passed"]
+
+if __name__ == "__main__":
+    import sys
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description = "Check the fleet aggregator against stand-in treaters on loopback ports")
+    parser.add_argument("--standins", type=int, default=3, help="number of stand-in treaters to start")
+    parser.add_argument("--base-port", type=int, default=18100, help="port of the first stand-in treater")
+    parser.add_argument("--port", type=int, default=18099, help="port for the aggregator")
+    args = parser.parse_args()
+
+    from logging import Formatter, StreamHandler, INFO, getLogger
+    consoleHandler = StreamHandler()
+    consoleHandler.setFormatter(Formatter(fmt='%(asctime)s - %(name)s - %(levelname)s - %(message)s', datefmt="%Y-%m-%d %H:%M:%S"))
+    getLogger().addHandler(consoleHandler)
+    getLogger().setLevel(INFO)
+    sys.exit(0 if checkAgainstStandIns(reactor, args.standins, args.base_port, args.port) else 1)
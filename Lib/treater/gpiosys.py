@@ -6,10 +6,71 @@
 
 import time
 import os
+import errno
+import select
+import struct
 import logging
 
 LOGGER = logging.getLogger("gpiosys")
 
+class AttributeWatcher:
+    """Waits for permission changes on a set of files using inotify, falling back to short polls when inotify
+    is not available through libc"""
+
+    IN_ATTRIB = 0x00000004
+    IN_NONBLOCK = 0o4000
+    EVENT_HEADER = struct.Struct("iIII")
+    POLL_SECONDS = 0.01
+
+    libc = None
+
+    def __init__(self):
+        self.fd = None
+        try:
+            if AttributeWatcher.libc is None:
+                import ctypes
+                import ctypes.util
+                # find_library shells out to ldconfig, so only fall back to it if the usual soname is missing
+                try:
+                    AttributeWatcher.libc = ctypes.CDLL("libc.so.6", use_errno=True)
+                except OSError:
+                    AttributeWatcher.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            self.fd = self.libc.inotify_init1(self.IN_NONBLOCK)
+            if self.fd < 0:
+                self.fd = None
+        except (OSError, AttributeError):
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def watch(self, path):
+        if self.fd is not None and self.libc.inotify_add_watch(self.fd, path, self.IN_ATTRIB) < 0:
+            LOGGER.debug("Unable to watch %s with inotify; will poll it" % path)
+
+    def wait(self, timeoutSeconds):
+        """Blocks until an attribute change is reported or timeoutSeconds passes"""
+        if self.fd is None:
+            time.sleep(min(timeoutSeconds, self.POLL_SECONDS))
+            return
+        # Also wake up periodically, in case a watch could not be added or the change raced the watch
+        (readable, ignored, ignored) = select.select([self.fd], [], [], min(timeoutSeconds, 0.1))
+        if readable:
+            try:
+                os.read(self.fd, 4096)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
 class GPIO:
 
     IN = "in"
@@ -35,6 +96,8 @@ class GPIO:
         def __init__(self, pinNumber, pinType):
             self.pinNumber = pinNumber
             self.pinType = pinType
+            self.reused = False
+            self.setupSeconds = None
 
     pins = {}
 
@@ -59,27 +122,65 @@ class GPIO:
         del self.pins[pinNumber]
 
     def setupPin(self, pinNumber, pinType, initialValue = None):
-        if pinNumber in self.pins:
+        self.setupPins([(pinNumber, pinType, initialValue)])
+
+    def setupPins(self, pinSpecs, timeoutSeconds = 2.0):
+        """Sets up several pins at once from (pinNumber, pinType, initialValue) tuples. All pins are exported in
+        one pass, then we wait (via inotify) for the udev rule to make their direction files writable, so the
+        udev delays overlap instead of adding up. Returns a dict of pin number to setup time in seconds"""
+        start = time.time()
+        pending = []
+        for (pinNumber, pinType, initialValue) in pinSpecs:
+            pin = self.pins.get(pinNumber)
+            if pin is None:
+                pin = GPIO.Pin(pinNumber, pinType)
+                self.pins[pinNumber] = pin
+                pin.reused = not self._exportPin(pinNumber)
+            pin.pinType = pinType
+            pending.append((pin, initialValue))
+
+        deadline = start + timeoutSeconds
+        with AttributeWatcher() as watcher:
+            for (pin, initialValue) in pending:
+                watcher.watch(self.DIRECTION_PATH % pin.pinNumber)
+            while pending:
+                stillPending = []
+                for (pin, initialValue) in pending:
+                    if self._setDirection(pin, initialValue):
+                        pin.setupSeconds = time.time() - start
+                    else:
+                        stillPending.append((pin, initialValue))
+                pending = stillPending
+                if pending:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise Exception("Unable to set pin direction. Error opening or writing to: %s" % (self.DIRECTION_PATH % pending[0][0].pinNumber))
+                    watcher.wait(remaining)
+
+        timings = dict((pinNumber, self.pins[pinNumber].setupSeconds) for (pinNumber, pinType, initialValue) in pinSpecs)
+        for (pinNumber, pinType, initialValue) in pinSpecs:
             pin = self.pins[pinNumber]
-        else:
-            pin = GPIO.Pin(pinNumber, pinType)
-            self.pins[pinNumber] = pin
-            self._exportPin(pinNumber)
-        directionWasSet = False
-        retryCount = 10
-        # Kludge to work around delay between creation of gpioN file and udev rule to update permissions
-        while retryCount > 0 and not directionWasSet:
-            try:
-                with open(self.DIRECTION_PATH % pinNumber, "w") as directionFile:
-                    directionFile.write(self._pinTypeAndValueToDirection(pinType, initialValue))
-                    directionWasSet = True
-            except IOError as ioe:
-                if ioe.errno != 13:
-                    raise ioe
-                retryCount = retryCount - 1
-                time.sleep(0.1)
-        if not directionWasSet:
-            raise Exception("Unable to set pin direction. Error opening or writing to: %s" % (self.DIRECTION_PATH % pinNumber))
+            LOGGER.info("GPIO pin %d set up as %s in %.1f ms%s" % (pinNumber, pinType, pin.setupSeconds * 1000,
+                                                                    " (reused existing export)" if pin.reused else ""))
+        return timings
+
+    def _setDirection(self, pin, initialValue):
+        """Returns False if the direction file is not writable yet (udev has not updated permissions)"""
+        direction = self._pinTypeAndValueToDirection(pin.pinType, initialValue)
+        directionPath = self.DIRECTION_PATH % pin.pinNumber
+        try:
+            if pin.reused and (pin.pinType == self.IN or initialValue is None):
+                # Left over from a previous run; nothing to write if it is already configured the way we want
+                with open(directionPath, "r") as directionFile:
+                    if directionFile.read().strip() == pin.pinType:
+                        return True
+            with open(directionPath, "w") as directionFile:
+                directionFile.write(direction)
+            return True
+        except IOError as ioe:
+            if ioe.errno not in (errno.EACCES, errno.ENOENT):
+                raise ioe
+            return False
 
     def writePin(self, pinNumber, value):
         if pinNumber not in self.pins:
@@ -107,12 +208,14 @@ class GPIO:
                 return "high"
 
     def _exportPin(self, pinNumber):
+        """Returns True if the pin was exported, or False if it was already exported"""
         pinPath = self.PIN_PATH % pinNumber
         if os.path.exists(pinPath):
             LOGGER.warning("GPIO pin %d is already exported. Will skip export and reconfigure it." % pinNumber)
-        else:
-            with open(self.EXPORT_PATH, "w") as exportFile:
-                exportFile.write(str(pinNumber))
+            return False
+        with open(self.EXPORT_PATH, "w") as exportFile:
+            exportFile.write(str(pinNumber))
+        return True
 
     def _unexportPin(self, pinNumber):
         pinPath = self.PIN_PATH % pinNumber
@@ -6,12 +6,18 @@
 
 import pickle
 import os
+import sys
 import threading
+import time
 from datetime import datetime, timedelta
 import logging
+from metrics import REGISTRY
+from memory import MEMORY
 
 LOGGER = logging.getLogger("history")
 
+SAVE_DURATION = REGISTRY.histogram("treater_history_save_duration_seconds", "Time spent writing the treat history file")
+
 class TreatEvent:
     def __init__(self, treatTime, treatCount):
         self.treatTime = treatTime
@@ -19,12 +25,18 @@ class TreatEvent:
 
 class TreatHistory:
     
-    def __init__(self, path=None):
+    def __init__(self, path=None, archivePath=None):
         self.treatEvents = []
         self.path = path
+        self.archivePath = archivePath
+        self.archive = None
         self.lock = threading.Lock()
+        self.listeners = []
         if path is not None:
             self.load(path)
+        if archivePath:
+            self.openArchive(archivePath)
+        MEMORY.register("history", self.memoryUsage)
 
     def __str__(self):
         return "TreatHistory"
@@ -53,23 +65,69 @@ class TreatHistory:
             LOGGER.warn("Treat history not present at path: %s" % path)          
             self.treatEvents = []
         
+    def openArchive(self, path):
+        """The archive keeps every treat event, one "<epoch> <count>" line each, where the history file keeps only
+        the last 24 hours. A new archive starts with the events in the history file"""
+        try:
+            exists = os.path.isfile(path)
+            # Line buffered, so each event reaches the file in a single write
+            self.archive = open(path, "a", 1)
+            if not exists:
+                for event in self.treatEvents:
+                    self.archiveEvent(event)
+        except IOError:
+            LOGGER.exception("Unable to open treat history archive: %s" % path)
+            self.archive = None
+
+    def archiveEvent(self, event):
+        if self.archive is None:
+            return
+        epoch = time.mktime(event.treatTime.timetuple()) + event.treatTime.microsecond / 1e6
+        try:
+            self.archive.write("%r %d\n" % (epoch, event.treatCount))
+        except IOError:
+            LOGGER.error("Unable to append to treat history archive: %s" % self.archivePath)
+
+    def closeArchive(self):
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+
     def save(self, path):
+        start = time.time()
         try:
             # Lock to prevent two threads trying to update the file at the same time
             with self.lock, open(path, "w") as f:
                 pickle.dump(self.treatEvents, f)
         except:
             LOGGER.error("Unable to write treat history to: %s" % path)
+        SAVE_DURATION.observe(time.time() - start)
         
     def autoSave(self):
         if (self.path is not None):
             self.save(self.path)
         
+    def memoryUsage(self):
+        events = self.treatEvents
+        size = sys.getsizeof(events)
+        if events:
+            event = events[0]
+            size += len(events) * (sys.getsizeof(event) + sys.getsizeof(event.__dict__) + sys.getsizeof(event.treatTime))
+        return (size, len(events))
+
+    def addListener(self, listener):
+        """listener.treatDispensed(treatEvent) is called after each dispense is recorded"""
+        self.listeners.append(listener)
+
     def treatsDispensed(self, treatCount):
         dt = datetime.now()
-        self.treatEvents.append(TreatEvent(dt, treatCount))
+        event = TreatEvent(dt, treatCount)
+        self.treatEvents.append(event)
         self.updateLast24Hours()
         self.autoSave()
+        self.archiveEvent(event)
+        for listener in self.listeners:
+            listener.treatDispensed(event)
 
     def getTreatStats(self):
         self.updateLast24Hours()
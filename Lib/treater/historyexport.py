@@ -0,0 +1,203 @@
+#!/usr/bin/python
+
+# treater/historyexport.py
+
+"""Streams treat history out as NDJSON or CSV with a push producer, a chunk of events per reactor turn, reading
+from the append-only history archive so that exporting years of history takes constant memory"""
+
+import json
+import os
+import time
+from datetime import datetime
+from logging import getLogger
+from zope.interface import implements
+from twisted.internet import reactor
+from twisted.internet.interfaces import IPushProducer
+from metrics import REGISTRY
+
+LOGGER = getLogger("webapi")
+
+EVENTS_EXPORTED = REGISTRY.counter("treater_history_export_events_total", "Treat events streamed by history exports")
+
+NDJSON = "ndjson"
+CSV = "csv"
+CONTENT_TYPES = {NDJSON: b"application/x-ndjson", CSV: b"text/csv; charset=utf-8"}
+
+TIME_FORMATS = ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d")
+
+def parseTime(text):
+    """Epoch seconds, or a local time as YYYY-mm-dd[THH:MM[:SS]]"""
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    for timeFormat in TIME_FORMATS:
+        try:
+            return time.mktime(datetime.strptime(text, timeFormat).timetuple())
+        except ValueError:
+            pass
+    raise ValueError("Unrecognised time %r; use epoch seconds or YYYY-mm-ddTHH:MM:SS" % text)
+
+def parseRecord(line):
+    """(epoch, treat count) from an archive line, or None for a line cut short by a crash"""
+    if not line.endswith("\n"):
+        return None
+    fields = line.split()
+    try:
+        return (float(fields[0]), int(fields[1]))
+    except (IndexError, ValueError):
+        return None
+
+def findArchiveOffset(f, epoch):
+    """Offset of the first complete line at or after epoch, found by bisecting the file on line boundaries. The
+    archive is appended in time order"""
+    f.seek(0, os.SEEK_END)
+    (low, high) = (0, f.tell())
+    while low < high:
+        middle = (low + high) // 2
+        f.seek(middle)
+        if middle > 0:
+            # Skip to the start of the next line
+            f.readline()
+        lineStart = f.tell()
+        record = parseRecord(f.readline()) if lineStart < high else None
+        if record is not None and record[0] < epoch:
+            low = f.tell()
+        else:
+            high = middle
+    # low is now at or just before the first wanted line
+    f.seek(low)
+    if low > 0:
+        f.seek(low - 1)
+        if f.read(1) != "\n":
+            f.readline()
+    return f.tell()
+
+def iterArchive(path, fromEpoch = None, toEpoch = None):
+    """Yields (epoch, treat count) for each archived event in [fromEpoch, toEpoch)"""
+    with open(path, "r") as f:
+        if fromEpoch is not None:
+            findArchiveOffset(f, fromEpoch)
+        for line in iter(f.readline, ""):
+            record = parseRecord(line)
+            if record is None:
+                continue
+            if fromEpoch is not None and record[0] < fromEpoch:
+                continue
+            if toEpoch is not None and record[0] >= toEpoch:
+                return
+            yield record
+
+def iterEvents(events, fromEpoch = None, toEpoch = None):
+    """The same, over in-memory TreatEvents, for when there is no archive"""
+    for event in list(events):
+        epoch = time.mktime(event.treatTime.timetuple()) + event.treatTime.microsecond / 1e6
+        if (fromEpoch is None or epoch >= fromEpoch) and (toEpoch is None or epoch < toEpoch):
+            yield (epoch, event.treatCount)
+
+def formatTime(epoch):
+    return datetime.fromtimestamp(epoch).strftime("%Y-%m-%dT%H:%M:%S")
+
+def formatNdjson(epoch, treatCount):
+    return json.dumps({"treatTime": formatTime(epoch), "epoch": epoch, "treatCount": treatCount}) + "\n"
+
+def formatCsv(epoch, treatCount):
+    return "%s,%r,%d\r\n" % (formatTime(epoch), epoch, treatCount)
+
+FORMATTERS = {NDJSON: formatNdjson, CSV: formatCsv}
+HEADERS = {NDJSON: "", CSV: "treatTime,epoch,treatCount\r\n"}
+
+class HistoryExportProducer:
+    """Writes chunkSize events per reactor turn, and stops while the consumer is paused"""
+    implements(IPushProducer)
+
+    CHUNK_SIZE = 500
+
+    def __init__(self, request, records, format, chunkSize = CHUNK_SIZE):
+        self.request = request
+        self.records = records
+        self.format = format
+        self.formatter = FORMATTERS[format]
+        self.chunkSize = chunkSize
+        self.paused = False
+        self.stopped = False
+        self.pending = None
+        self.exported = 0
+
+    def start(self):
+        self.request.registerProducer(self, True)
+        self.request.write(HEADERS[self.format])
+        self.schedule()
+
+    def schedule(self):
+        if self.pending is None and not self.stopped:
+            self.pending = reactor.callLater(0, self.produce)
+
+    def produce(self):
+        self.pending = None
+        if self.paused or self.stopped:
+            return
+        lines = []
+        try:
+            for record in self.records:
+                lines.append(self.formatter(*record))
+                if len(lines) >= self.chunkSize:
+                    break
+        except (IOError, OSError):
+            LOGGER.exception("Error reading treat history for export")
+            self.finish(abort=True)
+            return
+        if lines:
+            self.exported += len(lines)
+            EVENTS_EXPORTED.inc(len(lines))
+            self.request.write("".join(lines))
+        if len(lines) < self.chunkSize:
+            self.finish()
+        else:
+            self.schedule()
+
+    def finish(self, abort = False):
+        if self.stopped:
+            return
+        self.stopped = True
+        self.close()
+        self.request.unregisterProducer()
+        if abort:
+            self.request.channel.transport.loseConnection()
+        else:
+            self.request.finish()
+
+    def close(self):
+        # Closes the archive file of a generator that was not run to the end
+        close = getattr(self.records, "close", None)
+        if close is not None:
+            close()
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.schedule()
+
+    def stopProducing(self):
+        if self.pending is not None and self.pending.active():
+            self.pending.cancel()
+        self.pending = None
+        if not self.stopped:
+            self.stopped = True
+            self.close()
+
+if __name__ == "__main__":
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), "treathist.archive")
+    start = time.mktime(datetime(2020, 1, 1).timetuple())
+    with open(path, "w") as f:
+        for n in range(200000):
+            f.write("%r %d\n" % (start + n * 600.0, 1 + n % 4))
+    began = time.time()
+    fromEpoch = parseTime("2022-06-01")
+    toEpoch = parseTime("2022-06-02")
+    records = list(iterArchive(path, fromEpoch, toEpoch))
+    print("%d events on 2022-06-01 found in %.1f ms; first %s, last %s" % (
+        len(records), (time.time() - began) * 1000, formatTime(records[0][0]), formatTime(records[-1][0])))
@@ -0,0 +1,370 @@
+#!/usr/bin/python
+
+# treater/hwthread.py
+
+"""Runs GPIO sampling and dispenser power control on a dedicated thread, at SCHED_FIFO priority where permitted, so
+that treat detection and power cutoff do not wait on the reactor. Input changes are handed to the reactor through a
+bounded single-producer single-consumer ring and a wakeup pipe, and commands come back the same way"""
+
+import errno
+import os
+import select
+import threading
+import time
+from logging import getLogger
+from twisted.internet import abstract
+from metrics import REGISTRY
+
+LOGGER = getLogger("machine")
+
+SCHED_FIFO = 1
+
+EVENTS_DROPPED = REGISTRY.counter("treater_hwthread_events_dropped_total", "Input events dropped because the reactor fell behind the hardware thread")
+POLL_LATENESS = REGISTRY.histogram("treater_hwthread_poll_lateness_seconds", "How late the hardware thread sampled the GPIO inputs",
+                                   (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1))
+HANDOFF_LATENCY = REGISTRY.histogram("treater_hwthread_handoff_seconds", "Time from an input change being sampled to the reactor handling it",
+                                     (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5))
+POWER_CUTS = REGISTRY.counter("treater_hwthread_power_cuts_total", "Dispenser power cuts made by the hardware thread without waiting for the reactor")
+
+# Commands, reactor to hardware thread
+POWER = "power"
+ARM_CUTOFF = "armCutoff"
+# Events, hardware thread to reactor
+INPUT = "input"
+POWER_CUT = "powerCut"
+
+def loadSetScheduler():
+    try:
+        from os import sched_setscheduler, sched_param
+        return lambda priority: sched_setscheduler(0, SCHED_FIFO, sched_param(priority))
+    except ImportError:
+        pass
+    # Python 2 has no os.sched_setscheduler, so call the libc function directly
+    try:
+        import ctypes
+        import ctypes.util
+        try:
+            libc = ctypes.CDLL("libc.so.6", use_errno=True)
+        except OSError:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libcSetScheduler = libc.sched_setscheduler
+    except (OSError, AttributeError):
+        return None
+
+    def setScheduler(priority):
+        param = ctypes.c_int(priority)
+        # On Linux, pid 0 is the calling thread rather than the whole process
+        if libcSetScheduler(0, SCHED_FIFO, ctypes.byref(param)) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+    return setScheduler
+
+def setRealtimePriority(priority):
+    """Moves the calling thread to SCHED_FIFO at priority. Returns False if that is not permitted (it needs root or
+    CAP_SYS_NICE) or not supported"""
+    setScheduler = loadSetScheduler()
+    if setScheduler is None:
+        return False
+    try:
+        setScheduler(priority)
+        return True
+    except OSError as e:
+        LOGGER.warning("Unable to run the hardware thread at SCHED_FIFO priority %d: %s" % (priority, e.strerror))
+        return False
+
+class SpscRing:
+    """Bounded ring for exactly one producer thread and one consumer thread. Only the producer moves tail and only the
+    consumer moves head, and the slot is filled before tail publishes it, so no lock is needed"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.slots = [None] * capacity
+        self.head = 0
+        self.tail = 0
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def push(self, item):
+        """Returns False, leaving the ring unchanged, if it is full"""
+        tail = self.tail
+        if tail - self.head >= self.capacity:
+            return False
+        self.slots[tail % self.capacity] = item
+        self.tail = tail + 1
+        return True
+
+    def pop(self):
+        """Returns None if the ring is empty"""
+        head = self.head
+        if head == self.tail:
+            return None
+        index = head % self.capacity
+        item = self.slots[index]
+        self.slots[index] = None
+        self.head = head + 1
+        return item
+
+def openWakeupPipe():
+    (readFd, writeFd) = os.pipe()
+    for fd in (readFd, writeFd):
+        setNonBlocking(fd)
+    return (readFd, writeFd)
+
+def setNonBlocking(fd):
+    import fcntl
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+def wake(fd):
+    try:
+        os.write(fd, b"x")
+    except OSError as e:
+        # A full pipe already has a wakeup pending
+        if e.errno != errno.EAGAIN:
+            raise
+
+def drainWakeups(fd):
+    try:
+        while os.read(fd, 4096):
+            pass
+    except OSError as e:
+        if e.errno != errno.EAGAIN:
+            raise
+
+class HardwareThread:
+    """Owns the GPIO handles once started. Samples the detector and button every pollSeconds and reports changes to
+    listener.inputChanged(pinNumber, value, sampledTime) on the reactor. setPower and armCutoff are carried out on the
+    thread; once armed, the thread cuts power itself when the treat count or deadline is reached, and reports it with
+    listener.powerCut(cutTime, reason)"""
+
+    RING_SIZE = 256
+
+    def __init__(self, reactor, gpio, detectorPin, buttonPin, powerPin, pollSeconds, priority, listener):
+        self.reactor = reactor
+        self.gpio = gpio
+        self.detectorPin = detectorPin
+        self.buttonPin = buttonPin
+        self.powerPin = powerPin
+        self.pollSeconds = pollSeconds
+        self.priority = priority
+        self.listener = listener
+        self.events = SpscRing(self.RING_SIZE)
+        self.commands = SpscRing(self.RING_SIZE)
+        (self.eventReadFd, self.eventWriteFd) = openWakeupPipe()
+        (self.commandReadFd, self.commandWriteFd) = openWakeupPipe()
+        # Levels as last delivered to the reactor, read before the thread takes over the pins
+        self.levels = dict((pin, gpio.readPin(pin)) for pin in (detectorPin, buttonPin))
+        self.realtime = False
+        self.running = False
+        self.thread = None
+        self.reader = None
+        # Owned by the thread once it is running
+        self.sampled = dict(self.levels)
+        self.powered = False
+        self.cutCount = None
+        self.cutDeadline = None
+        self.armedCount = 0
+
+    def __str__(self):
+        return "HardwareThread"
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        hardware = self
+
+        class EventReader(abstract.FileDescriptor):
+            def fileno(self):
+                return hardware.eventReadFd
+
+            def doRead(self):
+                hardware.deliverEvents()
+
+        self.reader = EventReader(self.reactor)
+        self.reader.startReading()
+        self.thread = threading.Thread(target=self.run, name="hwthread")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeoutSeconds = 2.0):
+        """Powers the dispenser off and waits for the thread to exit, after which the GPIO handles are the caller's"""
+        if not self.running:
+            return
+        self.setPower(False)
+        self.running = False
+        wake(self.commandWriteFd)
+        self.thread.join(timeoutSeconds)
+        if self.thread.is_alive():
+            LOGGER.error("Hardware thread did not stop within %.1f seconds" % timeoutSeconds)
+        self.reader.stopReading()
+        self.deliverEvents()
+        for fd in (self.eventReadFd, self.eventWriteFd, self.commandReadFd, self.commandWriteFd):
+            os.close(fd)
+
+    def sendCommand(self, command):
+        if not self.commands.push(command):
+            # Commands are a handful per dispense cycle, so a full ring means the thread has stopped
+            raise Exception("Hardware thread command ring is full; is the thread running?")
+        wake(self.commandWriteFd)
+
+    def setPower(self, enabled):
+        self.sendCommand((POWER, bool(enabled)))
+
+    def armCutoff(self, cutCount, deadline):
+        """Has the thread cut power once cutCount treats are detected (None for no count) or at deadline (epoch
+        seconds), whichever comes first. Send it before powering on; powering off disarms it"""
+        self.sendCommand((ARM_CUTOFF, cutCount, deadline))
+
+    def deliverEvents(self):
+        # Wakeups are drained before the ring, so an event pushed after this point wakes us again
+        drainWakeups(self.eventReadFd)
+        while True:
+            event = self.events.pop()
+            if event is None:
+                return
+            if event[0] == INPUT:
+                (kind, pinNumber, value, sampledTime) = event
+                HANDOFF_LATENCY.observe(time.time() - sampledTime)
+                self.levels[pinNumber] = value
+                self.listener.inputChanged(pinNumber, value, sampledTime)
+            elif event[0] == POWER_CUT:
+                (kind, cutTime, reason) = event
+                self.listener.powerCut(cutTime, reason)
+
+    # Everything below runs on the hardware thread
+
+    def pushEvent(self, event):
+        if not self.events.push(event):
+            EVENTS_DROPPED.inc()
+            return
+        wake(self.eventWriteFd)
+
+    def run(self):
+        if self.priority > 0:
+            self.realtime = setRealtimePriority(self.priority)
+        LOGGER.info("Hardware thread polling every %.0f ms%s" % (self.pollSeconds * 1000,
+                                                                 " at SCHED_FIFO priority %d" % self.priority if self.realtime else ""))
+        nextPoll = time.time()
+        while self.running:
+            try:
+                (readable, ignored, ignored) = select.select([self.commandReadFd], [], [], max(0.0, nextPoll - time.time()))
+                if readable:
+                    drainWakeups(self.commandReadFd)
+                self.runCommands()
+                now = time.time()
+                if now >= nextPoll:
+                    POLL_LATENESS.observe(now - nextPoll)
+                    self.sample(now)
+                    # After a stall, carry on from now rather than sampling in a burst to catch up
+                    nextPoll = max(nextPoll + self.pollSeconds, now)
+            except Exception:
+                LOGGER.exception("Error on the hardware thread")
+                time.sleep(self.pollSeconds)
+        self.runCommands()
+
+    def runCommands(self):
+        while True:
+            command = self.commands.pop()
+            if command is None:
+                return
+            if command[0] == POWER:
+                self.writePower(command[1])
+            elif command[0] == ARM_CUTOFF:
+                (kind, self.cutCount, self.cutDeadline) = command
+                self.armedCount = 0
+
+    def writePower(self, enabled):
+        self.powered = enabled
+        if not enabled:
+            self.cutCount = None
+            self.cutDeadline = None
+        self.gpio.writePin(self.powerPin, 1 if enabled else 0)
+
+    def sample(self, now):
+        for pinNumber in (self.detectorPin, self.buttonPin):
+            value = self.gpio.readPin(pinNumber)
+            if value == self.sampled[pinNumber]:
+                continue
+            self.sampled[pinNumber] = value
+            self.pushEvent((INPUT, pinNumber, value, now))
+            if pinNumber == self.detectorPin and value and self.powered:
+                self.armedCount += 1
+                if self.cutCount is not None and self.armedCount >= self.cutCount:
+                    self.cutPower(now, "count")
+        if self.powered and self.cutDeadline is not None and now >= self.cutDeadline:
+            self.cutPower(now, "deadline")
+
+    def cutPower(self, now, reason):
+        self.writePower(False)
+        POWER_CUTS.inc()
+        self.pushEvent((POWER_CUT, now, reason))
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    from twisted.internet import reactor, task
+    from standins import StandInTreatMachine, standInMachineConfig
+
+    parser = ArgumentParser(description = "Measure power cutoff latency with and without the hardware thread, while "
+                            "the reactor is repeatedly blocked")
+    parser.add_argument("--hardware-thread", action="store_true")
+    parser.add_argument("--cycles", type=int, default=5)
+    parser.add_argument("--block-seconds", type=float, default=0.15, help="how long each reactor stall lasts")
+    args = parser.parse_args()
+
+    config = standInMachineConfig()
+    config.hardwareThread = args.hardware_thread
+    config.hardwareThreadPriority = 50
+    config.cutoffModelFile = ""
+    config.treatEnabledSeconds = 5
+    machine = StandInTreatMachine(reactor, config)
+    gpio = machine.gpio
+    latencies = []
+    counts = []
+
+    def dispenser():
+        # Its own thread, so that treats keep falling while the reactor is blocked. Pulses every 250 ms while powered
+        detected = 0
+        while True:
+            time.sleep(0.25)
+            if gpio.values[config.gpioTreatPower]:
+                gpio.values[config.gpioTreatDetector] = 1
+                detected += 1
+                pulseTime = time.time()
+                if detected == config.maxTreatsPerCycle:
+                    while gpio.values[config.gpioTreatPower]:
+                        if time.time() - pulseTime > 0.04:
+                            gpio.values[config.gpioTreatDetector] = 0
+                        time.sleep(0.0005)
+                    latencies.append(time.time() - pulseTime)
+                time.sleep(max(0.0, pulseTime + 0.04 - time.time()))
+                gpio.values[config.gpioTreatDetector] = 0
+            else:
+                detected = 0
+
+    dispenserThread = threading.Thread(target=dispenser)
+    dispenserThread.daemon = True
+    dispenserThread.start()
+
+    def blockReactor():
+        # Blocking I/O in some callback, e.g. a slow SD card write
+        time.sleep(args.block_seconds)
+    task.LoopingCall(blockReactor).start(0.3)
+
+    def dispense():
+        machine.dispenseTreat().addCallback(completed)
+
+    def completed(result):
+        counts.append(result.treatCount)
+        if len(counts) < args.cycles:
+            reactor.callLater(config.treatRecoverySeconds + 0.1, dispense)
+        else:
+            reactor.stop()
+
+    machine.start()
+    reactor.callLater(0.1, dispense)
+    reactor.run()
+    machine.close()
+    print("%s: cut power %s ms after the target treat; counts %s" % (
+        "hardware thread" if args.hardware_thread else "reactor polling",
+        ", ".join("%.0f" % (latency * 1000) for latency in latencies), counts))
@@ -0,0 +1,238 @@
+#!/usr/bin/python
+
+# treater/loadtest.py
+
+"""HTTP load test and latency benchmark for the TreatWeb API, run against stand-in hardware"""
+
+import os
+import sys
+import time
+from argparse import ArgumentParser
+from twisted.internet import reactor, protocol, task
+from twisted.internet.defer import Deferred, DeferredList, succeed
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
+from benchresults import summarizeLatencies, saveResults, loadResults, compareResults, formatRegressions
+
+WORKLOADS = ("status", "capture", "dispense")
+COMPARED_METRICS = ("throughput", "p50", "p95", "p99")
+SNAPSHOT_METRIC = "treater_standin_snapshot_requests_total"
+
+class WorkloadResult:
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.statusCodes = {}
+        self.errors = 0
+        self.startTime = None
+        self.endTime = None
+        self.extra = {}
+
+    def record(self, latency, code):
+        self.latencies.append(latency)
+        self.statusCodes[str(code)] = self.statusCodes.get(str(code), 0) + 1
+
+    def summary(self):
+        elapsed = (self.endTime or time.time()) - self.startTime
+        result = summarizeLatencies(self.latencies)
+        result["requests"] = len(self.latencies)
+        result["errors"] = self.errors
+        result["statusCodes"] = self.statusCodes
+        result["throughput"] = len(self.latencies) / elapsed if elapsed > 0 else 0.0
+        result.update(self.extra)
+        return result
+
+class LoadClient:
+    def __init__(self, reactor, agent, baseUrl):
+        self.reactor = reactor
+        self.agent = agent
+        self.baseUrl = baseUrl
+
+    def timedRequest(self, method, path, result):
+        start = time.time()
+        d = self.agent.request(method, self.baseUrl + path)
+        def gotResponse(response):
+            return readBody(response).addCallback(lambda body: result.record(time.time() - start, response.code))
+        def failed(failure):
+            result.errors += 1
+        d.addCallbacks(gotResponse, failed)
+        return d
+
+    def closedLoop(self, method, path, concurrency, duration, result):
+        """Keeps concurrency requests outstanding until duration has elapsed"""
+        deadline = time.time() + duration
+        def loop(ignored = None):
+            if time.time() >= deadline:
+                return
+            return self.timedRequest(method, path, result).addCallback(loop)
+        return DeferredList([loop() or succeed(None) for i in range(concurrency)])
+
+    def bursts(self, method, path, burstSize, burstInterval, duration, result):
+        """Fires burstSize simultaneous requests every burstInterval seconds"""
+        done = Deferred()
+        outstanding = []
+        deadline = time.time() + duration
+        def burst():
+            if time.time() >= deadline:
+                call.stop()
+                return
+            outstanding.extend(self.timedRequest(method, path, result) for i in range(burstSize))
+        call = task.LoopingCall(burst)
+        call.clock = self.reactor
+        call.start(burstInterval).addCallback(lambda ignored: DeferredList(outstanding)).chainDeferred(done)
+        return done
+
+    def fetchMetric(self, name):
+        d = self.agent.request("GET", self.baseUrl + "/api/metrics")
+        d.addCallback(readBody)
+        def parse(body):
+            for line in body.splitlines():
+                if line.startswith(name + " "):
+                    return float(line.split()[-1])
+            return None
+        d.addCallback(parse)
+        d.addErrback(lambda failure: None)
+        return d
+
+class StandInServerProtocol(protocol.ProcessProtocol):
+    def __init__(self):
+        self.exited = Deferred()
+
+    def processEnded(self, reason):
+        self.exited.callback(None)
+
+def spawnStandInServer(reactor, port, captureSeconds):
+    packageParent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [packageParent, env.get("PYTHONPATH")]))
+    proto = StandInServerProtocol()
+    args = [sys.executable, "-m", "treater.standins", "--port", str(port), "--capture-seconds", str(captureSeconds)]
+    transport = reactor.spawnProcess(proto, sys.executable, args, env=env, childFDs={0: "w", 1: 1, 2: 2})
+    return (transport, proto)
+
+def waitUntilServing(reactor, agent, baseUrl, timeout):
+    ready = Deferred()
+    deadline = time.time() + timeout
+    def attempt():
+        d = agent.request("GET", baseUrl + "/api/getStatus")
+        d.addCallback(readBody)
+        def retry(failure):
+            if time.time() > deadline:
+                ready.errback(failure)
+            else:
+                reactor.callLater(0.1, attempt)
+        d.addCallbacks(lambda body: ready.callback(None), retry)
+    attempt()
+    return ready
+
+def runWorkloads(reactor, client, args):
+    results = {}
+    names = [w for w in WORKLOADS if w in args.workloads]
+
+    def runNext(ignored = None):
+        if not names:
+            return results
+        name = names.pop(0)
+        result = WorkloadResult(name)
+        results[name] = result
+        result.startTime = time.time()
+        if name == "status":
+            d = client.closedLoop("GET", "/api/getStatus", args.concurrency, args.duration, result)
+        elif name == "capture":
+            d = runCaptureBursts(client, args, result)
+        else:
+            dispensePath = "/api/dispenseTreat?wait=1" if args.dispense_wait else "/api/dispenseTreat"
+            d = client.closedLoop("POST", dispensePath, args.concurrency, args.duration, result)
+        def finished(ignored):
+            result.endTime = time.time()
+        d.addCallback(finished)
+        d.addCallback(runNext)
+        return d
+    return runNext()
+
+def runCaptureBursts(client, args, result):
+    counts = {}
+    d = client.fetchMetric(SNAPSHOT_METRIC)
+    d.addCallback(lambda before: counts.__setitem__("before", before))
+    d.addCallback(lambda ignored: client.bursts("POST", "/api/capturePhoto", args.concurrency, args.burst_interval, args.duration, result))
+    d.addCallback(lambda ignored: client.fetchMetric(SNAPSHOT_METRIC))
+    def coalescing(after):
+        before = counts["before"]
+        if before is not None and after is not None and after > before:
+            snapshots = after - before
+            result.extra["snapshotRequests"] = int(snapshots)
+            # Captures served per request sent to the motion daemon; 1.0 means no coalescing at all
+            result.extra["coalescingRatio"] = len(result.latencies) / snapshots
+    d.addCallback(coalescing)
+    return d
+
+def report(results):
+    for name in WORKLOADS:
+        if name not in results:
+            continue
+        r = results[name]
+        line = "%-9s %6d req %6.1f req/s  p50 %7.2f ms  p95 %7.2f ms  p99 %7.2f ms  errors %d  codes %s" % (
+            name, r["requests"], r["throughput"], r["p50"] * 1000, r["p95"] * 1000, r["p99"] * 1000, r["errors"],
+            ",".join("%s:%d" % item for item in sorted(r["statusCodes"].items())))
+        if "coalescingRatio" in r:
+            line += "  coalescing %.1fx" % r["coalescingRatio"]
+        print(line)
+
+def main(reactor, args, outcome):
+    pool = HTTPConnectionPool(reactor, persistent=True)
+    pool.maxPersistentPerHost = args.concurrency
+    agent = Agent(reactor, pool=pool)
+    server = None
+    if args.url:
+        baseUrl = args.url.rstrip("/")
+    else:
+        baseUrl = "http://127.0.0.1:%d" % args.port
+        server = spawnStandInServer(reactor, args.port, args.capture_seconds)
+    client = LoadClient(reactor, agent, baseUrl)
+    outcome["exitCode"] = 0
+
+    d = waitUntilServing(reactor, agent, baseUrl, args.startup_timeout)
+    d.addCallback(lambda ignored: runWorkloads(reactor, client, args))
+    def finished(results):
+        summaries = dict((name, r.summary()) for (name, r) in results.items())
+        report(summaries)
+        if args.output:
+            saveResults(args.output, "loadtest", summaries)
+        if args.baseline:
+            regressions = compareResults(summaries, loadResults(args.baseline), args.threshold, COMPARED_METRICS)
+            if regressions:
+                print(formatRegressions(regressions))
+                outcome["exitCode"] = 1
+    def failed(failure):
+        print("Load test failed: %s" % failure.getErrorMessage())
+        outcome["exitCode"] = 2
+    d.addCallbacks(finished, failed)
+    d.addBoth(lambda ignored: pool.closeCachedConnections())
+    def stopServer(ignored):
+        if server is None:
+            return
+        (transport, proto) = server
+        transport.signalProcess("TERM")
+        return proto.exited
+    d.addBoth(stopServer)
+    d.addBoth(lambda ignored: reactor.stop())
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description = "Load test the treater web API")
+    parser.add_argument("--workloads", nargs="+", choices=WORKLOADS, default=list(WORKLOADS))
+    parser.add_argument("--concurrency", type=int, default=10, help="concurrent clients, or requests per capture burst")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run each workload")
+    parser.add_argument("--burst-interval", type=float, default=1.0, help="seconds between capturePhoto bursts")
+    parser.add_argument("--dispense-wait", action="store_true", help="hold each dispense request until its cycle completes")
+    parser.add_argument("--capture-seconds", type=float, default=0.25, help="simulated motion daemon capture latency")
+    parser.add_argument("--port", type=int, default=18000, help="port for the stand-in treater")
+    parser.add_argument("--url", help="test an already running treater at this base URL instead of a stand-in")
+    parser.add_argument("--startup-timeout", type=float, default=15)
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="compare results against this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed regression as a fraction of the baseline")
+    args = parser.parse_args()
+
+    outcome = {}
+    reactor.callWhenRunning(main, reactor, args, outcome)
+    reactor.run()
+    sys.exit(outcome.get("exitCode", 2))
@@ -7,19 +7,38 @@
 from gpiosys import GPIO
 from datetime import datetime, timedelta
 from twisted.internet import reactor
+from twisted.internet.defer import Deferred
 from history import TreatHistory
 from seriallcd import SerialLCD
 from os import path, getcwd
 from logging import getLogger
+from metrics import REGISTRY
+from tracebuffer import TRACE
+from cutoff import DispenserCutoff
+import time
 
 LOGGER = getLogger("machine")
 
+STATE_NAMES = ("NotRunning", "Idle", "LightLcd", "Dispensing", "Recovering")
+STATE_GAUGES = dict((name, REGISTRY.gauge("treater_machine_state", "1 for the current state of the treat machine, otherwise 0", {"state": name}))
+                    for name in STATE_NAMES)
+STATE_GAUGES["NotRunning"].set(1)
+STATE_INDEXES = dict((name, index) for (index, name) in enumerate(STATE_NAMES))
+
+TRACE_POLL = TRACE.defineEvent("machine", "poll", "detector=%(a)d button=%(b)d")
+TRACE_BUTTON = TRACE.defineEvent("machine", "button", "pressed=%(a)d")
+TRACE_TREAT_DETECTED = TRACE.defineEvent("machine", "treatDetected", "state=%(a)d")
+TRACE_STATE = TRACE.defineEvent("machine", "changeState", formatter = lambda a, b: "%s -> %s" % (STATE_NAMES[a], STATE_NAMES[b]))
+TRACE_POWER = TRACE.defineEvent("machine", "dispenserPower", "enabled=%(a)d")
+TRACE_ERROR = TRACE.defineEvent("machine", "runError")
+
 class TreatMachineConfig:
     SECTION_NAME = "machine"
 
     def __init__(self, config = None):
         self.maxTreatsPerCycle = 0
         self.historyFile = path.join(getcwd(), "treathist")
+        self.historyArchiveFile = ""
         self.buttonHoldForTreatSeconds = 2
         self.returnToIdleSeconds = 10
         self.treatEnabledSeconds = 10
@@ -31,6 +50,11 @@ class TreatMachineConfig:
         self.gpioButton = 22
         self.gpioTreatPower = 25
         self.lcdBaud = 9600
+        self.cutoffMode = "count"
+        self.cutoffModelFile = ""
+        self.cutoffLearningRate = 0.2
+        self.hardwareThread = False
+        self.hardwareThreadPriority = 50
         if config:
             self.load(config)
 
@@ -38,6 +62,7 @@ class TreatMachineConfig:
         sec = TreatMachineConfig.SECTION_NAME
         self.maxTreatsPerCycle = config.getint(sec, "maxTreatsPerCycle")
         self.historyFile = config.get(sec, "historyFile")
+        self.historyArchiveFile = config.get(sec, "historyArchiveFile")
         self.buttonHoldForTreatSeconds = config.getint(sec, "buttonHoldForTreatSeconds")
         self.treatEnabledSeconds = config.getint(sec, "treatEnabledSeconds")
         self.treatRecoverySeconds = config.getint(sec, "treatRecoverySeconds")
@@ -48,29 +73,70 @@ class TreatMachineConfig:
         self.gpioTreatDetector = config.getint(sec, "gpioTreatDetector")
         self.gpioButton = config.getint(sec, "gpioButton")
         self.gpioTreatPower = config.getint(sec, "gpioTreatPower")
+        self.cutoffMode = config.get(sec, "cutoffMode")
+        self.cutoffModelFile = config.get(sec, "cutoffModelFile")
+        self.cutoffLearningRate = config.getfloat(sec, "cutoffLearningRate")
+        self.hardwareThread = config.getboolean(sec, "hardwareThread")
+        self.hardwareThreadPriority = config.getint(sec, "hardwareThreadPriority")
+
+class DispenseResult:
+    """What a dispense cycle delivered. capped is True when power was cut because the cycle reached
+    maxTreatsPerCycle, rather than by the treatEnabledSeconds timer"""
+
+    def __init__(self, treatCount, durationSeconds, capped):
+        self.treatCount = treatCount
+        self.durationSeconds = durationSeconds
+        self.capped = capped
+
+    def describe(self):
+        return {"treatCount": self.treatCount, "durationSeconds": self.durationSeconds, "capped": self.capped}
+
+class DispenseAbandoned(Exception):
+    pass
+
+def machinePinSpecs(config):
+    return [(config.gpioTreatDetector, GPIO.IN, None),
+            (config.gpioButton, GPIO.IN, None),
+            (config.gpioTreatPower, GPIO.OUT, 0)]
+
+def provisionGpio(config):
+    """Exports and configures the treat machine's pins. This waits up to 2 seconds for udev to make them writable, so
+    the service calls it from a thread and passes the result to TreatMachine"""
+    gpio = GPIO()
+    gpio.setupPins(machinePinSpecs(config))
+    return gpio
 
 class TreatMachine:
 
     gpio = None
 
-    def __init__(self, reactor, config):
+    def __init__(self, reactor, config, lcd = None, gpio = None):
         self.reactor = reactor
         self.config = config
-        self.history = TreatHistory(self.config.historyFile)
-        self.lcd = SerialLCD(self.config.lcdBaud)
+        self.history = TreatHistory(self.config.historyFile, self.config.historyArchiveFile)
+        self.lcd = lcd if lcd is not None else SerialLCD(self.config.lcdBaud, reactor=reactor)
         self.lcd.clear()
         self.lcd.writeBothLines("")
         self.lcd.clear()
         self.lcd.enableBacklight(False)
         self.lcd.setDisplayMode(display = True, cursor = False, blink = False)
-        self.gpio = GPIO()
-        self.gpio.setupPin(self.config.gpioTreatDetector, GPIO.IN)
-        self.gpio.setupPin(self.config.gpioButton, GPIO.IN)
-        self.gpio.setupPin(self.config.gpioTreatPower, GPIO.OUT, 0)
+        self.gpio = gpio if gpio is not None else GPIO()
+        # Pins already set up by provisionGpio are only re-checked, without waiting on udev
+        self.gpio.setupPins(machinePinSpecs(self.config))
         self.currentState = None
         self.lastState = None
         self.lastButtonState = False
         self.lastTreatDetectorState = False
+        self.lastPolledLevels = None
+        self.dispenserPowered = None
+        self.dispenseListeners = []
+        self.cutoff = DispenserCutoff(config)
+        self.hardware = None
+        if self.config.hardwareThread:
+            from hwthread import HardwareThread
+            self.hardware = HardwareThread(reactor, self.gpio, self.config.gpioTreatDetector, self.config.gpioButton,
+                                           self.config.gpioTreatPower, self.config.treatPollSeconds,
+                                           self.config.hardwareThreadPriority, self)
 
     def __del__(self):
         self.close()
@@ -83,8 +149,14 @@ class TreatMachine:
         return False
 
     def close(self):
+        """Returns what the LCD's close does: with a reactor, a Deferred that fires once the display has been sent
+        everything queued for it"""
+        if self.hardware is not None:
+            self.hardware.stop()
         self.gpio.close()
-        self.lcd.close()
+        closed = self.lcd.close()
+        self.history.closeArchive()
+        return closed
 
     def __str__(self):
         return "TreatMachine"
@@ -93,6 +165,8 @@ class TreatMachine:
         if not self.currentState:
             return
         LOGGER.info("TreatMachine stopping")
+        if isinstance(self.currentState, DispensingState):
+            self.currentState.abandon()
         self.changeState(None)
         self.setTreatDispenserPowerState(False)
         self.lcd.writeBothLines("Treater disabled")
@@ -102,6 +176,8 @@ class TreatMachine:
         if self.currentState:
             return
         LOGGER.info("TreatMachine starting")
+        if self.hardware is not None:
+            self.hardware.start()
         self.lastButtonState = False
         self.changeState(IdleState())
         self.run()
@@ -113,21 +189,23 @@ class TreatMachine:
         callbackInterval = self.config.buttonPollSeconds
 
         try:
-            # Fire treat detector event
+            # Fire treat detector event. With the hardware thread, detector changes arrive through inputChanged instead
             newTreatDetectorState = self.isTreatDetectorActive()
-            if newTreatDetectorState != self.lastTreatDetectorState:
-                if newTreatDetectorState:
-                    self.currentState.onTreatDetected(self)
-                self.lastTreatDetectorState = newTreatDetectorState
+            newButtonState = self.isButtonPressed() 
+            # Only level changes are traced; a record per poll would wrap the ring within a minute of dispensing
+            polledLevels = (newTreatDetectorState, newButtonState)
+            if polledLevels != self.lastPolledLevels:
+                TRACE.record(TRACE_POLL, newTreatDetectorState, newButtonState)
+                self.lastPolledLevels = polledLevels
+            if self.hardware is None:
+                self.treatDetectorChanged(newTreatDetectorState, time.time())
 
             # Fire button events
-            newButtonState = self.isButtonPressed() 
             if newButtonState != self.lastButtonState:
+                TRACE.record(TRACE_BUTTON, newButtonState)
                 if newButtonState:
-                    LOGGER.debug("Button pressed")
                     self.currentState.onButtonPressed(self)
                 else:    
-                    LOGGER.debug("Button released")
                     self.currentState.onButtonReleased(self)
                 self.lastButtonState = newButtonState
 
@@ -140,35 +218,95 @@ class TreatMachine:
 
         except Exception as e:
             LOGGER.exception(e)
+            TRACE.record(TRACE_ERROR)
+            TRACE.crashDump("exception in TreatMachine.run: %s" % e)
         finally:
             # Queue continual callback to service state machine
             self.reactor.callLater(callbackInterval, self.run)
 
+    def treatDetectorChanged(self, active, detectedTime):
+        if active != self.lastTreatDetectorState:
+            if active:
+                TRACE.record(TRACE_TREAT_DETECTED, STATE_INDEXES[self.getCurrentStateName()])
+                self.currentState.onTreatDetected(self, detectedTime)
+            self.lastTreatDetectorState = active
+
+    def inputChanged(self, pinNumber, value, sampledTime):
+        """Called by the hardware thread, on the reactor, for each change it samples"""
+        if pinNumber == self.config.gpioTreatDetector and self.currentState is not None:
+            try:
+                self.treatDetectorChanged(value != 0, sampledTime)
+            except Exception as e:
+                LOGGER.exception(e)
+                TRACE.record(TRACE_ERROR)
+
+    def powerCut(self, cutTime, reason):
+        """Called by the hardware thread, on the reactor, after it cut dispenser power on its own"""
+        LOGGER.debug("Hardware thread cut dispenser power (%s)", reason)
+        if self.dispenserPowered:
+            TRACE.record(TRACE_POWER, False)
+            self.dispenserPowered = False
+        if isinstance(self.currentState, DispensingState):
+            self.cutoff.poweredOff(cutTime)
+
     def changeState(self, newState):
         self.lastState = self.currentState
         self.currentState = newState
-        LOGGER.debug("Changing states, %s -> %s" % (self.lastState, self.currentState) )
+        lastName = self.stateName(self.lastState)
+        currentName = self.stateName(self.currentState)
+        STATE_GAUGES[lastName].set(0)
+        STATE_GAUGES[currentName].set(1)
+        TRACE.record(TRACE_STATE, STATE_INDEXES[lastName], STATE_INDEXES[currentName])
+        LOGGER.debug("Changing states, %s -> %s", lastName, currentName)
         if self.currentState is not None:
             self.currentState.enterState(self)
 
     def getCurrentStateName(self):
-        if self.currentState is None:
+        return self.stateName(self.currentState)
+
+    def stateName(self, state):
+        if state is None:
             return "NotRunning"
-        return str(self.currentState)
+        return str(state)
+
+    def addDispenseListener(self, listener):
+        """listener.dispenseStarted() is called as each dispense cycle begins"""
+        self.dispenseListeners.append(listener)
 
     def dispenseTreat(self):
+        """Returns a Deferred that fires with the DispenseResult of the cycle that the request started or joined, or
+        None if the machine is busy recovering"""
         if self.currentState is not None:
             self.currentState.onTreatDispenseRequest(self)
-        return isinstance(self.currentState, DispensingState)
+        if not isinstance(self.currentState, DispensingState):
+            return None
+        return self.currentState.addWaiter()
 
     def isTreatDetectorActive(self):
-        return self.gpio.readPin(self.config.gpioTreatDetector) != 0
+        return self.readInput(self.config.gpioTreatDetector) != 0
 
     def isButtonPressed(self):
-        return self.gpio.readPin(self.config.gpioButton) == 0
+        return self.readInput(self.config.gpioButton) == 0
+
+    def readInput(self, pinNumber):
+        # The hardware thread owns the pins while it runs; its last reported levels stand in for reads
+        if self.hardware is not None and self.hardware.running:
+            return self.hardware.levels[pinNumber]
+        return self.gpio.readPin(pinNumber)
+
+    def armCutoff(self, deadline):
+        """With the hardware thread, has it cut power at the cutoff count or deadline without waiting for the reactor"""
+        if self.hardware is not None and self.hardware.running:
+            self.hardware.armCutoff(self.cutoff.cutoffCount(), deadline)
 
     def setTreatDispenserPowerState(self, enabled):
-        if enabled:
+        # The dispensing state re-asserts power off on every tick; only changes are worth tracing
+        if enabled != self.dispenserPowered:
+            TRACE.record(TRACE_POWER, enabled)
+            self.dispenserPowered = enabled
+        if self.hardware is not None and self.hardware.running:
+            self.hardware.setPower(enabled)
+        elif enabled:
             self.gpio.writePin(self.config.gpioTreatPower, 1)
         else:
             self.gpio.writePin(self.config.gpioTreatPower, 0)
@@ -208,7 +346,7 @@ class State:
     def onTreatDispenseRequest(self, machine):
         pass
 
-    def onTreatDetected(self, machine):
+    def onTreatDetected(self, machine, detectedTime):
         pass
 
     def pollIntervalSeconds(self, machine):
@@ -270,28 +408,59 @@ class DispensingState(State):
         LOGGER.info("Treat dispensing")
         self.dispenseTime = datetime.now()
         self.cycleTreatCount = 0
+        self.waiters = []
         self.timeToStopDispensing = datetime.now() + timedelta(seconds = machine.config.treatEnabledSeconds)
         self.timeToExit = self.timeToStopDispensing + timedelta(seconds = machine.config.postCycleSeconds)
+        machine.cutoff.startCycle(time.time())
+        machine.armCutoff(time.time() + machine.config.treatEnabledSeconds)
         machine.setTreatDispenserPowerState(True)
         machine.lcd.writeBothLines("Dispensing...")
         machine.lcd.enableBacklight(True)
+        for listener in machine.dispenseListeners:
+            listener.dispenseStarted()
        
     def onTimerTick(self, machine):
         if (datetime.now()  > self.timeToStopDispensing):
-            machine.setTreatDispenserPowerState(False)
+            self.cutPower(machine)
         if (datetime.now()  > self.timeToExit):
             LOGGER.info("Estimated treats dispensed: %d" % self.cycleTreatCount)
+            machine.cutoff.endCycle(self.cycleTreatCount)
             machine.history.treatsDispensed(self.cycleTreatCount)
+            result = DispenseResult(self.cycleTreatCount, (datetime.now() - self.dispenseTime).total_seconds(),
+                                    machine.cutoff.targetReached)
             machine.changeState(RecoveringState())
+            # Fired once recovering, so that waiters see the machine's state after the cycle
+            for d in self.takeWaiters():
+                d.callback(result)
 
-    def onTreatDetected(self, machine):
+    def onTreatDetected(self, machine, detectedTime):
         self.cycleTreatCount = self.cycleTreatCount + 1
-        if machine.config.maxTreatsPerCycle and self.cycleTreatCount >= machine.config.maxTreatsPerCycle:
-            machine.setTreatDispenserPowerState(False)
+        if machine.cutoff.treatDetected(detectedTime, self.cycleTreatCount):
+            self.cutPower(machine, detectedTime)
             self.timeToExit = datetime.now() + timedelta(seconds = machine.config.postCycleSeconds)
 
+    def addWaiter(self):
+        d = Deferred(lambda d: self.waiters.remove(d))
+        self.waiters.append(d)
+        return d
+
+    def takeWaiters(self):
+        waiters = self.waiters
+        self.waiters = []
+        return waiters
+
+    def abandon(self):
+        for d in self.takeWaiters():
+            d.errback(DispenseAbandoned("Treat machine stopped during the dispense cycle"))
+
+    def cutPower(self, machine, now = None):
+        machine.setTreatDispenserPowerState(False)
+        machine.cutoff.poweredOff(now if now is not None else time.time())
+
     def pollIntervalSeconds(self, machine):
-        # Poll at higher rate when monitoring the treat detector
+        # Poll at higher rate when monitoring the treat detector, unless the hardware thread is doing so
+        if machine.hardware is not None:
+            return machine.config.buttonPollSeconds
         return machine.config.treatPollSeconds
 
 class RecoveringState(State):
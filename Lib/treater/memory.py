@@ -0,0 +1,312 @@
+#!/usr/bin/python
+
+# treater/memory.py
+
+"""Memory footprint accounting: RSS and its high-water mark from /proc, per-subsystem estimates of the big
+structures, soft budgets that shed caches when exceeded, and heap snapshots on demand through the admin API"""
+
+import gc
+import json
+import sys
+import time
+from logging import getLogger
+from twisted.internet import task
+from twisted.web.resource import Resource
+from metrics import REGISTRY
+
+LOGGER = getLogger("main")
+
+RSS = REGISTRY.gauge("treater_memory_rss_bytes", "Resident set size of the treater process")
+RSS_HIGH_WATER = REGISTRY.gauge("treater_memory_rss_high_water_bytes", "Peak resident set size of the treater process")
+
+MEGABYTE = 1024 * 1024
+# After shedding for the RSS budget, nothing more is shed until RSS has fallen below this fraction of the budget
+RSS_REARM_FRACTION = 0.9
+SNAPSHOT_TOP = 30
+
+def readProcStatus(path = "/proc/self/status"):
+    """(rss, high water rss) in bytes, or (None, None) where /proc is unavailable"""
+    values = {}
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                (name, sep, value) = line.partition(":")
+                if name in ("VmRSS", "VmHWM"):
+                    values[name] = int(value.split()[0]) * 1024
+    except (IOError, ValueError):
+        pass
+    return (values.get("VmRSS"), values.get("VmHWM"))
+
+class Subsystem:
+    def __init__(self, name, measure, shed):
+        self.name = name
+        self.measure = measure
+        self.shed = shed
+        self.budget = None
+        self.bytes = 0
+        self.count = 0
+        self.sheds = 0
+        self.gauge = REGISTRY.gauge("treater_memory_subsystem_bytes", "Estimated memory held by a subsystem's big structures",
+                                    {"subsystem": name})
+        self.shedCounter = REGISTRY.counter("treater_memory_sheds_total", "Times a subsystem was asked to shed its caches",
+                                            {"subsystem": name})
+
+    def update(self):
+        try:
+            (self.bytes, self.count) = self.measure()
+        except Exception:
+            LOGGER.exception("Unable to measure memory used by %s" % self.name)
+        self.gauge.set(self.bytes)
+
+    def describe(self):
+        return {"bytes": self.bytes, "count": self.count, "budgetBytes": self.budget, "sheddable": self.shed is not None,
+                "sheds": self.sheds}
+
+class MemoryAccounting:
+    """Subsystems register measure() returning (estimated bytes, item count), and optionally shed(), which drops what
+    can be rebuilt or done without"""
+
+    def __init__(self):
+        self.subsystems = {}
+        self.rss = None
+        self.highWater = None
+
+    def register(self, name, measure, shed = None):
+        budget = self.subsystems[name].budget if name in self.subsystems else None
+        subsystem = Subsystem(name, measure, shed)
+        subsystem.budget = budget
+        self.subsystems[name] = subsystem
+        return subsystem
+
+    def setBudget(self, name, budgetBytes):
+        if name not in self.subsystems:
+            # Budgets may be configured before the subsystem exists
+            self.register(name, lambda: (0, 0))
+        self.subsystems[name].budget = budgetBytes
+
+    def update(self):
+        (rss, highWater) = readProcStatus()
+        if rss is not None:
+            self.rss = rss
+            self.highWater = max(highWater or rss, self.highWater or 0)
+            RSS.set(rss)
+            RSS_HIGH_WATER.set(self.highWater)
+        for subsystem in self.subsystems.values():
+            subsystem.update()
+
+    def shed(self, subsystem, reason):
+        if subsystem.shed is None:
+            return
+        before = subsystem.bytes
+        try:
+            subsystem.shed()
+        except Exception:
+            LOGGER.exception("Unable to shed caches of %s" % subsystem.name)
+            return
+        subsystem.sheds += 1
+        subsystem.shedCounter.inc()
+        subsystem.update()
+        LOGGER.info("Shed %s (%s): %d -> %d bytes" % (subsystem.name, reason, before, subsystem.bytes))
+
+    def shedAll(self, reason):
+        # Largest first, since that frees the most for the least disruption
+        for subsystem in sorted(self.subsystems.values(), key=lambda s: s.bytes, reverse=True):
+            if subsystem.bytes or subsystem.count:
+                self.shed(subsystem, reason)
+        gc.collect()
+
+    def describe(self):
+        return {
+            "rssBytes": self.rss,
+            "rssHighWaterBytes": self.highWater,
+            "gcCounts": gc.get_count(),
+            "subsystems": dict((name, s.describe()) for (name, s) in self.subsystems.items())}
+
+MEMORY = MemoryAccounting()
+
+def parseBudgets(text):
+    """Budgets are whitespace or comma separated name=megabytes"""
+    budgets = {}
+    for item in text.replace(",", " ").split():
+        (name, sep, megabytes) = item.partition("=")
+        if not sep:
+            raise ValueError("Memory budget %r is not name=megabytes" % item)
+        budgets[name] = int(float(megabytes) * MEGABYTE)
+    return budgets
+
+class MemoryConfig:
+    SECTION_NAME = "memory"
+
+    def __init__(self, config = None):
+        self.checkIntervalSeconds = 30.0
+        self.rssSoftBudgetMB = 0
+        self.subsystemBudgets = {}
+        self.tracemallocFrames = 0
+        if config:
+            self.load(config)
+
+    def load(self, config):
+        sec = MemoryConfig.SECTION_NAME
+        self.checkIntervalSeconds = config.getfloat(sec, "checkIntervalSeconds")
+        self.rssSoftBudgetMB = config.getfloat(sec, "rssSoftBudgetMB")
+        self.subsystemBudgets = parseBudgets(config.get(sec, "subsystemBudgets"))
+        self.tracemallocFrames = config.getint(sec, "tracemallocFrames")
+
+class MemoryMonitor:
+    def __init__(self, reactor, config, accounting = MEMORY):
+        self.reactor = reactor
+        self.config = config
+        self.accounting = accounting
+        self.overBudget = False
+        self.snapshot = None
+        self.previousSnapshot = None
+        for (name, budget) in config.subsystemBudgets.items():
+            accounting.setBudget(name, budget)
+        self.loop = task.LoopingCall(self.check)
+        self.loop.clock = reactor
+        self.tracemalloc = None
+        if config.tracemallocFrames > 0:
+            try:
+                import tracemalloc
+                tracemalloc.start(config.tracemallocFrames)
+                self.tracemalloc = tracemalloc
+            except ImportError:
+                LOGGER.warning("tracemalloc is not available; heap snapshots will be object censuses")
+
+    def __str__(self):
+        return "MemoryMonitor"
+
+    def start(self):
+        self.loop.start(self.config.checkIntervalSeconds)
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+    def check(self):
+        accounting = self.accounting
+        accounting.update()
+        for subsystem in accounting.subsystems.values():
+            if subsystem.budget is not None and subsystem.bytes > subsystem.budget:
+                accounting.shed(subsystem, "over its %d byte budget" % subsystem.budget)
+        budget = self.config.rssSoftBudgetMB * MEGABYTE
+        if not budget or accounting.rss is None:
+            self.overBudget = False
+        elif not self.overBudget and accounting.rss > budget:
+            # Once per crossing: freed memory rarely goes back to the OS, so RSS may stay over for good, and shedding
+            # on every check would keep closing capture files and resetting the motion baseline
+            LOGGER.warning("RSS of %d MB is over the %g MB soft budget; shedding caches" % (
+                accounting.rss // MEGABYTE, self.config.rssSoftBudgetMB))
+            accounting.shedAll("RSS over budget")
+            self.overBudget = True
+        elif self.overBudget and accounting.rss < budget * RSS_REARM_FRACTION:
+            LOGGER.info("RSS of %d MB is back within the soft budget" % (accounting.rss // MEGABYTE))
+            self.overBudget = False
+
+    def getStatus(self):
+        self.accounting.update()
+        status = self.accounting.describe()
+        status["overBudget"] = self.overBudget
+        status["rssSoftBudgetBytes"] = int(self.config.rssSoftBudgetMB * MEGABYTE) or None
+        status["snapshotKind"] = "tracemalloc" if self.tracemalloc is not None else "census"
+        return status
+
+    def takeSnapshot(self):
+        """Returns the top allocation sites (tracemalloc) or object types (census), with the change since the
+        previous snapshot"""
+        start = time.time()
+        if self.tracemalloc is not None:
+            snapshot = self.tracemalloc.take_snapshot()
+            entries = dict(("%s:%d" % (stat.traceback[0].filename, stat.traceback[0].lineno), (stat.size, stat.count))
+                           for stat in snapshot.statistics("lineno"))
+        else:
+            entries = objectCensus()
+        self.previousSnapshot = self.snapshot
+        self.snapshot = entries
+        previous = self.previousSnapshot or {}
+        top = sorted(entries.items(), key=lambda item: item[1][0], reverse=True)[:SNAPSHOT_TOP]
+        growth = sorted(((key, size - previous.get(key, (0, 0))[0], count - previous.get(key, (0, 0))[1])
+                         for (key, (size, count)) in entries.items()), key=lambda item: item[1], reverse=True)
+        return {
+            "kind": "tracemalloc" if self.tracemalloc is not None else "census",
+            "seconds": time.time() - start,
+            "top": [{"key": key, "bytes": size, "count": count} for (key, (size, count)) in top],
+            "growth": [{"key": key, "bytes": size, "count": count} for (key, size, count) in growth[:SNAPSHOT_TOP]
+                       if size > 0] if self.previousSnapshot is not None else []}
+
+def objectCensus():
+    """{type name: (shallow bytes, count)} over the objects the garbage collector tracks. Strings and other atomic
+    objects are only counted when a container is found holding them directly"""
+    census = {}
+    seen = set()
+    def add(obj):
+        name = type(obj).__name__
+        (size, count) = census.get(name, (0, 0))
+        census[name] = (size + sys.getsizeof(obj, 0), count + 1)
+    for obj in gc.get_objects():
+        add(obj)
+        if isinstance(obj, (list, tuple, dict)):
+            for item in (obj.itervalues() if isinstance(obj, dict) else obj):
+                if isinstance(item, (str, unicode, bytearray)) and id(item) not in seen:
+                    seen.add(id(item))
+                    add(item)
+    return census
+
+class AdminMemoryResource(Resource):
+    """GET: RSS, high water and per-subsystem accounting. POST snapshot: take a heap snapshot and return its top
+    entries and growth since the last one. POST shed: shed every subsystem's caches now"""
+
+    def __init__(self, monitor):
+        Resource.__init__(self)
+        self.monitor = monitor
+
+    def getChild(self, name, request):
+        if name == "":
+            return self
+        return MemoryActionResource(self.monitor, name)
+
+    def render_GET(self, request):
+        request.defaultContentType = b"application/json"
+        return json.dumps(self.monitor.getStatus())
+
+class MemoryActionResource(Resource):
+    isLeaf = True
+
+    def __init__(self, monitor, action):
+        Resource.__init__(self)
+        self.monitor = monitor
+        self.action = action
+
+    def render_POST(self, request):
+        request.defaultContentType = b"application/json"
+        if self.action == "snapshot":
+            return json.dumps(self.monitor.takeSnapshot())
+        if self.action == "shed":
+            self.monitor.accounting.update()
+            self.monitor.accounting.shedAll("requested")
+            return json.dumps(self.monitor.getStatus())
+        request.setResponseCode(404)
+        return "No such memory action"
+
+def startMemoryMonitor(reactor, config):
+    monitor = MemoryMonitor(reactor, config)
+    monitor.start()
+    return monitor
+
+if __name__ == "__main__":
+    from twisted.internet import reactor
+    cache = {}
+    MEMORY.register("demoCache", lambda: (sum(len(v) for v in cache.values()), len(cache)), cache.clear)
+    config = MemoryConfig()
+    config.subsystemBudgets = {"demoCache": 4 * MEGABYTE}
+    monitor = MemoryMonitor(reactor, config)
+    monitor.takeSnapshot()
+    for n in range(8):
+        cache[n] = b"x" * MEGABYTE
+    monitor.check()
+    status = monitor.getStatus()
+    print("RSS %d MB, high water %d MB; demoCache %d bytes after %d shed" % (
+        status["rssBytes"] // MEGABYTE, status["rssHighWaterBytes"] // MEGABYTE,
+        status["subsystems"]["demoCache"]["bytes"], status["subsystems"]["demoCache"]["sheds"]))
+    for entry in monitor.takeSnapshot()["growth"][:5]:
+        print("%-20s %+10d bytes %+6d objects" % (entry["key"], entry["bytes"], entry["count"]))
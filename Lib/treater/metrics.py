@@ -0,0 +1,166 @@
+#!/usr/bin/python
+
+# treater/metrics.py
+
+"""Lightweight counters, gauges and histograms, rendered in the Prometheus text exposition format"""
+
+from bisect import bisect_left
+
+CONTENT_TYPE = b"text/plain; version=0.0.4; charset=utf-8"
+
+# Bucket upper bounds (seconds) suitable for most of the latencies measured by the treater
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def formatLabels(labels, extra = None):
+    items = sorted(labels.items()) if labels else []
+    if extra:
+        items.append(extra)
+    if not items:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, escapeLabelValue(v)) for (k, v) in items) + "}"
+
+def escapeLabelValue(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def formatValue(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return repr(int(value))
+    return repr(value)
+
+class Metric:
+    TYPE = None
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        # Labels are formatted once, so that rendering never rebuilds them per sample
+        self.labelStr = formatLabels(labels)
+
+    def samples(self):
+        raise NotImplementedError()
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def __init__(self, name, help, labels = None):
+        Metric.__init__(self, name, help, labels)
+        self.value = 0
+
+    def inc(self, amount = 1):
+        self.value += amount
+
+    def samples(self):
+        return [(self.name + self.labelStr, self.value)]
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def __init__(self, name, help, labels = None):
+        Metric.__init__(self, name, help, labels)
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount = 1):
+        self.value += amount
+
+    def dec(self, amount = 1):
+        self.value -= amount
+
+    def setFunction(self, function):
+        """Have the gauge report the result of calling function at render time instead of a stored value"""
+        self.function = function
+
+    def samples(self):
+        value = self.function() if self.function is not None else self.value
+        return [(self.name + self.labelStr, value)]
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name, help, buckets = DEFAULT_BUCKETS, labels = None):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # One slot per bucket plus the +Inf overflow slot, allocated once up front
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.bucketLabelStrs = [formatLabels(labels, ("le", formatValue(float(b)))) for b in self.buckets]
+        self.bucketLabelStrs.append(formatLabels(labels, ("le", "+Inf")))
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        result = []
+        cumulative = 0
+        for (i, labelStr) in enumerate(self.bucketLabelStrs):
+            cumulative += self.counts[i]
+            result.append((self.name + "_bucket" + labelStr, cumulative))
+        result.append((self.name + "_sum" + self.labelStr, self.sum))
+        result.append((self.name + "_count" + self.labelStr, self.count))
+        return result
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.metrics = {}
+        self.names = []
+
+    def __str__(self):
+        return "MetricsRegistry"
+
+    def counter(self, name, help, labels = None):
+        return self.register(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels = None):
+        return self.register(Gauge, name, help, labels)
+
+    def histogram(self, name, help, buckets = DEFAULT_BUCKETS, labels = None):
+        return self.register(Histogram, name, help, labels, buckets = buckets)
+
+    def register(self, metricClass, name, help, labels, **kwargs):
+        key = (name, tuple(sorted(labels.items())) if labels else ())
+        metric = self.metrics.get(key)
+        if metric is not None:
+            if not isinstance(metric, metricClass):
+                raise Exception("Metric %s is already registered as a %s" % (name, metric.TYPE))
+            return metric
+        metric = metricClass(name, help, labels = labels, **kwargs)
+        self.metrics[key] = metric
+        if name not in self.names:
+            self.names.append(name)
+        return metric
+
+    def render(self):
+        families = {}
+        for metric in self.metrics.values():
+            families.setdefault(metric.name, []).append(metric)
+        lines = []
+        for name in self.names:
+            family = sorted(families[name], key=lambda m: m.labelStr)
+            lines.append("# HELP %s %s" % (name, family[0].help))
+            lines.append("# TYPE %s %s" % (name, family[0].TYPE))
+            for metric in family:
+                for (sampleName, value) in metric.samples():
+                    lines.append("%s %s" % (sampleName, formatValue(value)))
+        lines.append("")
+        return "\n".join(lines)
+
+# Process-wide registry that all of the treater subsystems report into
+REGISTRY = MetricsRegistry()
+
+if __name__ == "__main__":
+    requests = REGISTRY.counter("example_requests_total", "Example request counter", {"resource": "getStatus"})
+    latency = REGISTRY.histogram("example_latency_seconds", "Example latency histogram")
+    requests.inc()
+    latency.observe(0.003)
+    latency.observe(0.2)
+    print(REGISTRY.render())
@@ -0,0 +1,245 @@
+#!/usr/bin/python
+
+# treater/microbench.py
+
+"""Micro-benchmarks of the code that runs constantly: GPIO pin access, treat history statistics, LCD updates, motion
+frame analysis and status serialization. Results are saved as JSON and compared against a baseline with
+benchresults, so that a change which slows any of them down fails the run"""
+
+import fnmatch
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from cStringIO import StringIO
+from datetime import datetime, timedelta
+from timeit import default_timer
+from benchresults import saveResults, loadResults, compareResults, formatRegressions
+
+COMPARED_METRICS = ("secondsPerOp",)
+HISTORY_SIZES = (1000, 100000, 1000000)
+
+def measure(operation, minSeconds = 0.1, repeats = 5):
+    """Times operation() in batches of calls, sized so that a batch takes at least minSeconds. The best batch is
+    the figure compared against the baseline; the median shows how noisy the run was"""
+    batch = 1
+    while True:
+        start = default_timer()
+        for i in xrange(batch):
+            operation()
+        elapsed = default_timer() - start
+        if elapsed >= minSeconds:
+            break
+        batch *= 2 if elapsed == 0 else max(2, min(10, int(minSeconds / elapsed) + 1))
+    perOp = [elapsed / batch]
+    for run in range(repeats - 1):
+        start = default_timer()
+        for i in xrange(batch):
+            operation()
+        perOp.append((default_timer() - start) / batch)
+    perOp.sort()
+    return {"secondsPerOp": perOp[0], "median": perOp[len(perOp) // 2], "batch": batch}
+
+def benchGpio(results, workDir):
+    """readPin and writePin against a fake sysfs tree, in tmpfs when /dev/shm is available"""
+    from gpiosys import GPIO
+    root = tempfile.mkdtemp(prefix="treater-gpio-", dir="/dev/shm" if os.path.isdir("/dev/shm") else workDir)
+
+    class FakeSysfsGPIO(GPIO):
+        GPIO_PATH = root + "/"
+        EXPORT_PATH = GPIO_PATH + "export"
+        UNEXPORT_PATH = GPIO_PATH + "unexport"
+        PIN_PATH = GPIO_PATH + "gpio%d/"
+        DIRECTION_PATH = PIN_PATH + "direction"
+        EDGE_PATH = PIN_PATH + "edge"
+        VALUE_PATH = PIN_PATH + "value"
+        pins = {}
+
+    try:
+        gpio = FakeSysfsGPIO()
+        for (pinNumber, pinType) in ((17, GPIO.IN), (25, GPIO.OUT)):
+            os.mkdir(FakeSysfsGPIO.PIN_PATH % pinNumber)
+            for (name, value) in (("direction", pinType), ("value", "0\n")):
+                with open(os.path.join(FakeSysfsGPIO.PIN_PATH % pinNumber, name), "w") as f:
+                    f.write(value)
+            gpio.pins[pinNumber] = GPIO.Pin(pinNumber, pinType)
+        results["gpio.readPin"] = measure(lambda: gpio.readPin(17))
+        values = [0, 1]
+        results["gpio.writePin"] = measure(lambda: gpio.writePin(25, values.reverse() or values[0]))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def benchHistory(results, sizes):
+    """getTreatStats and updateLast24Hours over histories of each size, all within the last 24 hours so that
+    updateLast24Hours measures its steady state"""
+    from history import TreatHistory, TreatEvent
+    for size in sizes:
+        history = TreatHistory()
+        now = datetime.now()
+        # Shared datetimes keep the million event history to a few hundred megabytes
+        times = [now - timedelta(hours=23) + timedelta(seconds=s) for s in range(3600)]
+        history.treatEvents = [TreatEvent(times[n * len(times) // size], 3) for n in xrange(size)]
+        results["history.getTreatStats[%d]" % size] = measure(history.getTreatStats)
+        results["history.updateLast24Hours[%d]" % size] = measure(history.updateLast24Hours)
+        history.treatEvents = []
+        del history
+
+def benchLcd(results):
+    """writeBothLines on a blocking SerialLCD whose device is a pty, drained by a thread"""
+    from seriallcd import SerialLCD
+    from standins import PtyLCD
+    display = PtyLCD()
+    running = [True]
+
+    def drain():
+        import select
+        while running[0]:
+            if select.select([display.master], [], [], 0.1)[0]:
+                display.drain()
+
+    drainer = threading.Thread(target=drain)
+    drainer.daemon = True
+    drainer.start()
+    lcd = SerialLCD(9600, display.deviceName)
+    lcd.clear()
+    count = [0]
+
+    def update():
+        count[0] += 1
+        lcd.writeBothLines("Treats : %d/%d" % (count[0] % 100, count[0] % 30), "Last   : 0h %dm" % (count[0] % 60))
+    try:
+        results["lcd.writeBothLines"] = measure(update)
+    finally:
+        running[0] = False
+        drainer.join()
+        lcd.close()
+        os.close(display.master)
+        os.close(display.slave)
+
+def syntheticFramePair(size = (100, 75)):
+    """Two BMP frames as raspistill produces them, the second with a bright square that the first lacks"""
+    from PIL import Image
+    (width, height) = size
+    frames = []
+    for moved in (False, True):
+        image = Image.new("RGB", size)
+        image.putdata([((40 + (x * 150) // width),) * 3 for y in range(height) for x in range(width)])
+        if moved:
+            image.paste((230, 230, 230), (40, height // 3, 60, height // 3 + 20))
+        buf = StringIO()
+        image.save(buf, "BMP")
+        frames.append(buf.getvalue())
+    return frames
+
+def benchMotionCapture(results, workDir):
+    """raspicam.TreatCam.motionCapture, analysing inline, on frames that alternate so that every call finds motion"""
+    from twisted.internet import reactor
+    from raspicam import TreatCam, TreatCamConfig
+    config = TreatCamConfig()
+    config.captureDir = workDir
+    config.motionAnalysisProcesses = 0
+    camera = TreatCam(reactor, config)
+    frames = syntheticFramePair()
+    count = [0]
+
+    def capture():
+        count[0] += 1
+        camera.motionCapture((frames[count[0] % 2], "", 0))
+    results["raspicam.motionCapture"] = measure(capture)
+    camera.motionPool.close()
+    camera.activity.close()
+
+def benchGetStatus(results):
+    """ApiGetStatus rendering (getStatus and its JSON serialization) with a day of treat history"""
+    from twisted.internet import reactor
+    from twisted.web.test.requesthelper import DummyRequest
+    from history import TreatEvent
+    from standins import StandInTreatMachine, StandInTreatCam
+    from website import ApiGetStatus, TreatWebConfig
+    machine = StandInTreatMachine(reactor)
+    now = datetime.now()
+    machine.history.treatEvents = [TreatEvent(now - timedelta(minutes=15 * n), 3) for n in range(95, -1, -1)]
+    camera = StandInTreatCam(reactor)
+    camera.lastCaptureName = "capture-20200101-120000.jpg"
+    camera.lastCaptureTime = now
+    resource = ApiGetStatus(TreatWebConfig(), machine, camera)
+    request = DummyRequest([b""])
+    results["web.getStatus"] = measure(lambda: resource.render_GET(request))
+
+BENCHMARKS = ("gpio", "history", "lcd", "motion", "status")
+
+def runBenchmarks(selected, historySizes):
+    results = {}
+    workDir = tempfile.mkdtemp(prefix="treater-bench-")
+    try:
+        if "gpio" in selected:
+            benchGpio(results, workDir)
+        if "history" in selected:
+            benchHistory(results, historySizes)
+        if "lcd" in selected:
+            benchLcd(results)
+        if "motion" in selected:
+            benchMotionCapture(results, workDir)
+        if "status" in selected:
+            benchGetStatus(results)
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+    return results
+
+def parseThresholds(specs):
+    """[(pattern, fraction)] from "pattern=fraction" arguments, patterns being fnmatch globs of benchmark names"""
+    thresholds = []
+    for spec in specs:
+        (pattern, sep, fraction) = spec.rpartition("=")
+        if not sep:
+            raise ValueError("Threshold %r is not pattern=fraction" % spec)
+        thresholds.append((pattern, float(fraction)))
+    return thresholds
+
+def findRegressions(results, baseline, threshold, thresholds):
+    """As benchresults.compareResults, with the last matching pattern's threshold overriding the default"""
+    regressions = []
+    for name in sorted(results):
+        allowed = threshold
+        for (pattern, fraction) in thresholds:
+            if fnmatch.fnmatchcase(name, pattern):
+                allowed = fraction
+        regressions.extend(compareResults({name: results[name]}, baseline, allowed, COMPARED_METRICS))
+    return regressions
+
+def sortKey(name):
+    # History sizes in numeric order
+    (base, sep, size) = name.partition("[")
+    return (base, int(size.rstrip("]")) if sep else 0)
+
+def report(results):
+    for name in sorted(results, key=sortKey):
+        r = results[name]
+        print("%-36s %10.2f us/op  (median %.2f us, %d per batch)" % (name, r["secondsPerOp"] * 1e6, r["median"] * 1e6,
+                                                                       r["batch"]))
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description = "Micro-benchmark the treater hot paths, optionally against a baseline")
+    parser.add_argument("--benchmarks", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS))
+    parser.add_argument("--history-sizes", nargs="+", type=int, default=list(HISTORY_SIZES),
+                        help="treat history lengths to benchmark")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="compare results against this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed regression as a fraction of the baseline")
+    parser.add_argument("--threshold-for", nargs="+", default=[], metavar="PATTERN=FRACTION",
+                        help="allowed regression for benchmarks matching a glob, e.g. 'lcd.*=0.5'")
+    args = parser.parse_args()
+
+    thresholds = parseThresholds(args.threshold_for)
+    results = runBenchmarks(args.benchmarks, args.history_sizes)
+    report(results)
+    if args.output:
+        saveResults(args.output, "microbench", results)
+    if args.baseline:
+        regressions = findRegressions(results, loadResults(args.baseline), args.threshold, thresholds)
+        if regressions:
+            print(formatRegressions(regressions))
+            sys.exit(1)
+        print("No regressions against %s" % args.baseline)
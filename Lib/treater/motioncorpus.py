@@ -0,0 +1,286 @@
+#!/usr/bin/python
+
+# treater/motioncorpus.py
+
+"""Recorded motion-frame corpora, and a harness that replays them through the raspicam motion detector to measure
+its speed, and its precision and recall against hand labels"""
+
+import os
+import random
+import struct
+import sys
+import time
+import zlib
+from cStringIO import StringIO
+
+# File header, then one record per frame: capture time, compressed length, then the zlib-compressed frame
+MAGIC = b"TRMOTION"
+VERSION = 1
+HEADER = struct.Struct("<8sB")
+RECORD = struct.Struct("<dI")
+
+MOTION = "motion"
+STILL = "still"
+
+class CorpusWriter:
+    """Appends frames to a corpus file, creating it if needed. Each frame is flushed as it is written, so a
+    recording cut short by a restart is still readable"""
+
+    def __init__(self, path):
+        exists = os.path.isfile(path) and os.path.getsize(path) > 0
+        if exists:
+            with open(path, "rb") as f:
+                checkHeader(f, path)
+        self.file = open(path, "ab")
+        if not exists:
+            self.file.write(HEADER.pack(MAGIC, VERSION))
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def write(self, timestamp, frame):
+        data = zlib.compress(frame, 6)
+        self.file.write(RECORD.pack(timestamp, len(data)) + data)
+        self.file.flush()
+
+def checkHeader(f, path):
+    header = f.read(HEADER.size)
+    if len(header) != HEADER.size or HEADER.unpack(header) != (MAGIC, VERSION):
+        raise ValueError("%s is not a version %d motion corpus" % (path, VERSION))
+
+def readCorpus(path):
+    """Yields (timestamp, frame) for each complete frame in the corpus"""
+    with open(path, "rb") as f:
+        checkHeader(f, path)
+        while True:
+            record = f.read(RECORD.size)
+            if len(record) < RECORD.size:
+                return
+            (timestamp, length) = RECORD.unpack(record)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield (timestamp, zlib.decompress(data))
+
+def labelsPath(corpusPath):
+    return corpusPath + ".labels"
+
+def loadLabels(path):
+    """Labels are lines of "<frame>[-<last frame>] motion|still", frames numbered from 0. Frames that are not
+    labelled are left out of precision and recall. Returns {frame: True for motion}"""
+    labels = {}
+    if not os.path.isfile(path):
+        return labels
+    with open(path, "r") as f:
+        for (lineNumber, line) in enumerate(f, 1):
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            try:
+                (frames, label) = line.split()
+                (first, _, last) = frames.partition("-")
+                first = int(first)
+                last = int(last) if last else first
+                if label not in (MOTION, STILL):
+                    raise ValueError(label)
+            except ValueError:
+                raise ValueError("%s line %d: expected '<frame>[-<last frame>] motion|still'" % (path, lineNumber))
+            for frame in range(first, last + 1):
+                labels[frame] = label == MOTION
+    return labels
+
+def replay(corpusPath, threshold, sensitivity, repeat = 1):
+    """Feeds every frame through a fresh MotionDetector as fast as possible. Frames are decompressed beforehand,
+    so only the detector itself (decode and diff) is timed"""
+    from raspicam import MotionDetector
+    frames = [frame for (timestamp, frame) in readCorpus(corpusPath)]
+    labels = loadLabels(labelsPath(corpusPath))
+    predictions = []
+    cpuStart = sum(os.times()[:2])
+    wallStart = time.time()
+    for run in range(repeat):
+        detector = MotionDetector(threshold)
+        predictions = [detector.detect(frame) > sensitivity for frame in frames]
+    wallSeconds = time.time() - wallStart
+    cpuSeconds = sum(os.times()[:2]) - cpuStart
+    processed = len(frames) * repeat
+
+    truePositives = falsePositives = falseNegatives = 0
+    for (index, predicted) in enumerate(predictions):
+        if index not in labels:
+            continue
+        if predicted and labels[index]:
+            truePositives += 1
+        elif predicted:
+            falsePositives += 1
+        elif labels[index]:
+            falseNegatives += 1
+    results = {
+        "frames": len(frames),
+        "labelledFrames": len([i for i in labels if i < len(frames)]),
+        "fps": processed / wallSeconds if wallSeconds else 0.0,
+        "cpuPerFrame": cpuSeconds / processed if processed else 0.0,
+        "motionFrames": predictions.count(True)}
+    if labels:
+        results["precision"] = float(truePositives) / (truePositives + falsePositives) if truePositives + falsePositives else 1.0
+        results["recall"] = float(truePositives) / (truePositives + falseNegatives) if truePositives + falseNegatives else 1.0
+    return results
+
+def measurePollJitter(corpusPath, threshold, processes, maxWaiting, framesPerSecond, seconds, pollSeconds = 0.02):
+    """Runs a treat-detector style poll every pollSeconds on the reactor while frames from the corpus are submitted
+    to a MotionAnalysisPool at framesPerSecond, cycling through the corpus. Returns the poll lateness summary (in
+    seconds) and the frame counts"""
+    from twisted.internet import reactor
+    from motionpool import MotionAnalysisPool
+    from benchresults import summarizeLatencies
+
+    frames = [frame for (timestamp, frame) in readCorpus(corpusPath)]
+    pool = MotionAnalysisPool(reactor, threshold, processes, maxWaiting)
+    counts = {"submitted": 0, "analysed": 0, "dropped": 0}
+    lateness = []
+    start = time.time()
+    state = {"lastPoll": start}
+
+    def poll():
+        now = time.time()
+        lateness.append(max(0.0, now - state["lastPoll"] - pollSeconds))
+        state["lastPoll"] = now
+        if now - start < seconds:
+            reactor.callLater(pollSeconds, poll)
+
+    def analysed(changedPixels):
+        counts["analysed" if changedPixels is not None else "dropped"] += 1
+
+    def feed():
+        if time.time() - start >= seconds:
+            pool.close()
+            reactor.callLater(pollSeconds * 2, reactor.stop)
+            return
+        pool.submit(frames[counts["submitted"] % len(frames)]).addCallback(analysed)
+        counts["submitted"] += 1
+        reactor.callLater(1.0 / framesPerSecond, feed)
+
+    reactor.callLater(pollSeconds, poll)
+    reactor.callWhenRunning(feed)
+    reactor.run()
+    results = summarizeLatencies(lateness)
+    results.update(counts)
+    return results
+
+def synthesize(path, frameCount = 200, size = (100, 75), seed = 1):
+    """Writes a labelled corpus of noisy frames, with a bright square crossing the view in some stretches, for
+    trying out the harness without a camera"""
+    from PIL import Image
+    generator = random.Random(seed)
+    (width, height) = size
+    background = [(40 + (x * 150) // width + generator.randint(-2, 2)) for y in range(height) for x in range(width)]
+    writer = CorpusWriter(path)
+    labelLines = []
+    segmentStart = 0
+    moving = False
+    position = 0
+    for frame in range(frameCount):
+        # Alternate still and moving stretches of 10 to 30 frames
+        if frame == segmentStart:
+            labelStart = frame
+            segmentLength = generator.randint(10, 30)
+            segmentStart = frame + segmentLength
+            moving = not moving and frame > 0
+            position = 0
+            labelLines.append("%d-%d %s" % (labelStart, min(segmentStart, frameCount) - 1, MOTION if moving else STILL))
+        image = Image.new("RGB", size)
+        pixels = [(value + generator.randint(-3, 3),) * 3 for value in background]
+        image.putdata(pixels)
+        if moving:
+            position += 5
+            left = position % (width - 20)
+            image.paste((230, 230, 230), (left, height // 3, left + 20, height // 3 + 20))
+        buf = StringIO()
+        image.save(buf, "BMP")
+        writer.write(time.time() + frame * 0.5, buf.getvalue())
+    writer.close()
+    with open(labelsPath(path), "w") as f:
+        f.write("\n".join(labelLines) + "\n")
+
+def export(corpusPath, directory):
+    """Writes each frame out as frame-NNNNNN.bmp, for labelling by eye"""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    count = 0
+    for (index, (timestamp, frame)) in enumerate(readCorpus(corpusPath)):
+        with open(os.path.join(directory, "frame-%06d.bmp" % index), "wb") as f:
+            f.write(frame)
+        count += 1
+    return count
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    from benchresults import saveResults, loadResults, compareResults, formatRegressions
+
+    parser = ArgumentParser(description = "Motion detection corpus tools and replay benchmark")
+    commands = parser.add_subparsers(dest = "command")
+    replayParser = commands.add_parser("replay", help = "replay a corpus through the motion detector")
+    replayParser.add_argument("corpus")
+    replayParser.add_argument("--threshold", type=int, default=10, help="as [camera] motionThreshold")
+    replayParser.add_argument("--sensitivity", type=int, default=30, help="as [camera] motionSensitivity")
+    replayParser.add_argument("--repeat", type=int, default=1, help="replay the corpus this many times")
+    replayParser.add_argument("--output", help="write results to this JSON file")
+    replayParser.add_argument("--baseline", help="compare results against this JSON file")
+    replayParser.add_argument("--threshold-regression", type=float, default=0.2, dest="regression",
+                              help="allowed regression as a fraction of the baseline")
+    synthesizeParser = commands.add_parser("synthesize", help = "write a labelled synthetic corpus")
+    synthesizeParser.add_argument("corpus")
+    synthesizeParser.add_argument("--frames", type=int, default=200)
+    exportParser = commands.add_parser("export", help = "write each frame of a corpus as a BMP file")
+    exportParser.add_argument("corpus")
+    exportParser.add_argument("directory")
+    jitterParser = commands.add_parser("jitter", help = "check that treat poll jitter stays bounded during motion analysis")
+    jitterParser.add_argument("corpus")
+    jitterParser.add_argument("--threshold", type=int, default=10, help="as [camera] motionThreshold")
+    jitterParser.add_argument("--processes", type=int, default=1, help="as [camera] motionAnalysisProcesses")
+    jitterParser.add_argument("--max-waiting", type=int, default=1, help="as [camera] motionAnalysisMaxWaiting")
+    jitterParser.add_argument("--fps", type=float, default=20, help="rate at which frames are submitted")
+    jitterParser.add_argument("--seconds", type=float, default=10)
+    jitterParser.add_argument("--max-jitter-ms", type=float, default=10, help="fail if p99 poll lateness exceeds this")
+    infoParser = commands.add_parser("info", help = "describe a corpus")
+    infoParser.add_argument("corpus")
+    args = parser.parse_args()
+
+    if args.command == "synthesize":
+        synthesize(args.corpus, args.frames)
+        print("Wrote %d frames to %s, labels to %s" % (args.frames, args.corpus, labelsPath(args.corpus)))
+    elif args.command == "export":
+        print("Exported %d frames" % export(args.corpus, args.directory))
+    elif args.command == "jitter":
+        results = measurePollJitter(args.corpus, args.threshold, args.processes, args.max_waiting, args.fps, args.seconds)
+        print("%d frames submitted, %d analysed, %d dropped as stale" % (results["submitted"], results["analysed"],
+                                                                        results["dropped"]))
+        print("Poll lateness: p50 %.1f ms, p99 %.1f ms, max %.1f ms" % (results["p50"] * 1000, results["p99"] * 1000,
+                                                                       results["max"] * 1000))
+        if results["p99"] * 1000 > args.max_jitter_ms:
+            print("FAIL: p99 poll lateness is over %.1f ms" % args.max_jitter_ms)
+            sys.exit(1)
+        print("PASS")
+    elif args.command == "info":
+        timestamps = [timestamp for (timestamp, frame) in readCorpus(args.corpus)]
+        labels = loadLabels(labelsPath(args.corpus))
+        span = timestamps[-1] - timestamps[0] if timestamps else 0
+        print("%d frames over %.0f seconds, %d labelled (%d motion)" % (len(timestamps), span, len(labels),
+                                                                        labels.values().count(True)))
+    else:
+        results = replay(args.corpus, args.threshold, args.sensitivity, args.repeat)
+        print("%d frames, %.1f frames/s, %.2f ms CPU per frame, %d detected as motion" % (
+            results["frames"], results["fps"], results["cpuPerFrame"] * 1000, results["motionFrames"]))
+        if "precision" in results:
+            print("Precision %.3f, recall %.3f over %d labelled frames" % (results["precision"], results["recall"],
+                                                                          results["labelledFrames"]))
+        summaries = {"motionDetection": results}
+        if args.output:
+            saveResults(args.output, "motioncorpus", summaries)
+        if args.baseline:
+            regressions = compareResults(summaries, loadResults(args.baseline), args.regression,
+                                         ("fps", "cpuPerFrame", "precision", "recall"))
+            if regressions:
+                print(formatRegressions(regressions))
+                sys.exit(1)
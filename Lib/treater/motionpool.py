@@ -0,0 +1,236 @@
+#!/usr/bin/python
+
+# treater/motionpool.py
+
+"""Runs motion frame decode and diff in a worker process, so that a slow frame never delays the reactor (and with it
+the 20 ms treat detector poll). The worker keeps the previous decoded frame, so each frame is sent and decoded once.
+When the worker falls behind, frames waiting for it are dropped as stale in favour of newer ones. A worker that dies
+or hangs on a frame is replaced, and the frame counts as not analysed"""
+
+import os
+import signal
+import threading
+import time
+from collections import deque
+from logging import getLogger
+from multiprocessing import Pipe, Process
+from twisted.internet.defer import Deferred
+from metrics import REGISTRY
+
+LOGGER = getLogger("camera")
+
+FRAMES_DROPPED = REGISTRY.counter("treater_motion_frames_dropped_total", "Motion frames dropped as stale while the analysis workers were busy")
+WORKER_RESTARTS = REGISTRY.counter("treater_motion_worker_restarts_total", "Motion analysis workers restarted after losing a frame")
+FRAMES_WAITING = REGISTRY.gauge("treater_motion_frames_waiting", "Motion frames submitted for analysis and not yet analysed")
+
+# A frame the worker has not answered in this long is taken to be lost with it (a hang in the JPEG decoder, say)
+RESULT_TIMEOUT_SECONDS = 10.0
+
+# Sent to the worker in place of a frame
+SHED = None
+
+# The worker's detector, holding the last frame it decoded
+DETECTOR = None
+
+def runWorker(connection, threshold):
+    """The worker process: analyses each frame received on the connection and sends back the result, until the
+    connection is closed. The worker is forked from the running reactor; its handlers must not run in it"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    global DETECTOR
+    from raspicam import MotionDetector
+    DETECTOR = MotionDetector(threshold)
+    while True:
+        try:
+            frame = connection.recv()
+        except EOFError:
+            return
+        if frame is SHED:
+            DETECTOR.shed()
+        else:
+            connection.send(analyzeFrame(frame))
+
+def analyzeFrame(frame):
+    """Runs in the worker. Returns (changedPixels, seconds, error)"""
+    start = time.time()
+    try:
+        changedPixels = DETECTOR.detect(frame)
+    except Exception as e:
+        return (0, time.time() - start, "%s: %s" % (e.__class__.__name__, e))
+    return (changedPixels, time.time() - start, None)
+
+class MotionAnalysisPool:
+    """submit(frame) returns a Deferred that fires with the number of changed pixels since the previous frame that was
+    analysed, or with None if the frame was not analysed: dropped as stale, lost with its worker, or still waiting
+    when the pool was closed. With no worker process, frames are analysed inline on the reactor thread, as before.
+    Frames form one stream that each depends on the last, so there is never more than one worker. It is a plain
+    process on a pipe rather than a multiprocessing Pool, whose shared queue lock a killed worker can take with it"""
+
+    def __init__(self, reactor, threshold, processes, maxWaiting, durationHistogram = None):
+        self.reactor = reactor
+        self.threshold = threshold
+        self.maxWaiting = max(1, maxWaiting)
+        self.durationHistogram = durationHistogram
+        self.waiting = deque()
+        # (Deferred, timeout call) of the frame the worker is analysing
+        self.inFlight = None
+        self.worker = None
+        self.connection = None
+        self.detector = None
+        if processes > 1:
+            LOGGER.warning("Motion frames are analysed in one worker process, not %d" % processes)
+        if processes > 0:
+            LOGGER.info("Starting motion analysis worker process")
+            self.startWorker()
+        else:
+            from raspicam import MotionDetector
+            self.detector = MotionDetector(threshold)
+
+    def __str__(self):
+        return "MotionAnalysisPool"
+
+    def startWorker(self):
+        (self.connection, workerConnection) = Pipe()
+        self.worker = Process(target=runWorker, args=(workerConnection, self.threshold), name="motion")
+        self.worker.daemon = True
+        self.worker.start()
+        # Only the worker holds this end now, so reading ours ends with EOF if the worker dies
+        workerConnection.close()
+        reader = threading.Thread(target=self.readResults, args=(self.worker, self.connection), name="motionresults")
+        reader.daemon = True
+        reader.start()
+
+    def readResults(self, worker, connection):
+        """Runs on its own thread for the life of one worker, handing each result to the reactor"""
+        try:
+            while True:
+                result = connection.recv()
+                self.reactor.callFromThread(self.analyzed, result, worker)
+        except (EOFError, IOError):
+            self.reactor.callFromThread(self.workerExited, worker)
+        finally:
+            connection.close()
+
+    def stopWorker(self):
+        """Ends the worker; its reader thread sees EOF and closes the connection. SIGKILL, since a worker stuck in
+        the decoder may never act on SIGTERM, and it holds nothing that needs cleaning up"""
+        (worker, self.worker, self.connection) = (self.worker, None, None)
+        if worker.exitcode is None:
+            try:
+                os.kill(worker.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        worker.join()
+
+    def close(self):
+        if self.worker is not None:
+            self.stopWorker()
+        self.abandonInFlight()
+        while self.waiting:
+            (frame, d) = self.waiting.popleft()
+            d.callback(None)
+        FRAMES_WAITING.set(0)
+
+    def abandonInFlight(self):
+        if self.inFlight is not None:
+            (d, timeout) = self.inFlight
+            self.inFlight = None
+            if timeout.active():
+                timeout.cancel()
+            d.callback(None)
+
+    def memoryUsage(self):
+        """(bytes, frames) held in this process: the decoded previous frame when analysing inline, otherwise the
+        encoded frames waiting for the worker"""
+        frames = [frame for (frame, d) in self.waiting]
+        size = sum(len(frame) for frame in frames)
+        if self.detector is not None and self.detector.lastImage is not None:
+            size += self.detector.memoryUsage()
+            frames.append(self.detector.lastImage)
+        return (size, len(frames))
+
+    def shed(self):
+        if self.detector is not None:
+            self.detector.shed()
+        elif self.worker is not None:
+            # Taken after any frame already sent, as the worker reads the pipe in order
+            self.send(SHED)
+
+    def submit(self, frame):
+        d = Deferred()
+        if self.worker is None and self.detector is not None:
+            start = time.time()
+            changedPixels = self.detector.detect(frame)
+            self.observe(time.time() - start)
+            d.callback(changedPixels)
+            return d
+        if self.worker is None:
+            # Closed
+            d.callback(None)
+            return d
+        if len(self.waiting) >= self.maxWaiting:
+            # The oldest waiting frame is the stalest; there is no point analysing it once a newer one is waiting
+            (staleFrame, staleDeferred) = self.waiting.popleft()
+            FRAMES_DROPPED.inc()
+            staleDeferred.callback(None)
+        self.waiting.append((frame, d))
+        self.dispatch()
+        return d
+
+    def dispatch(self):
+        if self.waiting and self.inFlight is None and self.worker is not None:
+            (frame, d) = self.waiting.popleft()
+            # The worker is idle, so it reads the frame straight away
+            self.send(frame)
+            timeout = self.reactor.callLater(RESULT_TIMEOUT_SECONDS, self.resultLost, d)
+            self.inFlight = (d, timeout)
+        FRAMES_WAITING.set(len(self.waiting) + (self.inFlight is not None))
+
+    def send(self, message):
+        try:
+            self.connection.send(message)
+        except IOError:
+            # The worker has died. Its reader thread reports that, and the frame in flight is given up then
+            pass
+
+    def resultLost(self, d):
+        if self.inFlight is None or self.inFlight[0] is not d:
+            return
+        LOGGER.error("Motion analysis worker did not answer in %g seconds; restarting it" % RESULT_TIMEOUT_SECONDS)
+        self.restartWorker()
+
+    def workerExited(self, worker):
+        if worker is not self.worker:
+            # Stopped by us
+            return
+        worker.join()
+        LOGGER.error("Motion analysis worker exited with code %s; restarting it" % worker.exitcode)
+        self.restartWorker()
+
+    def restartWorker(self):
+        WORKER_RESTARTS.inc()
+        if self.worker is not None:
+            self.stopWorker()
+        # The new worker starts without a previous frame, as it would after a shed
+        self.startWorker()
+        self.abandonInFlight()
+        self.dispatch()
+
+    def analyzed(self, result, worker):
+        if worker is not self.worker or self.inFlight is None:
+            # Answered after it was given up for lost, or after close()
+            return
+        (d, timeout) = self.inFlight
+        timeout.cancel()
+        self.inFlight = None
+        (changedPixels, seconds, error) = result
+        self.observe(seconds)
+        self.dispatch()
+        if error is not None:
+            LOGGER.error("Motion frame analysis failed: %s" % error)
+            changedPixels = 0
+        d.callback(changedPixels)
+
+    def observe(self, seconds):
+        if self.durationHistogram is not None:
+            self.durationHistogram.observe(seconds)
@@ -0,0 +1,308 @@
+#!/usr/bin/python
+
+# treater/profiler.py
+
+"""On-demand CPU profiling of the reactor thread, started and stopped at runtime from the admin API"""
+
+import cProfile
+import json
+import marshal
+import os
+import signal
+import time
+from logging import getLogger
+from twisted.web.resource import Resource
+
+LOGGER = getLogger("profiler")
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Treater modules, by the subsystem their CPU time is reported under
+SUBSYSTEMS = {
+    "machine": "machine", "gpiosys": "machine",
+    "history": "history",
+    "camera": "camera", "raspicam": "camera",
+    "website": "web", "capturefiles": "web", "apiworkers": "web", "statussnapshot": "web",
+    "seriallcd": "seriallcd" }
+
+SAMPLING = "sampling"
+DETERMINISTIC = "deterministic"
+
+DEFAULT_SAMPLE_INTERVAL_SECONDS = 0.005
+MAX_STACK_DEPTH = 64
+MAX_CALLER_HOPS = 10
+
+def subsystemOf(filename):
+    """Names the subsystem that a source file belongs to: a treater subsystem, the reactor (Twisted), or other"""
+    directory, name = os.path.split(os.path.abspath(filename))
+    if directory == PACKAGE_DIR:
+        return SUBSYSTEMS.get(os.path.splitext(name)[0], "other")
+    if "twisted" in directory.split(os.sep):
+        return "reactor"
+    return "other"
+
+def isTreaterSubsystem(subsystem):
+    return subsystem not in ("reactor", "other")
+
+def describeCode(code):
+    return "%s:%s:%d" % (os.path.basename(code.co_filename), code.co_name, code.co_firstlineno)
+
+class SamplingProfile:
+    """Samples the reactor thread's stack on a CPU-time interval timer. Blocked time (waiting for I/O) is never
+    sampled, so the counts show where CPU time goes"""
+
+    def __init__(self, intervalSeconds):
+        self.intervalSeconds = intervalSeconds
+        self.stacks = {}
+        self.samples = 0
+        self.previousHandler = None
+
+    def enable(self):
+        self.previousHandler = signal.signal(signal.SIGPROF, self.sample)
+        # Restart interrupted system calls, rather than having the reactor see EINTR on every tick
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.intervalSeconds, self.intervalSeconds)
+
+    def disable(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self.previousHandler or signal.SIG_DFL)
+
+    def sample(self, signum, frame):
+        # Stacks are keyed by code objects; they are only turned into names when a report is requested
+        stack = []
+        while frame is not None and len(stack) < MAX_STACK_DEPTH:
+            stack.append(frame.f_code)
+            frame = frame.f_back
+        key = tuple(stack)
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.samples += 1
+
+    def subsystemSeconds(self):
+        totals = {}
+        for (stack, count) in self.stacks.iteritems():
+            # Charged to the innermost treater code on the stack: the subsystem that asked for the work
+            subsystem = "reactor"
+            for code in stack:
+                candidate = subsystemOf(code.co_filename)
+                if isTreaterSubsystem(candidate):
+                    subsystem = candidate
+                    break
+            else:
+                if stack:
+                    subsystem = subsystemOf(stack[0].co_filename)
+            totals[subsystem] = totals.get(subsystem, 0) + count * self.intervalSeconds
+        return totals
+
+    def topFunctions(self, limit):
+        selfCounts = {}
+        for (stack, count) in self.stacks.iteritems():
+            if stack:
+                selfCounts[stack[0]] = selfCounts.get(stack[0], 0) + count
+        ranked = sorted(selfCounts.iteritems(), key=lambda item: item[1], reverse=True)[:limit]
+        return [{"function": describeCode(code), "seconds": count * self.intervalSeconds} for (code, count) in ranked]
+
+    def collapsed(self):
+        """Stacks in the collapsed format read by flamegraph.pl and speedscope: root;...;leaf count"""
+        lines = []
+        for (stack, count) in self.stacks.iteritems():
+            lines.append("%s %d" % (";".join(describeCode(code) for code in reversed(stack)), count))
+        lines.sort()
+        return "\n".join(lines) + "\n"
+
+class DeterministicProfile:
+    """cProfile of the reactor thread. Exact call counts, at the cost of slowing everything down while it runs"""
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.stats = None
+
+    def enable(self):
+        self.profile.enable()
+
+    def disable(self):
+        self.profile.disable()
+        self.profile.create_stats()
+        self.stats = self.profile.stats
+
+    def subsystemSeconds(self):
+        totals = {}
+        owners = {}
+        for (function, (cc, nc, tt, ct, callers)) in self.stats.iteritems():
+            subsystem = self.ownerOf(function, owners)
+            totals[subsystem] = totals.get(subsystem, 0) + tt
+        return totals
+
+    def ownerOf(self, function, owners):
+        """Time spent in Twisted or library code is charged to the treater subsystem it was called from, found by
+        following the most expensive caller"""
+        if function in owners:
+            return owners[function]
+        (filename, line, name) = function
+        if filename == "~" and "of 'select." in name:
+            # The reactor waiting for events: wall-clock time, but not CPU time
+            owners[function] = "idle"
+            return "idle"
+        owner = "other"
+        current = function
+        visited = set()
+        for hop in range(MAX_CALLER_HOPS):
+            subsystem = subsystemOf(current[0]) if current[0] != "~" else "other"
+            if isTreaterSubsystem(subsystem):
+                owner = subsystem
+                break
+            if subsystem == "reactor":
+                owner = subsystem
+            visited.add(current)
+            callers = self.stats[current][4] if current in self.stats else {}
+            candidates = [(values[3], caller) for (caller, values) in callers.iteritems() if caller not in visited]
+            if not candidates:
+                break
+            current = max(candidates)[1]
+        owners[function] = owner
+        return owner
+
+    def topFunctions(self, limit):
+        ranked = sorted(self.stats.iteritems(), key=lambda item: item[1][2], reverse=True)[:limit]
+        return [{"function": "%s:%s:%d" % (os.path.basename(filename), name, line), "seconds": tt, "calls": nc}
+                for ((filename, line, name), (cc, nc, tt, ct, callers)) in ranked]
+
+    def pstats(self):
+        """The same marshalled form that pstats.Stats.dump_stats writes, loadable with pstats.Stats(path)"""
+        return marshal.dumps(self.stats)
+
+class CpuProfiler:
+    """At most one profile runs at a time, for a bounded time. Nothing is installed while idle"""
+
+    def __init__(self, reactor, maxSeconds):
+        self.reactor = reactor
+        self.maxSeconds = maxSeconds
+        self.profile = None
+        self.mode = None
+        self.running = False
+        self.startTime = None
+        self.elapsedSeconds = 0
+        self.stopCall = None
+
+    def __str__(self):
+        return "CpuProfiler"
+
+    def start(self, mode, seconds, intervalSeconds = DEFAULT_SAMPLE_INTERVAL_SECONDS):
+        if self.running:
+            raise ValueError("A %s profile is already running" % self.mode)
+        if seconds <= 0 or intervalSeconds < 0.001:
+            raise ValueError("Profile duration must be positive and the sample interval at least 1 ms")
+        if mode == SAMPLING:
+            profile = SamplingProfile(intervalSeconds)
+        elif mode == DETERMINISTIC:
+            profile = DeterministicProfile()
+        else:
+            raise ValueError("Unknown profile mode: %s" % mode)
+        seconds = min(seconds, self.maxSeconds)
+        self.profile = profile
+        self.mode = mode
+        self.running = True
+        self.startTime = time.time()
+        self.elapsedSeconds = 0
+        profile.enable()
+        self.stopCall = self.reactor.callLater(seconds, self.stop)
+        LOGGER.info("Started %s CPU profile for %.0f seconds" % (mode, seconds))
+        return seconds
+
+    def stop(self):
+        if not self.running:
+            return
+        if self.stopCall is not None and self.stopCall.active():
+            self.stopCall.cancel()
+        self.stopCall = None
+        self.profile.disable()
+        self.running = False
+        self.elapsedSeconds = time.time() - self.startTime
+        LOGGER.info("Stopped %s CPU profile after %.1f seconds" % (self.mode, self.elapsedSeconds))
+
+    def getStatus(self, limit = 20):
+        result = {"mode": self.mode, "running": self.running, "maxSeconds": self.maxSeconds}
+        if self.running:
+            result["elapsedSeconds"] = time.time() - self.startTime
+        elif self.profile is not None:
+            result["elapsedSeconds"] = self.elapsedSeconds
+            result["subsystems"] = self.profile.subsystemSeconds()
+            result["topFunctions"] = self.profile.topFunctions(limit)
+            if self.mode == SAMPLING:
+                result["samples"] = self.profile.samples
+        return result
+
+class AdminProfileResource(Resource):
+    """GET: status and per-subsystem summary of the last profile. POST start?mode=sampling&seconds=30 / stop.
+    GET pstats (deterministic profiles) or collapsed (sampling profiles) downloads the last profile"""
+
+    def __init__(self, profiler):
+        Resource.__init__(self)
+        self.profiler = profiler
+
+    def getChild(self, name, request):
+        if name == "":
+            return self
+        return ProfileActionResource(self.profiler, name)
+
+    def render_GET(self, request):
+        request.defaultContentType = b"application/json"
+        return json.dumps(self.profiler.getStatus())
+
+class ProfileActionResource(Resource):
+    isLeaf = True
+
+    def __init__(self, profiler, action):
+        Resource.__init__(self)
+        self.profiler = profiler
+        self.action = action
+
+    def render_POST(self, request):
+        request.defaultContentType = b"application/json"
+        if self.action == "start":
+            mode = request.args.get("mode", [SAMPLING])[0]
+            try:
+                seconds = float(request.args.get("seconds", ["30"])[0])
+                interval = float(request.args.get("interval", [str(DEFAULT_SAMPLE_INTERVAL_SECONDS)])[0])
+                seconds = self.profiler.start(mode, seconds, interval)
+            except ValueError as e:
+                request.setResponseCode(409 if self.profiler.running else 400)
+                return str(e)
+            return json.dumps({"mode": mode, "seconds": seconds})
+        if self.action == "stop":
+            self.profiler.stop()
+            return json.dumps(self.profiler.getStatus())
+        request.setResponseCode(404)
+        return "No such profiler action"
+
+    def render_GET(self, request):
+        profile = self.profiler.profile
+        if self.profiler.running or profile is None:
+            request.setResponseCode(409)
+            return "No completed profile"
+        if self.action == "pstats" and self.profiler.mode == DETERMINISTIC:
+            request.setHeader(b"Content-Type", b"application/octet-stream")
+            request.setHeader(b"Content-Disposition", b"attachment; filename=treater.pstats")
+            return profile.pstats()
+        if self.action == "collapsed" and self.profiler.mode == SAMPLING:
+            request.setHeader(b"Content-Type", b"text/plain; charset=utf-8")
+            return profile.collapsed()
+        request.setResponseCode(404)
+        return "pstats is available for deterministic profiles, collapsed for sampling profiles"
+
+if __name__ == "__main__":
+    from twisted.internet import reactor, task
+
+    def busy():
+        deadline = time.time() + 0.05
+        while time.time() < deadline:
+            pass
+
+    profiler = CpuProfiler(reactor, 60)
+    task.LoopingCall(busy).start(0.1)
+    profiler.start(SAMPLING, 1)
+    def report():
+        print(json.dumps(profiler.getStatus(5), indent=2))
+        print(profiler.profile.collapsed())
+        reactor.stop()
+    reactor.callLater(1.5, report)
+    reactor.run()
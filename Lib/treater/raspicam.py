@@ -4,18 +4,149 @@
 
 """Background task that captures images via the Raspberry Pi camera if motion is detected"""
 
-from twisted.internet import protocol, utils, reactor, defer
+from twisted.internet import protocol, utils, reactor, defer, task
+from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
 from twisted.python import failure
 from twisted.python.constants import NamedConstant, Names
 from cStringIO import StringIO
 from PIL import Image
 from logging import getLogger
+from metrics import REGISTRY
+from tracebuffer import TRACE
 from os import path, remove, rename, symlink, getcwd
 from glob import glob
+from os import getloadavg
 from datetime import datetime, timedelta
+import time
 
 LOGGER = getLogger("camera")
 
+MOTION_DETECTION_DURATION = REGISTRY.histogram("treater_motion_detection_duration_seconds", "Time spent decoding and diffing each motion frame")
+TRIM_DURATION = REGISTRY.histogram("treater_capture_trim_duration_seconds", "Time spent trimming excess capture files")
+MOTION_INTERVAL = REGISTRY.gauge("treater_motion_interval_seconds", "Interval currently chosen between motion detection frames")
+MOTION_THROTTLED = REGISTRY.gauge("treater_motion_throttled", "1 while motion sampling is slowed for reactor lag or system load")
+
+TRACE_MOTION = TRACE.defineEvent("camera", "motionFrame", "changedPixels=%(a)d exitCode=%(b)d")
+
+class MotionDetector:
+    """Counts the pixels that changed between consecutive motion frames. Kept free of camera state so that
+    recorded frames can be replayed through it (see motioncorpus.py)"""
+
+    # Use green channel only as it is the highest quality channel due to Bayer filter
+    GREEN = 1
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.lastImage = None
+        self.lastBuffer = None
+
+    def detect(self, frame):
+        """Takes an encoded frame (BMP from raspistill) and returns the number of changed pixels, 0 for the first frame"""
+        s = StringIO(frame)
+        image = Image.open(s)
+        buffer = image.load()
+        s.close()
+        changedPixels = 0
+        if self.lastImage is not None:
+            changedPixels = countChangedPixels(self.lastBuffer, buffer, image.size, self.threshold)
+        # Save image for next comparison
+        self.lastImage = image
+        self.lastBuffer = buffer
+        return changedPixels
+
+    def memoryUsage(self):
+        if self.lastImage is None:
+            return 0
+        (width, height) = self.lastImage.size
+        return width * height * len(self.lastImage.getbands())
+
+    def shed(self):
+        # The next frame is then treated as the first
+        self.lastImage = None
+        self.lastBuffer = None
+
+def countChangedPixels(lastBuffer, buffer, size, threshold):
+    GREEN = MotionDetector.GREEN
+    changedPixels = 0
+    (width, height) = size
+    for x in xrange(0, width):
+        for y in xrange(0, height):
+            pixdiff = abs(lastBuffer[x,y][GREEN] - buffer[x,y][GREEN])
+            if pixdiff >= threshold:
+                changedPixels += 1
+    return changedPixels
+
+class AdaptiveSampler:
+    """Chooses the interval between motion frames. It backs off exponentially from motionIntervalSeconds to
+    motionMaxIntervalSeconds while the scene is static, snaps back when the changed pixel count rises or a dispense
+    starts, and slows down further while the reactor is lagging or the system is loaded"""
+
+    # A frame with at least this fraction of motionSensitivity changed pixels counts as activity
+    ACTIVITY_FRACTION = 0.5
+    THROTTLE_FACTOR = 2
+    LAG_PROBE_SECONDS = 0.5
+
+    def __init__(self, reactor, config):
+        self.reactor = reactor
+        self.config = config
+        self.baseInterval = config.motionIntervalSeconds
+        self.interval = config.motionIntervalSeconds
+        self.lag = 0.0
+        self.probe = None
+        self.lastProbeTime = None
+        MOTION_INTERVAL.set(self.interval)
+
+    def start(self):
+        if self.probe is None:
+            self.lastProbeTime = time.time()
+            self.probe = task.LoopingCall(self.measureLag)
+            self.probe.clock = self.reactor
+            self.probe.start(AdaptiveSampler.LAG_PROBE_SECONDS, now=False)
+
+    def stop(self):
+        if self.probe is not None and self.probe.running:
+            self.probe.stop()
+        self.probe = None
+
+    def measureLag(self):
+        now = time.time()
+        lateness = max(0.0, now - self.lastProbeTime - AdaptiveSampler.LAG_PROBE_SECONDS)
+        self.lastProbeTime = now
+        # Decay rather than replace, so that one on-time probe does not hide a lag spike straight away
+        self.lag = max(lateness, self.lag * 0.5)
+
+    def isOverloaded(self):
+        if self.lag > self.config.motionLagThresholdSeconds:
+            return True
+        try:
+            return getloadavg()[0] > self.config.motionLoadThreshold
+        except OSError:
+            return False
+
+    def snapBack(self):
+        self.baseInterval = self.config.motionIntervalSeconds
+        return self.choose()
+
+    def nextInterval(self, changedPixels):
+        if changedPixels >= self.config.motionSensitivity * AdaptiveSampler.ACTIVITY_FRACTION:
+            self.baseInterval = self.config.motionIntervalSeconds
+        else:
+            self.baseInterval = min(self.baseInterval * self.config.motionBackoffFactor, self.config.motionMaxIntervalSeconds)
+        return self.choose()
+
+    def choose(self):
+        interval = self.baseInterval
+        overloaded = self.isOverloaded()
+        if overloaded:
+            interval = min(interval * AdaptiveSampler.THROTTLE_FACTOR, self.config.motionMaxIntervalSeconds)
+        if interval != self.interval:
+            LOGGER.debug("Motion sampling interval now %.2f s%s", interval, " (throttled)" if overloaded else "")
+        self.interval = interval
+        MOTION_INTERVAL.set(interval)
+        MOTION_THROTTLED.set(1 if overloaded else 0)
+        return interval
+
 class TreatCamConfig:
     SECTION_NAME = "camera"
     RASPISTILL = '/usr/bin/raspistill'    
@@ -30,10 +161,23 @@ class TreatCamConfig:
         self.motionAutoDisableSeconds = 600
         self.motionThreshold = 10
         self.motionSensitivity = 30
+        self.motionMaxIntervalSeconds = 4
+        self.motionBackoffFactor = 1.5
+        self.motionLagThresholdSeconds = 0.1
+        self.motionLoadThreshold = 1.5
+        self.motionRecordFile = ""
+        self.motionAnalysisProcesses = 1
+        self.motionAnalysisMaxWaiting = 1
+        self.activityFile = ""
+        self.dedupPolicy = "off"
+        self.dedupMaxDistance = 4
+        self.dedupRecentCaptures = 32
         self.captureProgram = TreatCamConfig.RASPISTILL
         self.captureProgramArgs = "-w 648 -h 486 -t 0 -n -e jpg -q 15 -o" 
         self.capturesToRetain = 100
         self.captureDir = getcwd()
+        self.captureStorage = "files"
+        self.captureSegmentSeconds = 3600
         if config:
             self.load(config)
 
@@ -45,10 +189,23 @@ class TreatCamConfig:
         self.motionAutoDisableSeconds = config.getint(sec, "motionAutoDisableSeconds")
         self.motionThreshold = config.getint(sec, "motionThreshold")
         self.motionSensitivity = config.getint(sec, "motionSensitivity")
+        self.motionMaxIntervalSeconds = config.getfloat(sec, "motionMaxIntervalSeconds")
+        self.motionBackoffFactor = config.getfloat(sec, "motionBackoffFactor")
+        self.motionLagThresholdSeconds = config.getfloat(sec, "motionLagThresholdSeconds")
+        self.motionLoadThreshold = config.getfloat(sec, "motionLoadThreshold")
+        self.motionRecordFile = config.get(sec, "motionRecordFile")
+        self.motionAnalysisProcesses = config.getint(sec, "motionAnalysisProcesses")
+        self.motionAnalysisMaxWaiting = config.getint(sec, "motionAnalysisMaxWaiting")
+        self.activityFile = config.get(sec, "activityFile")
+        self.dedupPolicy = config.get(sec, "dedupPolicy")
+        self.dedupMaxDistance = config.getint(sec, "dedupMaxDistance")
+        self.dedupRecentCaptures = config.getint(sec, "dedupRecentCaptures")
         self.captureProgram = config.get(sec, "captureProgram")
         self.captureProgramArgs = config.get(sec, "captureProgramArgs")
         self.capturesToRetain = config.getint(sec, "capturesToRetain")
         self.captureDir = config.get(sec, "captureDir")
+        self.captureStorage = config.get(sec, "captureStorage")
+        self.captureSegmentSeconds = config.getint(sec, "captureSegmentSeconds")
                         
 class TreatCam:
 
@@ -56,6 +213,8 @@ class TreatCam:
     PENDING_MOTION_CAPTURE = 21
     PENDING_FULL_CAPTURE = 2
 
+    CAPTURE_PHOTO_TIMEOUT_SECONDS = 5
+
     CAPTURE_PREFIX = "capture-"
     CAPTURE_FORMAT = CAPTURE_PREFIX + "%Y%m%d-%H%M%S.jpg"
 
@@ -66,15 +225,43 @@ class TreatCam:
 
         self.motionCaptureRunning = False
         self.motionCaptureStartTime = None
+        self.nextMotionCapture = None
         self.state = TreatCam.IDLE
     
-        self.lastImage = None
-        self.lastBuffer = None
+        from motionpool import MotionAnalysisPool
+        self.motionPool = MotionAnalysisPool(reactor, config.motionThreshold, config.motionAnalysisProcesses,
+                                             config.motionAnalysisMaxWaiting, MOTION_DETECTION_DURATION)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.motionPool.close)
+        from memory import MEMORY
+        MEMORY.register("motionFrames", self.motionPool.memoryUsage, self.motionPool.shed)
+        from activity import ActivitySeries
+        self.activity = ActivitySeries(config.activityFile)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.activity.close)
+        MEMORY.register("activity", self.activity.memoryUsage)
+        self.sampler = AdaptiveSampler(reactor, config)
+        from dedup import createDeduplicator
+        self.deduplicator = createDeduplicator(reactor, config)
+        self.store = None
+        if config.captureStorage == "segments":
+            from segstore import SegmentedCaptureStore
+            self.store = SegmentedCaptureStore(config.captureDir, config.captureSegmentSeconds)
+            reactor.addSystemEventTrigger('before', 'shutdown', self.store.close)
+            MEMORY.register("captureIndex", self.store.memoryUsage)
+            if self.deduplicator is not None:
+                LOGGER.warning("Capture dedup works on capture files, so it is off with segmented capture storage")
+                self.deduplicator = None
+        self.motionRecorder = None
+        if config.motionRecordFile:
+            from motioncorpus import CorpusWriter
+            LOGGER.info("Recording motion frames to %s" % config.motionRecordFile)
+            self.motionRecorder = CorpusWriter(config.motionRecordFile)
 
         self.lastCaptureTime = None
         self.lastCaptureName = None
         self.findPreExistingLastCapture()
         self.forceCapture = False
+        self.defers = []
+        self.captureListeners = []
         
     def __str__(self):
         return "TreatCam"
@@ -88,6 +275,7 @@ class TreatCam:
             return
         LOGGER.info("Enabling camera motion capture")
         self.motionCaptureRunning = True
+        self.sampler.start()
         self.initiateMotionCaptureCycle()
 
     def stopMotionCapture(self):
@@ -96,6 +284,30 @@ class TreatCam:
         LOGGER.info("Disabling camera capture")
         self.motionCaptureRunning = False
         self.motionCaptureStartTime = None
+        self.sampler.stop()
+        self.cancelMotionCapture()
+
+    def dispenseStarted(self):
+        """Treat machine dispense listener: sample at the fast rate, starting motion capture if it is not running"""
+        self.sampler.snapBack()
+        if self.motionCaptureRunning and self.cancelMotionCapture():
+            # The frame already scheduled would wait out the backed-off interval; take it now instead
+            self.initiateMotionCaptureCycle()
+        self.startMotionCapture()
+
+    def scheduleMotionCapture(self, delay):
+        # The handle is kept so that a dispense can bring the next frame forward
+        self.cancelMotionCapture()
+        self.nextMotionCapture = self.reactor.callLater(delay, self.initiateMotionCaptureCycle)
+
+    def cancelMotionCapture(self):
+        """Returns True if a scheduled motion frame was cancelled"""
+        pending = self.nextMotionCapture
+        self.nextMotionCapture = None
+        if pending is not None and pending.active():
+            pending.cancel()
+            return True
+        return False
 
     def forceImageCapture(self):
         LOGGER.debug("Received request to force image capture")
@@ -107,7 +319,36 @@ class TreatCam:
             LOGGER.debug("Force capture initiating full capture cycle")
             self.initiateFullCaptureCycle()
         else:
-            LOGGER.DEBUG("Setting force capture flag; full capture will occcur after in-progress motion capture")
+            LOGGER.debug("Setting force capture flag; full capture will occcur after in-progress motion capture")
+
+    def capturePhoto(self):
+        """Returns a Deferred that fires with the name of the next full capture"""
+        LOGGER.debug("Received request to capture a photo")
+        d = Deferred()
+        timeout = self.reactor.callLater(TreatCam.CAPTURE_PHOTO_TIMEOUT_SECONDS, d.cancel)
+        def cancelTimeout(result):
+            if timeout.active():
+                timeout.cancel()
+            return result
+        d.addBoth(cancelTimeout)
+        self.defers.append(d)
+        self.forceImageCapture()
+        return d
+
+    def fireDefers(self, result):
+        defers = self.defers
+        self.defers = []
+        for d in defers:
+            if not d.called:
+                if isinstance(result, Failure):
+                    d.errback(result)
+                else:
+                    d.callback(result)
+
+    def addCaptureListener(self, listener):
+        """listener.captureAdded(name) is called for each new capture, and listener.capturesRemoved(names) when
+        captures are trimmed"""
+        self.captureListeners.append(listener)
 
     def getLastCaptureTime(self):
         return self.lastCaptureTime
@@ -116,6 +357,13 @@ class TreatCam:
         return self.lastCaptureName
 
     def findPreExistingLastCapture(self):
+        if self.store is not None:
+            name = self.store.latest()
+            if name:
+                self.lastCaptureTime = datetime.strptime(name, TreatCam.CAPTURE_FORMAT)
+                self.lastCaptureName = name
+                LOGGER.info("Recovering %s at startup as last capture" % self.lastCaptureName)
+            return
         capturePattern = path.join(self.config.captureDir, TreatCam.CAPTURE_PREFIX + "*")
         captures = sorted(glob(capturePattern))
         if captures:
@@ -145,45 +393,40 @@ class TreatCam:
 
         (out, err, code) = result
 
-        changedPixels = 0
         if code == 0:
-            s = StringIO(out)
-            image = Image.open(s)
-            buffer = image.load()
-            s.close()
-    
-            # Count changed pixels
-            if self.lastImage is not None:
-                (width, height) = image.size
-                for x in xrange(0, width):
-                    for y in xrange(0, height):
-                        # Use green channel only as it is the highest quality channel due to Bayer filter
-                        GREEN = 1
-                        pixdiff = abs(self.lastBuffer[x,y][GREEN] - buffer[x,y][GREEN])
-                        if pixdiff >= self.config.motionThreshold:
-                            changedPixels += 1
-                LOGGER.debug("changedPixels = %d" % changedPixels)
-
-            # Save image for next comparison
-            self.lastImage = image
-            self.lastBuffer = buffer
-
+            captureTime = time.time()
+            if self.motionRecorder is not None:
+                self.motionRecorder.write(captureTime, out)
+            d = self.motionPool.submit(out)
+            d.addCallback(self.motionAnalyzed, code, captureTime)
         else:
             LOGGER.error("Image capture process returned error %s: %s" % (code, err))
+            self.motionAnalyzed(0, code)
+
+    def motionAnalyzed(self, changedPixels, code, captureTime = None):
+        if changedPixels is None:
+            # Dropped as stale; carry on at the current rate
+            if self.motionCaptureRunning:
+                self.scheduleMotionCapture(self.sampler.interval)
+            return
+        TRACE.record(TRACE_MOTION, changedPixels, code)
+        if captureTime is not None:
+            self.activity.record(captureTime, changedPixels)
 
         # If motion capture is still enabled, we either capture a full image or schedule the next motion capture
         if self.motionCaptureRunning:
-            # Queue an image capture operation if pixels changed
-            if changedPixels > self.config.motionSensitivity:
+            interval = self.sampler.nextInterval(changedPixels)
+            # Queue an image capture operation if pixels changed, unless a forced one is already under way
+            if changedPixels > self.config.motionSensitivity and self.state == TreatCam.IDLE:
                 LOGGER.info("Motion detected. Will capture image")
                 self.initiateFullCaptureCycle()
             # Otherwise queue next motion capture
             else:
                 if self.motionCaptureRunning:
                     if (datetime.now() - self.motionCaptureStartTime) > timedelta(seconds=self.config.motionAutoDisableSeconds):
-                        self.motionCaptureRunning = False
+                        self.stopMotionCapture()
                     else:
-                        self.reactor.callLater(self.config.motionIntervalSeconds, self.initiateMotionCaptureCycle)
+                        self.scheduleMotionCapture(interval)
 
     def motionCaptureError(self, err):
         LOGGER.error("Error response to motion capture process: %s" % err)
@@ -196,7 +439,11 @@ class TreatCam:
         self.forceCapture = False
         time = datetime.now()
         captureName = time.strftime(TreatCam.CAPTURE_FORMAT)
-        capturePath = path.join(self.config.captureDir, captureName)
+        if self.store is None:
+            capturePath = path.join(self.config.captureDir, captureName)
+        else:
+            # The image comes back on stdout, to be appended to its segment
+            capturePath = "-"
         cmdLine = self.config.captureProgramArgs + " " + capturePath
         LOGGER.debug("Preparing to spawn capture process: %s %s" % (self.config.captureProgram, cmdLine))
         args = cmdLine.split(' ')
@@ -211,30 +458,72 @@ class TreatCam:
 
         (out, err, code) = result
 
-        if code == 0:
-            self.lastCaptureTime = kwargs["captureTime"]
-            self.lastCaptureName =  kwargs["captureName"]
-            LOGGER.info("Captured %s" % self.lastCaptureName)
-            self.trimExcessCaptureFiles()
+        if code == 0 and self.store is not None:
+            try:
+                captureName = self.store.add(kwargs["captureTime"], out)
+            except (IOError, OSError) as e:
+                LOGGER.exception("Unable to store capture")
+                self.fireDefers(Failure(e))
+            else:
+                self.captureCompleted(captureName, kwargs["captureTime"])
+        elif code == 0:
+            if self.deduplicator is None:
+                self.captureCompleted(kwargs["captureName"], kwargs["captureTime"])
+            else:
+                d = self.deduplicator.check(kwargs["captureName"])
+                d.addCallback(self.dedupChecked, kwargs["captureTime"])
         else:
             LOGGER.error("Image capture process returned error %s: %s" % (code, err))
+            self.fireDefers(Failure(Exception("Image capture process returned error %s" % code)))
 
         # If motion capture enabled, start the next motion capture cycle
         if self.motionCaptureRunning:
-            self.reactor.callLater(self.config.motionIntervalSeconds, self.initiateMotionCaptureCycle)
+            self.scheduleMotionCapture(self.sampler.interval)
+
+    def dedupChecked(self, result, captureTime):
+        (kept, match) = result
+        if kept is None:
+            # Dropped as a duplicate; its match stands in as the latest capture
+            try:
+                captureTime = datetime.strptime(match, TreatCam.CAPTURE_FORMAT)
+            except ValueError:
+                pass
+            kept = match
+        self.captureCompleted(kept, captureTime)
+
+    def captureCompleted(self, captureName, captureTime):
+        self.lastCaptureTime = captureTime
+        self.lastCaptureName = captureName
+        LOGGER.info("Captured %s" % self.lastCaptureName)
+        for listener in self.captureListeners:
+            listener.captureAdded(self.lastCaptureName)
+        self.trimExcessCaptureFiles()
+        self.fireDefers(self.lastCaptureName)
 
     def fullCaptureError(self, err):
         LOGGER.error("Error response to full image capture process: %s" % err)
         self.state = TreatCam.IDLE
+        self.fireDefers(err)
         return err
 
     def trimExcessCaptureFiles(self):
+        start = time.time()
+        if self.store is not None:
+            removed = self.store.trim(self.config.capturesToRetain)
+            if removed:
+                for listener in self.captureListeners:
+                    listener.capturesRemoved(removed)
+            TRIM_DURATION.observe(time.time() - start)
+            return
         captures = sorted(glob(path.join(self.config.captureDir, TreatCam.CAPTURE_PREFIX + "*")))
         excessCaptures = len(captures) - self.config.capturesToRetain
         if (excessCaptures > 0):
             for i in range(excessCaptures):
                 LOGGER.info("Trimming: %s" % captures[i])
                 remove(captures[i])
+            for listener in self.captureListeners:
+                listener.capturesRemoved([path.basename(c) for c in captures[:excessCaptures]])
+        TRIM_DURATION.observe(time.time() - start)
 
 if __name__=="__main__":
     from logging import Formatter, StreamHandler, INFO, DEBUG, getLogger
@@ -0,0 +1,318 @@
+#!/usr/bin/python
+
+# treater/segstore.py
+
+"""Capture storage in time-segmented container files. Each segment (an hour by default) is one data file of JPEG
+frames appended back to back, and one index file of fixed-size (second, offset, length) entries. Any capture is
+found by bisecting its segment's index and read with mmap (or sent with sendfile) without a directory scan, and
+retention unlinks whole segments"""
+
+import mmap
+import os
+import struct
+import time
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from glob import glob
+from logging import getLogger
+from metrics import REGISTRY
+
+LOGGER = getLogger("camera")
+
+SEGMENT_COUNT = REGISTRY.gauge("treater_capture_segments", "Capture segment files held by the segmented capture store")
+CAPTURE_COUNT = REGISTRY.gauge("treater_capture_segment_captures", "Captures held by the segmented capture store")
+APPEND_DURATION = REGISTRY.histogram("treater_capture_segment_append_duration_seconds", "Time spent appending a capture to its segment")
+
+CAPTURE_FORMAT = "capture-%Y%m%d-%H%M%S.jpg"
+SEGMENT_PREFIX = "segment-"
+SEGMENT_FORMAT = SEGMENT_PREFIX + "%Y%m%d-%H%M%S"
+DATA_EXTENSION = ".seg"
+INDEX_EXTENSION = ".idx"
+
+# Ahead of each frame in the data file, so that the index can be rebuilt from it after a crash
+FRAME_HEADER = struct.Struct("<4sqI")
+FRAME_MAGIC = b"TRCP"
+INDEX_ENTRY = struct.Struct("<qQI")
+
+def captureSecond(name):
+    """Local time of a capture name as epoch seconds, or None if it is not a capture name"""
+    try:
+        return int(time.mktime(datetime.strptime(name, CAPTURE_FORMAT).timetuple()))
+    except ValueError:
+        return None
+
+def captureName(second):
+    return datetime.fromtimestamp(second).strftime(CAPTURE_FORMAT)
+
+class Segment:
+    def __init__(self, directory, start):
+        self.start = start
+        basePath = os.path.join(directory, datetime.fromtimestamp(start).strftime(SEGMENT_FORMAT))
+        self.dataPath = basePath + DATA_EXTENSION
+        self.indexPath = basePath + INDEX_EXTENSION
+        self.seconds = None
+        self.entries = None
+        self.dataFile = None
+        self.indexFile = None
+        self.map = None
+
+    def __len__(self):
+        if self.entries is not None:
+            return len(self.entries)
+        # Counted without reading the index
+        try:
+            return os.path.getsize(self.indexPath) // INDEX_ENTRY.size
+        except OSError:
+            return 0
+
+    def load(self):
+        """Reads the index, rebuilding it from the data file if a crash left it behind the data"""
+        if self.entries is not None:
+            return
+        entries = []
+        try:
+            with open(self.indexPath, "rb") as f:
+                data = f.read()
+            entries = [INDEX_ENTRY.unpack_from(data, offset)
+                       for offset in range(0, len(data) - len(data) % INDEX_ENTRY.size, INDEX_ENTRY.size)]
+        except IOError:
+            pass
+        try:
+            dataSize = os.path.getsize(self.dataPath)
+        except OSError:
+            dataSize = 0
+        indexedSize = entries[-1][1] + entries[-1][2] if entries else 0
+        if indexedSize != dataSize:
+            entries = self.rebuildIndex()
+        self.entries = entries
+        self.seconds = [second for (second, offset, length) in entries]
+
+    def rebuildIndex(self):
+        LOGGER.warning("Rebuilding capture segment index %s" % self.indexPath)
+        entries = []
+        try:
+            with open(self.dataPath, "rb") as f:
+                offset = 0
+                while True:
+                    header = f.read(FRAME_HEADER.size)
+                    if len(header) < FRAME_HEADER.size:
+                        break
+                    (magic, second, length) = FRAME_HEADER.unpack(header)
+                    if magic != FRAME_MAGIC:
+                        break
+                    f.seek(length, os.SEEK_CUR)
+                    if f.tell() > os.fstat(f.fileno()).st_size:
+                        break
+                    entries.append((second, offset + FRAME_HEADER.size, length))
+                    offset += FRAME_HEADER.size + length
+            # Drop anything after the last complete frame, so that appends line up with the index again
+            with open(self.dataPath, "r+b") as f:
+                f.truncate(offset)
+        except IOError:
+            LOGGER.exception("Unable to rebuild capture segment index from %s" % self.dataPath)
+        with open(self.indexPath, "wb") as f:
+            for entry in entries:
+                f.write(INDEX_ENTRY.pack(*entry))
+        return entries
+
+    def append(self, second, frame):
+        self.load()
+        if self.dataFile is None:
+            self.dataFile = open(self.dataPath, "ab")
+            self.indexFile = open(self.indexPath, "ab")
+        offset = self.dataFile.tell() + FRAME_HEADER.size
+        self.dataFile.write(FRAME_HEADER.pack(FRAME_MAGIC, second, len(frame)) + frame)
+        self.dataFile.flush()
+        # The index entry only goes in once its frame is in the data file
+        entry = (second, offset, len(frame))
+        self.indexFile.write(INDEX_ENTRY.pack(*entry))
+        self.indexFile.flush()
+        position = bisect_right(self.seconds, second)
+        self.entries.insert(position, entry)
+        self.seconds.insert(position, second)
+
+    def find(self, second):
+        """(offset, length) of the last capture taken in that second, or None"""
+        self.load()
+        position = bisect_right(self.seconds, second)
+        if position == 0 or self.seconds[position - 1] != second:
+            return None
+        (second, offset, length) = self.entries[position - 1]
+        return (offset, length)
+
+    def read(self, offset, length):
+        if self.map is None or offset + length > len(self.map):
+            # Mapped afresh once the segment has grown past the old mapping
+            self.closeMap()
+            with open(self.dataPath, "rb") as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map[offset:offset + length]
+
+    def names(self):
+        self.load()
+        return [captureName(second) for second in self.seconds]
+
+    def closeMap(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def close(self):
+        self.closeMap()
+        for f in (self.dataFile, self.indexFile):
+            if f is not None:
+                f.close()
+        self.dataFile = None
+        self.indexFile = None
+
+    def remove(self):
+        self.close()
+        for filePath in (self.dataPath, self.indexPath):
+            try:
+                os.remove(filePath)
+            except OSError:
+                LOGGER.exception("Unable to remove capture segment file %s" % filePath)
+
+class SegmentedCaptureStore:
+    """Captures keep their capture-YYYYmmdd-HHMMSS.jpg names, so the rest of the treater (the correlation index,
+    getStatus, capture URLs) is unchanged; names are resolved to a segment, offset and length here"""
+
+    def __init__(self, directory, segmentSeconds):
+        self.directory = directory
+        self.segmentSeconds = segmentSeconds
+        self.segments = []
+        self.starts = []
+        # One directory scan, of segments rather than captures, at start-up
+        for dataPath in sorted(glob(os.path.join(directory, SEGMENT_PREFIX + "*" + DATA_EXTENSION))):
+            name = os.path.basename(dataPath)[:-len(DATA_EXTENSION)]
+            try:
+                start = int(time.mktime(datetime.strptime(name, SEGMENT_FORMAT).timetuple()))
+            except ValueError:
+                continue
+            self.segments.append(Segment(directory, start))
+            self.starts.append(start)
+        self.updateGauges()
+
+    def __str__(self):
+        return "SegmentedCaptureStore"
+
+    def __len__(self):
+        return sum(len(segment) for segment in self.segments)
+
+    def updateGauges(self):
+        SEGMENT_COUNT.set(len(self.segments))
+        CAPTURE_COUNT.set(len(self))
+
+    def segmentFor(self, second, create = False):
+        start = second - second % self.segmentSeconds
+        position = bisect_left(self.starts, start)
+        if position < len(self.starts) and self.starts[position] == start:
+            return self.segments[position]
+        if not create:
+            return None
+        segment = Segment(self.directory, start)
+        self.segments.insert(position, segment)
+        self.starts.insert(position, start)
+        if position > 0:
+            # Only the newest segment is normally appended to, so the others' files need not stay open
+            self.segments[position - 1].close()
+        return segment
+
+    def add(self, captureTime, frame):
+        """Appends a JPEG frame taken at captureTime (a datetime). Returns its capture name"""
+        start = time.time()
+        second = int(time.mktime(captureTime.timetuple()))
+        self.segmentFor(second, create=True).append(second, frame)
+        APPEND_DURATION.observe(time.time() - start)
+        self.updateGauges()
+        return captureName(second)
+
+    def locate(self, name):
+        """(data file path, offset, length, capture epoch) of a capture, or None"""
+        second = captureSecond(name)
+        if second is None:
+            return None
+        segment = self.segmentFor(second)
+        found = segment.find(second) if segment is not None else None
+        if found is None:
+            return None
+        return (segment.dataPath, found[0], found[1], second)
+
+    def read(self, name):
+        """The JPEG bytes of a capture, or None"""
+        second = captureSecond(name)
+        segment = self.segmentFor(second) if second is not None else None
+        found = segment.find(second) if segment is not None else None
+        if found is None:
+            return None
+        return segment.read(*found)
+
+    def latest(self):
+        """Name of the newest capture, or None"""
+        for segment in reversed(self.segments):
+            segment.load()
+            if segment.seconds:
+                return captureName(segment.seconds[-1])
+        return None
+
+    def names(self):
+        names = []
+        for segment in self.segments:
+            names.extend(segment.names())
+        return names
+
+    def trim(self, capturesToRetain):
+        """Removes the oldest whole segments while at least capturesToRetain captures would remain. Returns the
+        names of the captures removed"""
+        removed = []
+        total = len(self)
+        while len(self.segments) > 1 and total - len(self.segments[0]) >= capturesToRetain:
+            segment = self.segments.pop(0)
+            self.starts.pop(0)
+            total -= len(segment)
+            names = segment.names()
+            LOGGER.info("Trimming capture segment %s of %d captures" % (os.path.basename(segment.dataPath), len(names)))
+            segment.remove()
+            removed.extend(names)
+        if removed:
+            self.updateGauges()
+        return removed
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+    def memoryUsage(self):
+        loaded = [segment for segment in self.segments if segment.entries is not None]
+        entries = sum(len(segment.entries) for segment in loaded)
+        # A tuple of three and an int per loaded index entry
+        return (entries * 120, entries)
+
+if __name__ == "__main__":
+    import random
+    import shutil
+    import tempfile
+    from datetime import timedelta
+    directory = tempfile.mkdtemp()
+    store = SegmentedCaptureStore(directory, 3600)
+    start = datetime.now().replace(microsecond=0) - timedelta(days=2)
+    frames = 2 * 24 * 60
+    began = time.time()
+    for n in range(frames):
+        store.add(start + timedelta(seconds=60 * n), os.urandom(random.randint(20000, 40000)))
+    print("Appended %d captures in %.1f ms each, into %d segments" % (
+        frames, (time.time() - began) * 1000 / frames, len(store.segments)))
+    store.close()
+
+    began = time.time()
+    reopened = SegmentedCaptureStore(directory, 3600)
+    name = captureName(int(time.mktime((start + timedelta(hours=30, minutes=7)).timetuple())))
+    frame = reopened.read(name)
+    print("Reopened and read %s (%d bytes) in %.1f ms; latest is %s" % (
+        name, len(frame), (time.time() - began) * 1000, reopened.latest()))
+    began = time.time()
+    removed = reopened.trim(100)
+    print("Trimmed to %d captures by removing %d segments in %.1f ms" % (
+        len(reopened), len(removed) // 60, (time.time() - began) * 1000))
+    reopened.close()
+    shutil.rmtree(directory)
@@ -5,9 +5,22 @@
 import time
 import serial
 import logging
+from collections import deque
 
 LOGGER = logging.getLogger("seriallcd")
 
+class LCDProtocol:
+    """The LCD never sends anything back, so the serial transport just needs somewhere to deliver nothing"""
+
+    def makeConnection(self, transport):
+        self.transport = transport
+
+    def dataReceived(self, data):
+        pass
+
+    def connectionLost(self, reason):
+        pass
+
 class SerialLCD:
 
     NoteCodes = { 
@@ -23,8 +36,44 @@ class SerialLCD:
     NoteScaleCodes = {
         3 : b'\xD7', 4 : b'\xD8', 5 : b'\xD9', 6 : b'\xDA', 7 : b'\xDB' } 
 
-    def __init__(self, baud, device='/dev/ttyAMA0'):
-        self.ser = serial.Serial(device, 9600, timeout=2)
+    LINE_WIDTH = 16
+    # Cursor position commands for the first cell of each line; add the column to address any cell
+    LINE_ADDRESSES = (0x80, 0x94)
+    BLANK_FRAME = b' ' * (LINE_WIDTH * 2)
+
+    # Queued command kinds. Later commands of a coalesced kind replace a queued one instead of adding another
+    RAW = 0
+    CLEAR = 1
+    FRAME = 2
+    BACKLIGHT = 3
+    MODE = 4
+    COALESCED = (FRAME, BACKLIGHT, MODE)
+
+    CLEAR_DELAY_SECONDS = 0.01
+    BITS_PER_BYTE = 10
+    MAX_QUEUED_COMMANDS = 32
+
+    def __init__(self, baud, device='/dev/ttyAMA0', reactor = None):
+        self.baud = baud
+        self.reactor = reactor
+        # Without a reactor, writes block on pyserial. With one, commands are queued and paced onto a
+        # non-blocking Twisted serial transport
+        if reactor is None:
+            self.ser = serial.Serial(device, baud, timeout=2)
+            self.port = None
+        else:
+            from twisted.internet.serialport import SerialPort
+            self.ser = None
+            self.port = SerialPort(LCDProtocol(), device, reactor, baudrate=baud)
+        self.queue = deque()
+        self.coalescable = {}
+        self.pump = None
+        # Fires once the commands queued before close() have been sent
+        self.closing = None
+        # Shadow copy of what the display is showing, or None when unknown. Lets updates send only changed cells
+        self.frame = None
+        self.backlight = None
+        self.displayMode = None
 
     def __enter__(self):
         pass    
@@ -33,17 +82,33 @@ class SerialLCD:
         self.close()
 
     def close(self):
+        """With a reactor, returns a Deferred that fires once everything queued so far has been sent and the port is
+        closed"""
         if self.ser is not None:
             self.ser.close()
             self.ser = None
+        if self.reactor is None:
+            return None
+        from twisted.internet.defer import Deferred, succeed
+        if self.port is None:
+            return succeed(None)
+        if self.closing is None:
+            self.closing = Deferred()
+            if self.pump is None:
+                self.finishClose()
+        return self.closing
+
+    def finishClose(self):
+        self.port.loseConnection()
+        self.port = None
+        self.closing.callback(None)
 
     def flush(self):
-        self.ser.flush()
+        if self.ser is not None:
+            self.ser.flush()
 
     def clear(self):
-        self.write(b'\x0C')
-        self.flush()
-        time.sleep(0.01)
+        self.submit(self.CLEAR)
 
     def setDisplayMode(self, display = True, cursor = True, blink = False):
         if display:
@@ -59,15 +124,10 @@ class SerialLCD:
                     code = b'\x16'
         else:
             code = b'\x15'
-        self.write(code)
-        self.flush()
+        self.submit(self.MODE, code)
 		
     def enableBacklight(self, enabled):
-        if (enabled):
-            self.write(b'\x11')
-        else:
-            self.write(b'\x12')
-        self.flush()
+        self.submit(self.BACKLIGHT, bool(enabled))
         
     def home(self):
         self.write(b'\x80')
@@ -76,18 +136,124 @@ class SerialLCD:
         self.write(b'\x0D')
 
     def write(self, msg):
-        self.ser.write(msg)
+        self.submit(self.RAW, msg)
 
     def writeLine(self, msg):
         paddedMsg = (msg + b' '*16)[:16]
-        self.write(paddedMsg)
-        self.nextLine()
+        # Written wherever the cursor happened to be, so the shadow frame can no longer be trusted
+        self.submit(self.RAW, paddedMsg + b'\x0D', invalidatesFrame = True)
 
     def writeBothLines(self, line1, line2 = ''):
         paddedLine1 = (line1 + b' '*16)[:16]
         paddedLine2 = (line2 + b' '*16)[:16]
-        self.home()
-        self.write(paddedLine1 + paddedLine2)
+        self.submit(self.FRAME, paddedLine1 + paddedLine2)
+
+    def submit(self, kind, data = None, invalidatesFrame = False):
+        if self.reactor is None:
+            if self.ser is None:
+                return
+            (output, delay) = self.render(kind, data, invalidatesFrame)
+            if output:
+                self.ser.write(output)
+                if kind not in (self.RAW, self.FRAME):
+                    self.ser.flush()
+            if delay:
+                time.sleep(delay)
+            return
+        if self.closing is not None:
+            # Nothing submitted after close() is sent
+            return
+        pending = self.coalescable.get(kind)
+        if pending is not None:
+            # Superseded before it was sent; only the latest content matters. It moves to the back of the queue so
+            # that it is not sent ahead of commands submitted after the one it replaces
+            if self.queue[-1] is pending:
+                pending[1] = data
+                return
+            self.queue.remove(pending)
+        if kind == self.RAW and len(self.queue) >= self.MAX_QUEUED_COMMANDS:
+            LOGGER.warning("LCD command queue is full; dropping %d bytes" % len(data))
+            return
+        entry = [kind, data, invalidatesFrame]
+        self.queue.append(entry)
+        if kind in self.COALESCED:
+            self.coalescable[kind] = entry
+        else:
+            # Updates queued after a clear or raw write must be sent after it, not merged into ones ahead of it
+            self.coalescable.clear()
+        self.schedulePump(0)
+
+    def schedulePump(self, delay):
+        if self.pump is None:
+            self.pump = self.reactor.callLater(delay, self.pumpQueue)
+
+    def pumpQueue(self):
+        self.pump = None
+        while self.queue and self.port is not None:
+            entry = self.queue.popleft()
+            (kind, data, invalidatesFrame) = entry
+            if self.coalescable.get(kind) is entry:
+                del self.coalescable[kind]
+            (output, delay) = self.render(kind, data, invalidatesFrame)
+            if not output:
+                continue
+            self.port.write(output)
+            # Hold further commands until these bytes are on the wire, so anything arriving meanwhile coalesces
+            self.schedulePump(len(output) * self.BITS_PER_BYTE / float(self.baud) + delay)
+            return
+        if self.closing is not None and self.port is not None:
+            self.finishClose()
+
+    def render(self, kind, data, invalidatesFrame):
+        """Turns a command into the bytes to send, given what the display currently shows. Returns (bytes, delay)
+        where delay is how long the display needs before it can accept the next command"""
+        if kind == self.FRAME:
+            if self.frame is None:
+                output = b'\x80' + data
+            else:
+                output = self.frameUpdateCommands(self.frame, data)
+            self.frame = data
+            return (output, 0)
+        if kind == self.BACKLIGHT:
+            if data == self.backlight:
+                return (b'', 0)
+            self.backlight = data
+            return (b'\x11' if data else b'\x12', 0)
+        if kind == self.MODE:
+            if data == self.displayMode:
+                return (b'', 0)
+            self.displayMode = data
+            return (data, 0)
+        if kind == self.CLEAR:
+            self.frame = self.BLANK_FRAME
+            return (b'\x0C', self.CLEAR_DELAY_SECONDS)
+        if invalidatesFrame:
+            self.frame = None
+        return (data, 0)
+
+    def frameUpdateCommands(self, oldFrame, newFrame):
+        """Builds the cursor position commands and characters needed to turn oldFrame into newFrame"""
+        commands = []
+        for (line, address) in enumerate(self.LINE_ADDRESSES):
+            start = line * self.LINE_WIDTH
+            oldLine = oldFrame[start:start + self.LINE_WIDTH]
+            newLine = newFrame[start:start + self.LINE_WIDTH]
+            for (first, last) in self.changedRuns(oldLine, newLine):
+                commands.append(chr(address + first))
+                commands.append(newLine[first:last])
+        return b''.join(commands)
+
+    def changedRuns(self, oldLine, newLine):
+        runs = []
+        for column in range(len(newLine)):
+            if oldLine[column] == newLine[column]:
+                continue
+            # Rewriting one unchanged cell costs the same byte as a new position command, so join such runs
+            if runs and column - runs[-1][1] <= 1:
+                runs[-1][1] = column + 1
+            else:
+                runs.append([column, column + 1])
+        return runs
 
     def playNote(self, scale, note, length):
         scaleCode = self.NoteScaleCodes[int(scale)]
@@ -95,9 +261,60 @@ class SerialLCD:
         lengthCode = self.NoteLengthCodes[length]
         self.write(scaleCode + lengthCode + note)
 
+def checkAgainstPty():
+    """Drives a reactor-backed SerialLCD attached to a pty stand-in, checks what the display ends up showing, and
+    measures how late a 10 ms timer runs while a burst of updates is being sent"""
+    import select
+    from twisted.internet import reactor, task
+    from standins import PtyLCD
+
+    display = PtyLCD(reactor)
+    lcd = SerialLCD(9600, display.deviceName, reactor=reactor)
+    lag = {"max": 0.0, "last": time.time()}
+    def tick():
+        now = time.time()
+        lag["max"] = max(lag["max"], now - lag["last"] - 0.01)
+        lag["last"] = now
+    ticker = task.LoopingCall(tick)
+    ticker.start(0.01)
+
+    def burst():
+        lcd.clear()
+        lcd.setDisplayMode(display = True, cursor = False, blink = False)
+        for i in range(200):
+            lcd.enableBacklight(i % 2 == 0)
+            lcd.writeBothLines("Treats : %d/%d" % (i, i / 3), "Last   : 0h %dm" % (i % 60))
+        lcd.enableBacklight(True)
+    def verify():
+        ticker.stop()
+        expected = ("Treats : 199/66 ", "Last   : 0h 19m ")
+        print("Display shows: %r (expected %r)" % (display.lines(), expected))
+        print("Backlight: %s, bytes received: %d for 200 updates" % (display.backlight, display.bytesReceived))
+        print("Worst reactor lag during the burst: %.1f ms" % (lag["max"] * 1000))
+        result["burst"] = display.lines() == expected and display.backlight
+        # As the treat machine does at shutdown: these must reach the display before the reactor stops
+        lcd.writeBothLines("Treater disabled")
+        lcd.enableBacklight(False)
+        reactor.stop()
+    result = {}
+    reactor.addSystemEventTrigger('before', 'shutdown', lcd.close)
+    reactor.callLater(0.1, burst)
+    reactor.callLater(1.0, verify)
+    reactor.run()
+    # Whatever reached the pty after the reactor stopped reading it
+    while select.select([display.master], [], [], 0.1)[0]:
+        display.drain()
+    expected = ("Treater disabled", " " * 16)
+    print("After shutdown the display shows: %r, backlight %s" % (display.lines(), display.backlight))
+    print("PASS" if result["burst"] and display.lines() == expected and not display.backlight else "FAIL")
+
 if __name__ == '__main__':
-    lcd = SerialLCD(9600)
-    lcd.clear()
-    lcd.writeLine("1234567890123456")
-    lcd.home()
-    lcd.writeLine("AAAA")
+    import sys
+    if "--pty" in sys.argv:
+        checkAgainstPty()
+    else:
+        lcd = SerialLCD(9600)
+        lcd.clear()
+        lcd.writeLine("1234567890123456")
+        lcd.home()
+        lcd.writeLine("AAAA")
@@ -0,0 +1,266 @@
+#!/usr/bin/python
+
+# treater/standins.py
+
+"""Stand-ins for the treater hardware, so that the machine, camera and web API can run on any Linux box"""
+
+import os
+import random
+from datetime import datetime
+from logging import getLogger
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.python import threadable
+from gpiosys import GPIO
+from camera import TreatCam, TreatCamConfig
+from machine import TreatMachine, TreatMachineConfig
+from metrics import REGISTRY
+from correlation import CorrelationIndex, CorrelationConfig
+
+LOGGER = getLogger("main")
+
+SNAPSHOT_REQUESTS = REGISTRY.counter("treater_standin_snapshot_requests_total",
+                                     "Snapshot requests that reached the stand-in motion daemon")
+
+class StandInGPIO:
+    """Holds pin values in memory. Inputs idle at their inactive levels (the button input is active low)"""
+
+    def __init__(self, idleValues = None):
+        self.values = dict(idleValues or {})
+        self.pins = {}
+        self.writeListeners = []
+
+    def close(self):
+        self.pins.clear()
+
+    def setupPin(self, pinNumber, pinType, initialValue = None):
+        self.pins[pinNumber] = GPIO.Pin(pinNumber, pinType)
+        if pinNumber not in self.values:
+            self.values[pinNumber] = initialValue or 0
+
+    def setupPins(self, pinSpecs, timeoutSeconds = 2.0):
+        for (pinNumber, pinType, initialValue) in pinSpecs:
+            self.setupPin(pinNumber, pinType, initialValue)
+        return dict((pinNumber, 0.0) for (pinNumber, pinType, initialValue) in pinSpecs)
+
+    def readPin(self, pinNumber):
+        return self.values[pinNumber]
+
+    def writePin(self, pinNumber, value):
+        self.values[pinNumber] = value
+        for listener in self.writeListeners:
+            listener(pinNumber, value)
+
+class SimulatedDispenser:
+    """Drives a StandInGPIO like the real dispenser: while powered it drops treats at roughly treatsPerSecond, each
+    one pulsing the treat detector, and treats already on their way keep falling for coastSeconds after power-off"""
+
+    def __init__(self, reactor, gpio, detectorPin, powerPin, treatsPerSecond = 4.0, coastSeconds = 0.3,
+                 pulseSeconds = 0.04, seed = None):
+        self.reactor = reactor
+        self.gpio = gpio
+        self.detectorPin = detectorPin
+        self.powerPin = powerPin
+        self.treatsPerSecond = treatsPerSecond
+        self.coastSeconds = coastSeconds
+        self.pulseSeconds = pulseSeconds
+        self.random = random.Random(seed)
+        self.powered = False
+        self.powerOffTime = None
+        self.nextTreat = None
+        self.treatsDropped = 0
+        gpio.writeListeners.append(self.pinWritten)
+
+    def pinWritten(self, pinNumber, value):
+        if not threadable.isInIOThread():
+            # Written by the hardware thread
+            self.reactor.callFromThread(self.pinWritten, pinNumber, value)
+            return
+        if pinNumber != self.powerPin or bool(value) == self.powered:
+            return
+        self.powered = bool(value)
+        if self.powered:
+            self.powerOffTime = None
+            if self.nextTreat is None or not self.nextTreat.active():
+                self.scheduleTreat()
+        else:
+            self.powerOffTime = self.reactor.seconds()
+
+    def scheduleTreat(self):
+        interval = self.random.uniform(0.8, 1.2) / self.treatsPerSecond
+        self.nextTreat = self.reactor.callLater(interval, self.dropTreat)
+
+    def dropTreat(self):
+        if not self.powered and self.reactor.seconds() - self.powerOffTime > self.coastSeconds:
+            return
+        self.treatsDropped += 1
+        self.gpio.values[self.detectorPin] = 1
+        self.reactor.callLater(self.pulseSeconds, self.gpio.values.__setitem__, self.detectorPin, 0)
+        self.scheduleTreat()
+
+class StandInLCD:
+    """Remembers what would have been shown on the serial LCD"""
+
+    def __init__(self):
+        self.lines = ("", "")
+        self.backlight = False
+
+    def close(self):
+        pass
+
+    def clear(self):
+        self.lines = ("", "")
+
+    def setDisplayMode(self, display = True, cursor = True, blink = False):
+        pass
+
+    def enableBacklight(self, enabled):
+        self.backlight = enabled
+
+    def writeBothLines(self, line1, line2 = ''):
+        self.lines = (line1, line2)
+
+class PtyLCD:
+    """Pseudo-terminal that a SerialLCD can open as its device. Bytes written to it are decoded with the
+    Parallax 2x16 serial LCD command set, so the resulting display contents can be checked"""
+
+    WIDTH = 16
+
+    def __init__(self, reactor = None):
+        (self.master, self.slave) = os.openpty()
+        self.deviceName = os.ttyname(self.slave)
+        self.cells = [" "] * (self.WIDTH * 2)
+        self.cursor = 0
+        self.backlight = False
+        self.bytesReceived = 0
+        if reactor is not None:
+            from twisted.internet import abstract
+            pty = self
+
+            class MasterReader(abstract.FileDescriptor):
+                def fileno(self):
+                    return pty.master
+
+                def doRead(self):
+                    pty.drain()
+
+            self.reader = MasterReader(reactor)
+            self.reader.startReading()
+
+    def drain(self):
+        self.feed(os.read(self.master, 4096))
+
+    def feed(self, data):
+        self.bytesReceived += len(data)
+        for c in data:
+            code = ord(c)
+            if code == 0x0C:
+                self.cells = [" "] * (self.WIDTH * 2)
+                self.cursor = 0
+            elif code == 0x0D:
+                self.cursor = self.WIDTH if self.cursor < self.WIDTH else 0
+            elif code == 0x11 or code == 0x12:
+                self.backlight = code == 0x11
+            elif 0x80 <= code < 0x80 + self.WIDTH:
+                self.cursor = code - 0x80
+            elif 0x94 <= code < 0x94 + self.WIDTH:
+                self.cursor = self.WIDTH + code - 0x94
+            elif 0x20 <= code < 0x80:
+                self.cells[self.cursor] = c
+                self.cursor = (self.cursor + 1) % len(self.cells)
+
+    def lines(self):
+        text = "".join(self.cells)
+        return (text[:self.WIDTH], text[self.WIDTH:])
+
+class StandInTreatMachine(TreatMachine):
+
+    def __init__(self, reactor, config = None):
+        if config is None:
+            config = standInMachineConfig()
+        gpio = StandInGPIO({config.gpioButton: 1})
+        TreatMachine.__init__(self, reactor, config, lcd = StandInLCD(), gpio = gpio)
+
+def standInMachineConfig():
+    config = TreatMachineConfig()
+    # No history file, and a short cycle so that dispense storms see the machine become available again
+    config.historyFile = None
+    config.maxTreatsPerCycle = 3
+    config.treatEnabledSeconds = 1
+    config.postCycleSeconds = 0.5
+    config.treatRecoverySeconds = 2
+    return config
+
+class StandInMotionAgent:
+    """Answers the snapshot action URL the way the motion daemon does: the HTTP request completes at once,
+    and the new capture appears a little later"""
+
+    def __init__(self, reactor, camera, captureSeconds):
+        self.reactor = reactor
+        self.camera = camera
+        self.captureSeconds = captureSeconds
+        self.captureCount = 0
+
+    def request(self, method, uri, headers = None, bodyProducer = None):
+        SNAPSHOT_REQUESTS.inc()
+        self.reactor.callLater(self.captureSeconds, self.captureCompleted)
+        d = Deferred()
+        self.reactor.callLater(0, d.callback, None)
+        return d
+
+    def captureCompleted(self):
+        self.captureCount += 1
+        name = "capture-%s-%02d.jpg" % (datetime.now().strftime(TreatCam.CAPTURE_DATETIME_FORMAT), self.captureCount % 100)
+        self.camera.captureCreated(name)
+
+class StandInTreatCam(TreatCam):
+
+    def __init__(self, reactor, captureSeconds = 0.25):
+        self.config = TreatCamConfig()
+        self.reactor = reactor
+        self.agent = StandInMotionAgent(reactor, self, captureSeconds)
+        self.defers = []
+        self.captureListeners = []
+        self.snapshotActionUrl = "http://localhost:%d/0/action/snapshot" % self.config.motionControlPort
+        self.lastCaptureTime = None
+        self.lastCaptureName = None
+
+def startStandInTreater(reactor, port, captureSeconds = 0.25):
+    from website import TreatWeb, TreatWebConfig
+    machine = StandInTreatMachine(reactor)
+    # So that dispense cycles deliver treats, and dispenseTreat?wait=1 has a count to report
+    SimulatedDispenser(reactor, machine.gpio, machine.config.gpioTreatDetector, machine.config.gpioTreatPower)
+    camera = StandInTreatCam(reactor, captureSeconds)
+    config = TreatWebConfig()
+    config.port = port
+    config.capturePath = "/captures"
+    correlation = CorrelationIndex(CorrelationConfig())
+    camera.addCaptureListener(correlation)
+    machine.history.addListener(correlation)
+    machine.start()
+    web = TreatWeb(reactor, None, None, config)
+    web.attach(machine, camera, correlation)
+    return (machine, camera, web)
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    from logging import Formatter, StreamHandler, INFO, getLogger
+    from twisted.python.log import PythonLoggingObserver
+
+    parser = ArgumentParser(description = "Run the treater web API against stand-in hardware")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--capture-seconds", type=float, default=0.25, help="simulated motion daemon capture latency")
+    args = parser.parse_args()
+
+    logFormatter = Formatter(fmt='%(asctime)s - %(name)s - %(levelname)s - %(message)s', datefmt="%Y-%m-%d %H:%M:%S")
+    rootLogger = getLogger()
+    consoleHandler = StreamHandler()
+    consoleHandler.setFormatter(logFormatter)
+    rootLogger.addHandler(consoleHandler)
+    rootLogger.setLevel(INFO)
+    observer = PythonLoggingObserver()
+    observer.start()
+
+    startStandInTreater(reactor, args.port, args.capture_seconds)
+    LOGGER.info("Stand-in treater listening on port %d" % args.port)
+    reactor.run()
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+
+# treater/startup.py
+
+"""Start-up measurements: an import-time profile and the time taken to reach each start-up milestone"""
+
+import os
+import sys
+import time
+import __builtin__
+from logging import getLogger
+from metrics import REGISTRY
+
+LOGGER = getLogger("main")
+
+def processStartTime():
+    """When the process was started (seconds since the epoch), including interpreter start-up, from /proc"""
+    try:
+        with open("/proc/self/stat") as f:
+            # The command name may contain spaces, so split after its closing parenthesis
+            fields = f.read().rsplit(")", 1)[1].split()
+        startTicks = int(fields[19])
+        with open("/proc/stat") as f:
+            bootTime = int([line for line in f if line.startswith("btime")][0].split()[1])
+        return bootTime + float(startTicks) / os.sysconf("SC_CLK_TCK")
+    except (IOError, OSError, IndexError, ValueError):
+        return time.time()
+
+class StartupTimer:
+    def __init__(self):
+        self.startTime = processStartTime()
+        self.marks = {}
+        self.responded = False
+
+    def __str__(self):
+        return "StartupTimer"
+
+    def mark(self, milestone):
+        if milestone in self.marks:
+            return
+        elapsed = time.time() - self.startTime
+        self.marks[milestone] = elapsed
+        REGISTRY.gauge("treater_startup_seconds", "Time from process start to each start-up milestone",
+                       {"milestone": milestone}).set(elapsed)
+        LOGGER.info("Start-up: %s after %.0f ms" % (milestone, elapsed * 1000))
+
+    def firstResponse(self):
+        if not self.responded:
+            self.responded = True
+            self.mark("first_response")
+
+STARTUP = StartupTimer()
+
+class ImportProfiler:
+    """Times every module imported while installed. Nested imports are included in their parent's time"""
+
+    def __init__(self):
+        self.records = []
+        self.depth = 0
+        self.original = None
+
+    def install(self):
+        self.original = __builtin__.__import__
+        __builtin__.__import__ = self.profiledImport
+
+    def uninstall(self):
+        if self.original is not None:
+            __builtin__.__import__ = self.original
+            self.original = None
+
+    def profiledImport(self, name, globals = None, locals = None, fromlist = None, level = -1):
+        loaded = len(sys.modules)
+        start = time.time()
+        self.depth += 1
+        try:
+            return self.original(name, globals, locals, fromlist, level)
+        finally:
+            self.depth -= 1
+            # Only imports that actually loaded something are interesting
+            if len(sys.modules) > loaded:
+                if fromlist:
+                    name = "%s (%s)" % (name, ", ".join(fromlist))
+                self.records.append((time.time() - start, self.depth, name))
+
+    def report(self, limit = 30, minimumSeconds = 0.001):
+        lines = ["Import profile (inclusive ms, nesting depth, module):"]
+        for (seconds, depth, name) in sorted(self.records, reverse=True)[:limit]:
+            if seconds < minimumSeconds:
+                break
+            lines.append("%8.1f  %2d  %s" % (seconds * 1000, depth, name))
+        return "\n".join(lines)
@@ -0,0 +1,71 @@
+#!/usr/bin/python
+
+# treater/statussnapshot.py
+
+"""Status document shared between processes through a memory-mapped file, guarded by a seqlock"""
+
+import mmap
+import os
+import struct
+import time
+
+class StatusSnapshot:
+    """A single writer publishes, any number of readers in other processes read without locking. The sequence
+    number is odd while a write is in progress, and readers retry if it was odd or changed while they copied"""
+
+    HEADER = struct.Struct("<II")
+    SEQUENCE = struct.Struct("<I")
+    DEFAULT_SIZE = 65536
+    MAX_READ_ATTEMPTS = 1000
+
+    def __init__(self, path, size = DEFAULT_SIZE, create = False):
+        self.path = path
+        self.size = size
+        flags = os.O_RDWR | (os.O_CREAT if create else 0)
+        fd = os.open(path, flags, 0o640)
+        try:
+            if create:
+                os.ftruncate(fd, size)
+            else:
+                self.size = os.fstat(fd).st_size
+            self.map = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+        if create:
+            self.HEADER.pack_into(self.map, 0, 0, 0)
+        self.sequence = self.SEQUENCE.unpack_from(self.map, 0)[0]
+
+    def __str__(self):
+        return "StatusSnapshot"
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def publish(self, data):
+        if self.HEADER.size + len(data) > self.size:
+            raise ValueError("Status of %d bytes does not fit in a %d byte snapshot" % (len(data), self.size))
+        # Round up to an odd sequence: readers treat the snapshot as being written until it is even again
+        self.sequence = ((self.sequence + 1) | 1) & 0xFFFFFFFF
+        self.SEQUENCE.pack_into(self.map, 0, self.sequence)
+        self.SEQUENCE.pack_into(self.map, 4, len(data))
+        self.map[self.HEADER.size:self.HEADER.size + len(data)] = data
+        # Zero is reserved for "never published", so skip it when the counter wraps
+        self.sequence = ((self.sequence + 1) & 0xFFFFFFFF) or 2
+        self.SEQUENCE.pack_into(self.map, 0, self.sequence)
+
+    def read(self):
+        """Returns the most recently published data, or None if nothing has been published yet"""
+        for attempt in xrange(self.MAX_READ_ATTEMPTS):
+            (before, length) = self.HEADER.unpack_from(self.map, 0)
+            if before & 1:
+                # Writer is mid-update; it only takes microseconds, so yield rather than sleep for long
+                time.sleep(0)
+                continue
+            if before == 0:
+                return None
+            data = self.map[self.HEADER.size:self.HEADER.size + min(length, self.size - self.HEADER.size)]
+            if self.SEQUENCE.unpack_from(self.map, 0)[0] == before:
+                return data
+        raise IOError("Unable to read a consistent status snapshot from %s" % self.path)
@@ -0,0 +1,156 @@
+#!/usr/bin/python
+
+# treater/tracebuffer.py
+
+"""In-memory trace of hot-path events. Events have a fixed shape (time, event id, two small ints) and are stored in
+preallocated arrays, so recording one never formats a string or allocates. Text is only produced on dump"""
+
+import sys
+import time
+from array import array
+from datetime import datetime
+from logging import getLogger
+from twisted.web.resource import Resource
+
+LOGGER = getLogger("main")
+
+DEFAULT_CAPACITY = 4096
+# A failing poll loop would otherwise write a dump every few milliseconds
+MIN_SECONDS_BETWEEN_CRASH_DUMPS = 60
+
+class TraceEvent:
+    def __init__(self, eventId, subsystem, name, format, formatter):
+        self.eventId = eventId
+        self.subsystem = subsystem
+        self.name = name
+        self.format = format
+        self.formatter = formatter
+
+    def describe(self, a, b):
+        if self.formatter is not None:
+            return self.formatter(a, b)
+        return self.format % {"a": a, "b": b}
+
+class TraceBuffer:
+    def __init__(self, capacity = DEFAULT_CAPACITY):
+        self.events = [None]
+        self.crashDumpFile = None
+        self.lastCrashDumpTime = 0
+        self.allocate(capacity)
+
+    def __str__(self):
+        return "TraceBuffer"
+
+    def allocate(self, capacity):
+        """Discards anything recorded so far"""
+        self.capacity = capacity
+        self.times = array("d", [0.0]) * capacity
+        self.ids = array("H", [0]) * capacity
+        self.argA = array("l", [0]) * capacity
+        self.argB = array("l", [0]) * capacity
+        self.count = 0
+
+    def defineEvent(self, subsystem, name, format = "", formatter = None):
+        """Returns the id to pass to record(). format is applied to a dict of the args, a and b; formatter, when
+        given, is called with them instead"""
+        event = TraceEvent(len(self.events), subsystem, name, format, formatter)
+        self.events.append(event)
+        return event.eventId
+
+    def record(self, eventId, a = 0, b = 0):
+        i = self.count % self.capacity
+        self.times[i] = time.time()
+        self.ids[i] = eventId
+        self.argA[i] = a
+        self.argB[i] = b
+        self.count += 1
+
+    def entries(self, limit = None):
+        """(time, event, a, b) for the retained events, oldest first"""
+        retained = min(self.count, self.capacity)
+        if limit is not None:
+            retained = min(retained, limit)
+        first = self.count - retained
+        result = []
+        for n in range(first, self.count):
+            i = n % self.capacity
+            result.append((self.times[i], self.events[self.ids[i]], self.argA[i], self.argB[i]))
+        return result
+
+    def dump(self, limit = None):
+        lines = []
+        for (when, event, a, b) in self.entries(limit):
+            stamp = datetime.fromtimestamp(when).strftime("%Y-%m-%d %H:%M:%S.%f")
+            lines.append("%s %-9s %-14s %s" % (stamp, event.subsystem, event.name, event.describe(a, b)))
+        return "\n".join(lines) + "\n"
+
+    def crashDump(self, reason):
+        """Writes the trace to the configured crash dump file, at most once a minute"""
+        now = time.time()
+        if not self.crashDumpFile or now - self.lastCrashDumpTime < MIN_SECONDS_BETWEEN_CRASH_DUMPS:
+            return
+        self.lastCrashDumpTime = now
+        try:
+            with open(self.crashDumpFile, "w") as f:
+                f.write("# Trace dumped after: %s\n" % reason)
+                f.write(self.dump())
+            LOGGER.error("Trace of the last %d events written to %s" % (min(self.count, self.capacity), self.crashDumpFile))
+        except (IOError, OSError):
+            LOGGER.exception("Unable to write trace dump")
+
+    def installExceptHook(self):
+        previousHook = sys.excepthook
+        def excepthook(excType, value, tb):
+            self.crashDump("unhandled %s: %s" % (excType.__name__, value))
+            previousHook(excType, value, tb)
+        sys.excepthook = excepthook
+
+TRACE = TraceBuffer()
+
+class AdminTraceResource(Resource):
+    """GET: the retained trace events as text, oldest first. ?limit=N returns only the newest N"""
+    isLeaf = True
+
+    def __init__(self, trace):
+        Resource.__init__(self)
+        self.trace = trace
+
+    def render_GET(self, request):
+        request.setHeader(b"Content-Type", b"text/plain; charset=utf-8")
+        try:
+            limit = int(request.args["limit"][0]) if "limit" in request.args else None
+        except ValueError:
+            request.setResponseCode(400)
+            return "limit must be an integer"
+        return self.trace.dump(limit)
+
+class TraceConfig:
+    SECTION_NAME = "main"
+
+    def __init__(self, config = None):
+        self.traceCapacity = DEFAULT_CAPACITY
+        self.traceDumpFile = ""
+        if config:
+            self.load(config)
+
+    def load(self, config):
+        sec = TraceConfig.SECTION_NAME
+        self.traceCapacity = config.getint(sec, "traceCapacity")
+        self.traceDumpFile = config.get(sec, "traceDumpFile")
+
+def configureTrace(config):
+    TRACE.allocate(config.traceCapacity)
+    TRACE.crashDumpFile = config.traceDumpFile
+    TRACE.installExceptHook()
+    from memory import MEMORY
+    MEMORY.register("trace", lambda: (sum(a.buffer_info()[1] * a.itemsize for a in (TRACE.times, TRACE.ids, TRACE.argA, TRACE.argB)),
+                                      TRACE.capacity))
+
+if __name__ == "__main__":
+    TICK = TRACE.defineEvent("demo", "tick", "n=%(a)d odd=%(b)d")
+    start = time.time()
+    for n in range(100000):
+        TRACE.record(TICK, n, n & 1)
+    elapsed = time.time() - start
+    print(TRACE.dump(5))
+    print("%.2f us per event recorded" % (elapsed / 100000 * 1e6))
@@ -5,18 +5,13 @@
 import json
 import datetime
 import time
-from os import getcwd, path
+from os import getcwd, path, remove
 from logging import getLogger
-from twisted.web.server import Site, NOT_DONE_YET
-from twisted.web.static import File
-from twisted.web.resource import Resource, IResource
-from twisted.web.proxy import ReverseProxyResource
 from twisted.internet import defer
-from zope.interface import implements
-from twisted.cred import portal, checkers, credentials, error as credError
-from twisted.web.guard import HTTPAuthSessionWrapper
-from twisted.web.guard import DigestCredentialFactory
-from twisted.web.guard import BasicCredentialFactory
+from twisted.web.server import Site, NOT_DONE_YET
+from twisted.web.resource import Resource
+from metrics import REGISTRY, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from startup import STARTUP
 
 LOGGER = getLogger("webapi")
 
@@ -33,6 +28,15 @@ class TreatWebConfig:
     def __init__(self, config = None):
         self.capturePath = path.join(getcwd(), "/captures")
         self.port = 8000
+        self.serveCaptures = False
+        self.apiWorkers = 0
+        self.workerSocket = ""
+        self.controlSocket = path.join(getcwd(), "treater-control.sock")
+        self.statusSnapshotFile = "/dev/shm/treater-status"
+        self.snapshotIntervalSeconds = 0.5
+        self.adminPasswordFile = ""
+        self.maxProfileSeconds = 300
+        self.dispenseWaitSeconds = 60
         if config:
             self.load(config)
 
@@ -40,24 +44,80 @@ class TreatWebConfig:
         sec = TreatWebConfig.SECTION_NAME
         self.capturePath = config.get(sec, "capturePath")
         self.port = config.getint(sec, "port")
+        self.serveCaptures = config.getboolean(sec, "serveCaptures")
+        self.apiWorkers = config.getint(sec, "apiWorkers")
+        self.workerSocket = config.get(sec, "workerSocket")
+        self.controlSocket = config.get(sec, "controlSocket")
+        self.statusSnapshotFile = config.get(sec, "statusSnapshotFile")
+        self.snapshotIntervalSeconds = config.getfloat(sec, "snapshotIntervalSeconds")
+        self.adminPasswordFile = config.get(sec, "adminPasswordFile")
+        self.maxProfileSeconds = config.getint(sec, "maxProfileSeconds")
+        self.dispenseWaitSeconds = config.getfloat(sec, "dispenseWaitSeconds")
 
 class TreatWeb:
+    """The web API. May be created with machine and camera set to None so that it can start listening while the
+    hardware is still initializing; attach() supplies them once they are ready"""
+
     def __init__(self, reactor, machine, camera, config):
         self.config = config
         self.reactor = reactor
-        self.machine = machine
-        self.camera = camera
+        self.machine = None
+        self.camera = None
 
-        root = Resource()
+        self.root = Resource()
         api = Resource()
-        api.putChild("getStatus", ApiGetStatus(config, machine, camera))
-        api.putChild("capturePhoto", ApiCapturePhoto(config, machine, camera))
-        api.putChild("dispenseTreat", ApiDispenseTreat(config, machine, camera))
-        api.putChild("getVideoStreamUrl", ApiGetVideoStreamUrl(config, machine, camera))
-        root.putChild("api", api)
-
-        site = Site(root)
-        reactor.listenTCP(self.config.port, site)
+        self.statusResource = ApiGetStatus(config, machine, camera)
+        self.apiResources = [self.statusResource,
+                             ApiCapturePhoto(config, machine, camera),
+                             ApiDispenseTreat(config, machine, camera),
+                             ApiGetVideoStreamUrl(config, machine, camera),
+                             ApiMetrics(config, machine, camera),
+                             ApiTreats(config, machine, camera),
+                             ApiHistory(config, machine, camera),
+                             ApiActivity(config, machine, camera)]
+        for resource in self.apiResources:
+            api.putChild(resource.NAME, resource)
+        self.root.putChild("api", api)
+        self.admin = None
+        self.profiler = None
+        if self.config.adminPasswordFile:
+            self.createAdmin(api)
+        if machine is not None and camera is not None:
+            self.attach(machine, camera)
+
+        site = Site(self.root)
+        if self.config.apiWorkers:
+            # API worker processes own the public port; they forward to us over the control socket
+            if path.exists(self.config.controlSocket):
+                remove(self.config.controlSocket)
+            reactor.listenUNIX(self.config.controlSocket, site)
+        else:
+            reactor.listenTCP(self.config.port, site)
+        STARTUP.mark("listening")
+
+    def createAdmin(self, api):
+        from admin import createAdminResource
+        from profiler import CpuProfiler, AdminProfileResource
+        from tracebuffer import TRACE, AdminTraceResource
+        (self.admin, protected) = createAdminResource(self.config.adminPasswordFile)
+        self.profiler = CpuProfiler(self.reactor, self.config.maxProfileSeconds)
+        self.admin.putChild("profile", AdminProfileResource(self.profiler))
+        self.admin.putChild("trace", AdminTraceResource(TRACE))
+        api.putChild("admin", protected)
+
+    def attach(self, machine, camera, correlation = None):
+        self.machine = machine
+        self.camera = camera
+        for resource in self.apiResources:
+            resource.machine = machine
+            resource.camera = camera
+            resource.correlation = correlation
+        if self.config.serveCaptures:
+            # Serve the capture directory ourselves when there is no nginx in front of us
+            from capturefiles import CaptureFileResource
+            captures = CaptureFileResource(camera.config.captureDir, camera.config.capturesToRetain,
+                                           getattr(camera, "store", None))
+            self.root.putChild(self.config.capturePath.strip("/"), captures)
  
 def datetimeToJsonStr(dt):
     if not dt:
@@ -66,12 +126,34 @@ def datetimeToJsonStr(dt):
 
 class ApiResource(Resource):
     jsonContentType = b"application/json"
+    # Resources that need the machine or camera answer 503 until the hardware has been initialized
+    requiresHardware = False
+    correlation = None
 
     def __init__(self, config, machine, camera):
         self.config = config
         self.machine = machine
         self.camera = camera
         self.isLeaf = True
+        self.latency = REGISTRY.histogram("treater_api_request_duration_seconds", "Time spent handling web API requests",
+                                          labels = {"resource": self.__class__.__name__})
+
+    def render(self, request):
+        start = time.time()
+        if self.requiresHardware and self.machine is None:
+            request.setResponseCode(503)
+            result = "Treater is initializing"
+        else:
+            result = Resource.render(self, request)
+        if result == NOT_DONE_YET:
+            request.notifyFinish().addBoth(self.observeLatency, start)
+        else:
+            self.observeLatency(None, start)
+        return result
+
+    def observeLatency(self, ignored, start):
+        self.latency.observe(time.time() - start)
+        STARTUP.firstResponse()
 
     def makeCapturePath(self, capture):
         if not capture:
@@ -83,10 +165,19 @@ class ApiResource(Resource):
         return self.makeCapturePath(capture)
 
     def getStatus(self):
+        if self.machine is None or self.camera is None:
+            return {
+                "lastTreat" : "",
+                "numTreatsInLast24Hours" : 0,
+                "numCyclesInLast24Hours" : 0,
+                "timeSinceLastTreat" : { "hours" : -1, "minutes" : -1 },
+                "machineState" : "Initializing",
+                "captureTime" : "",
+                "capturePath" : ""}
         (cycleCount, treatCount, lastTreatTime) = self.machine.history.getTreatStats()
         if lastTreatTime:
             td = datetime.datetime.now() - lastTreatTime
-            (hours, minutes) = (int(td.total_seconds()/3600), int(td.total_seconds()%60))
+            (hours, minutes) = (int(td.total_seconds()/3600), int(td.total_seconds()%3600/60))
         else:
             (hours, minutes) = (-1, -1)
         result = {
@@ -101,6 +192,8 @@ class ApiResource(Resource):
 
 
 class ApiGetStatus(ApiResource):
+    NAME = "getStatus"
+
     def __init__(self, config, machine, camera):
         ApiResource.__init__(self, config, machine, camera)
 
@@ -110,6 +203,8 @@ class ApiGetStatus(ApiResource):
         return result
 
 class ApiGetVideoStreamUrl(ApiResource):
+    NAME = "getVideoStreamUrl"
+
     def __init__(self, config, machine, camera):
         ApiResource.__init__(self, config, machine, camera)
 
@@ -119,6 +214,9 @@ class ApiGetVideoStreamUrl(ApiResource):
         return result
 
 class ApiCapturePhoto(ApiResource):
+    NAME = "capturePhoto"
+    requiresHardware = True
+
     def __init__(self, config, machine, camera):
         ApiResource.__init__(self, config, machine, camera)
 
@@ -146,15 +244,157 @@ class ApiCapturePhoto(ApiResource):
         request.finish()
 
 class ApiDispenseTreat(ApiResource):
+    """POST starts a dispense cycle (or joins the one under way) and answers with the status straight away. With
+    ?wait=1 the answer is held until the cycle completes, and holds its result as well as the status"""
+    NAME = "dispenseTreat"
+    requiresHardware = True
+
     def __init__(self, config, machine, camera):
         ApiResource.__init__(self, config, machine, camera)
 
     def render_POST(self, request):
         LOGGER.info("Treat dispense request from web")
-        success = self.machine.dispenseTreat()
-        if not success:
+        d = self.machine.dispenseTreat()
+        if d is None:
             request.setResponseCode(429) # Too many requests
             return "Treat machine is busy. Please allow 60 seconds between treat dispense requests"
+        if request.args.get("wait", ["0"])[0] != "1":
+            d.addErrback(lambda failure: None)
+            request.defaultContentType = ApiResource.jsonContentType
+            return json.dumps(self.getStatus())
+        d.addTimeout(self.config.dispenseWaitSeconds, self.machine.reactor)
+        client = {"connected": True}
+        def clientGone(failure):
+            client["connected"] = False
+            d.cancel()
+        request.notifyFinish().addErrback(clientGone)
+        d.addCallbacks(self.dispenseCompleted, self.dispenseFailed, callbackArgs=(request, client),
+                       errbackArgs=(request, client))
+        return NOT_DONE_YET
+
+    def dispenseCompleted(self, result, request, client):
+        if not client["connected"]:
+            return
+        request.defaultContentType = ApiResource.jsonContentType
+        response = result.describe()
+        response["status"] = self.getStatus()
+        request.write(json.dumps(response))
+        request.finish()
+
+    def dispenseFailed(self, failure, request, client):
+        if not client["connected"]:
+            return
+        if failure.check(defer.TimeoutError):
+            request.setResponseCode(504)
+            request.write("Timed out waiting for the dispense cycle to complete")
+        else:
+            LOGGER.error("Dispense cycle did not complete: %s" % failure.getErrorMessage())
+            request.setResponseCode(503)
+            request.write("Dispense cycle did not complete")
+        request.finish()
+
+class ApiMetrics(ApiResource):
+    NAME = "metrics"
+
+    def __init__(self, config, machine, camera):
+        ApiResource.__init__(self, config, machine, camera)
+
+    def render_GET(self, request):
+        request.setHeader(b"Content-Type", METRICS_CONTENT_TYPE)
+        return REGISTRY.render()
+
+class ApiTreats(ApiResource):
+    """/api/treats lists the treats in the correlation index, newest first. /api/treats/<id>/captures lists the
+    captures taken around that treat, where id is the treat time as YYYYmmdd-HHMMSS or "latest" """
+    NAME = "treats"
+    requiresHardware = True
+
+    def __init__(self, config, machine, camera):
+        ApiResource.__init__(self, config, machine, camera)
+
+    def render_GET(self, request):
         request.defaultContentType = ApiResource.jsonContentType
-        return json.dumps(self.getStatus())
+        if self.correlation is None:
+            request.setResponseCode(404)
+            return "Treat capture correlation is not enabled"
+        postpath = [p for p in request.postpath if p]
+        if not postpath:
+            treats = [self.describeTreat(self.correlation.getTreat(tid)) for tid in reversed(self.correlation.getTreatIds())]
+            return json.dumps({"treats" : treats})
+        if len(postpath) != 2 or postpath[1] != "captures":
+            request.setResponseCode(404)
+            return "No such resource"
+        treat = self.correlation.getTreat(postpath[0])
+        if treat is None:
+            request.setResponseCode(404)
+            return "No such treat"
+        captures = [{"captureTime" : datetimeToJsonStr(captureTime), "capturePath" : self.makeCapturePath(name)}
+                    for (name, captureTime) in self.correlation.capturesForTreat(treat[0])]
+        return json.dumps({"treat" : self.describeTreat(treat), "captures" : captures})
+
+    def describeTreat(self, treat):
+        (tid, treatTime, treatCount) = treat
+        return {"id" : tid, "treatTime" : datetimeToJsonStr(treatTime), "treatCount" : treatCount}
+
+class ApiHistory(ApiResource):
+    """/api/history/export?format=ndjson|csv&from=&to= streams the treat history, oldest first. from and to are epoch
+    seconds or local times as YYYY-mm-ddTHH:MM:SS; from is inclusive and to exclusive"""
+    NAME = "history"
+    requiresHardware = True
 
+    def __init__(self, config, machine, camera):
+        ApiResource.__init__(self, config, machine, camera)
+
+    def render_GET(self, request):
+        from historyexport import HistoryExportProducer, CONTENT_TYPES, NDJSON, parseTime, iterArchive, iterEvents
+        postpath = [p for p in request.postpath if p]
+        if postpath != ["export"]:
+            request.setResponseCode(404)
+            return "No such resource"
+        format = request.args.get("format", [NDJSON])[0]
+        if format not in CONTENT_TYPES:
+            request.setResponseCode(400)
+            return "format must be one of: %s" % ", ".join(sorted(CONTENT_TYPES))
+        try:
+            fromEpoch = parseTime(request.args["from"][0]) if request.args.get("from", [""])[0] else None
+            toEpoch = parseTime(request.args["to"][0]) if request.args.get("to", [""])[0] else None
+        except ValueError as e:
+            request.setResponseCode(400)
+            return str(e)
+        history = self.machine.history
+        if history.archivePath and path.isfile(history.archivePath):
+            records = iterArchive(history.archivePath, fromEpoch, toEpoch)
+        else:
+            records = iterEvents(history.treatEvents, fromEpoch, toEpoch)
+        request.setHeader(b"Content-Type", CONTENT_TYPES[format])
+        request.setHeader(b"Content-Disposition", b"attachment; filename=treathistory.%s" % format)
+        HistoryExportProducer(request, records, format).start()
+        return NOT_DONE_YET
+
+class ApiActivity(ApiResource):
+    """/api/activity?from=&to=&resolution=second|minute|hour returns the motion activity series as
+    [start epoch, peak, mean, frames] buckets, leaving out buckets with no frames. from and to are as for
+    /api/history/export, defaulting to the last hour; without resolution, the finest that suits the range is used"""
+    NAME = "activity"
+    requiresHardware = True
+
+    def __init__(self, config, machine, camera):
+        ApiResource.__init__(self, config, machine, camera)
+
+    def render_GET(self, request):
+        from historyexport import parseTime
+        request.defaultContentType = ApiResource.jsonContentType
+        activity = getattr(self.camera, "activity", None)
+        if activity is None:
+            request.setResponseCode(404)
+            return "Motion activity is only recorded by the raspicam camera"
+        now = time.time()
+        try:
+            toEpoch = parseTime(request.args["to"][0]) if request.args.get("to", [""])[0] else now
+            fromEpoch = parseTime(request.args["from"][0]) if request.args.get("from", [""])[0] else toEpoch - 3600
+            (level, buckets) = activity.query(fromEpoch, toEpoch, request.args.get("resolution", [None])[0] or None)
+        except ValueError as e:
+            request.setResponseCode(400)
+            return str(e)
+        return json.dumps({"from": fromEpoch, "to": toEpoch, "resolution": level.name, "bucketSeconds": level.seconds,
+                           "buckets": buckets}, separators=(",", ":"))